@@ -7,13 +7,22 @@ from Ruppert's book.
 """
 
 import os
+import time
 import uuid
 import json
 import logging
 import tempfile
 import subprocess
+import redis
 import docker
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+from output import OutputCollector
+from sandbox_pool import SandboxPool
+from sessions import SessionManager, KERNEL_DIR
+from result_cache import ResultCache
+from scheduler import Scheduler, QueueFull, parse_memory, default_workers
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -28,41 +37,380 @@ docker_client = docker.from_env()
 # Configuration
 MAX_EXECUTION_TIME = int(os.getenv('MAX_EXECUTION_TIME', 30))  # seconds
 MAX_MEMORY = os.getenv('MAX_MEMORY', '512m')
+OUTPUT_MAX_BYTES = int(os.getenv('OUTPUT_MAX_KB', 128)) * 1024  # stdout and stderr together
+ARTIFACT_MAX_COUNT = int(os.getenv('ARTIFACT_MAX_COUNT', 10))
+ARTIFACT_MAX_BYTES = int(os.getenv('ARTIFACT_MAX_KB', 512)) * 1024
+WORKDIR_MAX_SIZE = os.getenv('WORKDIR_MAX_SIZE', '64m')  # tmpfs for the files code writes
+SANDBOX_IMAGES = {
+    'python': "python:3.11-slim",
+    'r': "rocker/tidyverse:latest"  # Includes common R packages for data analysis
+}
+
+# Metrics, served on /metrics in the Prometheus text format
+EXECUTIONS = Counter(
+    'executor_executions',
+    'Code executions by language and outcome: success, error (non-zero exit), failed (timeout or sandbox error) or cached',
+    ['language', 'outcome']
+)
+EXECUTION_SECONDS = Histogram(
+    'executor_execution_duration_seconds',
+    'Time to handle an execution request, end to end',
+    ['language'],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+)
+STAGE_SECONDS = Histogram(
+    'executor_stage_duration_seconds',
+    'Time spent starting the sandbox container, running the code and reading its output',
+    ['language', 'stage'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30)
+)
+RUNNING = Gauge('executor_running', 'Executions in progress')
+QUEUED = Gauge('executor_queued', 'Executions waiting for a worker')
+REJECTED = Counter('executor_rejected', 'Executions turned away because the queue was full')
+RESULT_CACHE_LOOKUPS = Counter('executor_result_cache_lookups', 'Result cache lookups by result: hit or miss', ['result'])
+SESSIONS = Gauge('executor_sessions', 'Live interpreter sessions by language', ['language'])
+SANDBOXES = Gauge('executor_sandboxes', 'Pooled sandboxes by language and state: idle, busy or starting', ['language', 'state'])
+
+# Pools of started sandboxes, so that code runs without waiting for a container to start
+def create_sandbox_pools():
+    if os.getenv('SANDBOX_POOL_ENABLED', 'true').lower() != 'true':
+        return {}
+    settings = {
+        'max_size': int(os.getenv('SANDBOX_POOL_MAX_SIZE', 8)),
+        'idle_timeout': int(os.getenv('SANDBOX_IDLE_TIMEOUT', 600)),
+        'max_jobs': int(os.getenv('SANDBOX_MAX_JOBS', 1)),
+        'mem_limit': MAX_MEMORY,
+        'workdir_size': WORKDIR_MAX_SIZE
+    }
+    pools = {
+        'python': SandboxPool(docker_client, 'python', SANDBOX_IMAGES['python'], ["python"], "main.py",
+                              size=int(os.getenv('SANDBOX_POOL_PYTHON', 2)),
+                              environment={"PYTHONPATH": "/code", "MPLBACKEND": "Agg"},
+                              files=[os.path.join(KERNEL_DIR, "sitecustomize.py")], **settings),
+        'r': SandboxPool(docker_client, 'r', SANDBOX_IMAGES['r'], ["Rscript"], "main.R",
+                         size=int(os.getenv('SANDBOX_POOL_R', 2)),
+                         environment={"R_PROFILE_USER": "/code/profile.R"},
+                         files=[os.path.join(KERNEL_DIR, "profile.R")], **settings)
+    }
+    for language, pool in pools.items():
+        pool.start()
+        for state in ('idle', 'busy', 'starting'):
+            SANDBOXES.labels(language, state).set_function(lambda pool=pool, state=state: pool.stats()[state])
+    return pools
+
+sandbox_pools = create_sandbox_pools()
+
+# Optional per-conversation interpreter sessions with the book's packages preloaded
+def create_session_manager():
+    if os.getenv('SESSIONS_ENABLED', 'true').lower() != 'true':
+        return None
+    manager = SessionManager(
+        docker_client,
+        {
+            'python': {
+                'image': os.getenv('SESSION_PYTHON_IMAGE', "python:3.11-slim"),
+                'command': ["python", "-u"],
+                'kernel': "kernel.py",
+                'extension': ".py",
+                'environment': {
+                    "PYTHONPATH": "/code",
+                    "MPLBACKEND": "Agg",
+                    "SESSION_PYTHON_MODULES": os.getenv('SESSION_PYTHON_MODULES', "numpy,pandas,scipy,statsmodels,matplotlib")
+                }
+            },
+            'r': {
+                'image': os.getenv('SESSION_R_IMAGE', "rocker/tidyverse:latest"),
+                'command': ["Rscript"],
+                'kernel': "kernel.R",
+                'extension': ".R",
+                'environment': {
+                    "SESSION_R_PACKAGES": os.getenv('SESSION_R_PACKAGES', "tidyverse,MASS,xts,zoo,fGarch,rugarch,Ecdat")
+                }
+            }
+        },
+        max_sessions=int(os.getenv('SESSION_MAX', 20)),
+        idle_timeout=int(os.getenv('SESSION_IDLE_TIMEOUT', 900)),
+        mem_limit=os.getenv('SESSION_MAX_MEMORY', '1g'),
+        workdir_size=WORKDIR_MAX_SIZE,
+        start_timeout=int(os.getenv('SESSION_START_TIMEOUT', 30)),
+        data_dir=os.getenv('SESSION_DATA_DIR') or None
+    )
+    manager.start()
+    for language in manager.languages:
+        SESSIONS.labels(language).set_function(lambda language=language: manager.stats()[language])
+    return manager
+
+session_manager = create_session_manager()
+
+# Results of deterministic code, shared through Redis
+def create_result_cache():
+    if os.getenv('RESULT_CACHE_ENABLED', 'true').lower() != 'true':
+        return None
+    redis_client = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'redis'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        password=os.getenv('REDIS_PASSWORD', ''),
+        decode_responses=True
+    )
+    return ResultCache(
+        redis_client,
+        docker_client,
+        max_bytes=int(os.getenv('RESULT_CACHE_MAX_MB', 64)) * 1024 * 1024,
+        max_entry_bytes=int(os.getenv('RESULT_CACHE_MAX_ENTRY_KB', 256)) * 1024
+    )
+
+result_cache = create_result_cache()
+
+# A bounded number of executions run at once, taking turns between users
+def create_scheduler():
+    # Idle pooled sandboxes and sessions hold memory besides the running jobs
+    reserved = sum(pool.size for pool in sandbox_pools.values()) * parse_memory(MAX_MEMORY)
+    if session_manager is not None:
+        reserved += session_manager.max_sessions * parse_memory(session_manager.mem_limit)
+    workers = int(os.getenv('EXECUTOR_WORKERS', 0)) or default_workers(parse_memory(MAX_MEMORY), reserved)
+    if sandbox_pools:
+        # More workers than sandboxes would fail with PoolExhausted
+        max_size = min(pool.max_size for pool in sandbox_pools.values())
+        if workers > max_size:
+            logger.warning(f"Running {max_size} executions at once, as SANDBOX_POOL_MAX_SIZE allows, not {workers}")
+            workers = max_size
+    scheduler = Scheduler(
+        workers,
+        max_queued=int(os.getenv('EXECUTOR_MAX_QUEUE', 100)),
+        max_queued_per_user=int(os.getenv('EXECUTOR_MAX_QUEUE_PER_USER', 5)),
+        result_ttl=int(os.getenv('EXECUTOR_RESULT_TTL', 300))
+    )
+    scheduler.start()
+    QUEUED.set_function(lambda: scheduler.stats()['queued'])
+    return scheduler
+
+scheduler = create_scheduler()
 
 @app.route('/health')
 def health():
     return jsonify({'status': 'ok'})
 
-@app.route('/execute', methods=['POST'])
-def execute_code():
-    data = request.json
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/cache-stats')
+def cache_stats():
+    if result_cache is None:
+        return jsonify({'enabled': False})
+    try:
+        return jsonify(dict(result_cache.stats(), enabled=True))
+    except redis.RedisError as e:
+        logger.error(f"Error reading cache stats: {e}")
+        return jsonify({'error': 'Cache statistics unavailable'}), 503
+
+def parse_request(data):
+    """Return (code, language, session_id), or an error response for an invalid request."""
     code = data.get('code')
     language = data.get('language', 'python').lower()
     
     if not code:
-        return jsonify({'success': False, 'stderr': 'No code provided'}), 400
+        return None, (jsonify({'success': False, 'stderr': 'No code provided'}), 400)
     
     if language not in ['python', 'r']:
-        return jsonify({'success': False, 'stderr': f'Unsupported language: {language}'}), 400
+        return None, (jsonify({'success': False, 'stderr': f'Unsupported language: {language}'}), 400)
     
+    session_id = data.get('session_id') if session_manager is not None else None
+    return (code, language, session_id), None
+
+def lookup_result(code, language, session_id):
+    """Return (cache key, cached result) for a request; either may be None."""
+    # Outside a session, deterministic code gives the same result every time
+    if result_cache is None or session_id:
+        return None, None
+    cache_key = result_cache.key(code, language, SANDBOX_IMAGES[language])
+    if not cache_key:
+        return None, None
+    cached = result_cache.get(cache_key)
+    RESULT_CACHE_LOOKUPS.labels('hit' if cached else 'miss').inc()
+    if cached:
+        EXECUTIONS.labels(language, 'cached').inc()
+        return cache_key, dict(cached, cached=True)
+    return cache_key, None
+
+def run_execution(code, language, session_id, cache_key, on_output=None):
+    """Execute code and return its result; runs on a scheduler worker.
+    
+    Output is passed to on_output(stream, text) as it is written.
+    """
+    started = time.monotonic()
+    collector = OutputCollector(OUTPUT_MAX_BYTES, ARTIFACT_MAX_COUNT, ARTIFACT_MAX_BYTES, on_output=on_output)
     try:
         # Execute code in appropriate container
-        if language == 'python':
-            result = execute_python(code)
-        else:  # R
-            result = execute_r(code)
+        with RUNNING.track_inprogress():
+            if session_id:
+                result = execute_in_session(session_id, language, code, collector)
+            elif language in sandbox_pools:
+                result = execute_pooled(language, code, collector)
+            elif language == 'python':
+                result = execute_python(code, collector)
+            else:  # R
+                result = execute_r(code, collector)
         
-        return jsonify(result)
+        EXECUTIONS.labels(language, 'success' if result['success'] else 'error').inc()
+        EXECUTION_SECONDS.labels(language).observe(time.monotonic() - started)
+        if cache_key:
+            result_cache.put(cache_key, result)
+        return result
     
     except Exception as e:
         logger.error(f"Error executing {language} code: {e}")
-        return jsonify({
-            'success': False,
-            'stdout': '',
-            'stderr': f"Error: {str(e)}"
-        })
+        EXECUTIONS.labels(language, 'failed').inc()
+        EXECUTION_SECONDS.labels(language).observe(time.monotonic() - started)
+        # Keep what the code printed before it failed
+        result = collector.result(1)
+        if result['stderr'] and not result['stderr'].endswith('\n'):
+            result['stderr'] += '\n'
+        result['stderr'] += f"Error: {str(e)}"
+        return result
 
-def execute_python(code):
+def submit_execution(data):
+    """Queue a request; return (job, cached result, error response)."""
+    request_args, error = parse_request(data)
+    if error:
+        return None, None, error
+    code, language, session_id = request_args
+    
+    cache_key, cached = lookup_result(code, language, session_id)
+    if cached:
+        return None, cached, None
+    
+    try:
+        job = scheduler.submit(str(data.get('user') or request.remote_addr),
+                               lambda job: run_execution(code, language, session_id, cache_key, job.write))
+    except QueueFull as e:
+        REJECTED.inc()
+        response = jsonify({'success': False, 'stdout': '', 'stderr': f"Error: {e}. Please try again shortly.",
+                            'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return None, None, (response, 429)
+    return job, None, None
+
+def job_status(job):
+    """Return the JSON description of a job."""
+    status = {'job_id': job.id, 'status': job.status}
+    if job.status == 'queued':
+        status['position'] = scheduler.position(job)
+    elif job.status == 'done':
+        status['result'] = job.result
+    return status
+
+@app.route('/execute', methods=['POST'])
+def execute_code():
+    """Run code and wait for the result."""
+    job, cached, error = submit_execution(request.json)
+    if error:
+        return error
+    if cached:
+        return jsonify(cached)
+    job.done.wait()
+    return jsonify(job.result)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue code to run and return the job to poll, or the cached result."""
+    job, cached, error = submit_execution(request.json)
+    if error:
+        return error
+    if cached:
+        return jsonify({'status': 'done', 'result': cached})
+    return jsonify(job_status(job)), 202
+
+def find_job(job_id):
+    """Return a job by ID, or None if it is unknown, expired or another user's.
+    
+    The user is identified as on submission: by the `user` query
+    parameter, or else by the client address.
+    """
+    job = scheduler.get(job_id)
+    if job is None or str(request.args.get('user') or request.remote_addr) != job.user:
+        return None
+    return job
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Return the status of a job, with its result once it is done."""
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """Stream a job as JSON lines: its status, then its output as it is written, then its result.
+    
+    Status lines ({job_id, status, position}) are sent when the status or
+    queue position changes, and every few seconds to keep the connection
+    alive. Output lines are {stream, text}; the last line is
+    {status: done, result}.
+    """
+    job = find_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    
+    def events():
+        offset = 0
+        reported, reported_at = None, 0.0
+        while True:
+            status = job_status(job)
+            if status['status'] != 'done' and (status != reported or time.monotonic() - reported_at >= 10):
+                yield json.dumps(status) + '\n'
+                reported, reported_at = status, time.monotonic()
+            output, finished = job.wait(offset, timeout=1.0)
+            for stream, text in output:
+                yield json.dumps({'stream': stream, 'text': text}) + '\n'
+            offset += len(output)
+            if finished:
+                yield json.dumps({'status': 'done', 'result': job.result}) + '\n'
+                return
+    
+    return Response(events(), mimetype='application/x-ndjson')
+
+def execute_in_session(session_id, language, code, collector):
+    """Execute code in the interpreter session of a conversation."""
+    started = time.monotonic()
+    exit_code, timed_out = session_manager.run(session_id, language, code, MAX_EXECUTION_TIME, collector)
+    STAGE_SECONDS.labels(language, 'session').observe(time.monotonic() - started)
+    if timed_out:
+        raise Exception(f"Execution timed out after {MAX_EXECUTION_TIME} seconds; the session was restarted")
+    
+    return collector.result(exit_code)
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def end_session(session_id):
+    if session_manager is not None:
+        for language in session_manager.languages:
+            session_manager.end(session_id, language)
+    return jsonify({'success': True})
+
+def execute_pooled(language, code, collector):
+    """Execute code in a sandbox from the pool."""
+    pool = sandbox_pools[language]
+    started = time.monotonic()
+    with pool.worker() as worker:
+        STAGE_SECONDS.labels(language, 'start').observe(time.monotonic() - started)
+        started = time.monotonic()
+        exit_code, timed_out = worker.run(pool.filename, code, pool.command, MAX_EXECUTION_TIME, collector, pool.files)
+        STAGE_SECONDS.labels(language, 'run').observe(time.monotonic() - started)
+        if timed_out:
+            raise Exception(f"Execution timed out or failed: no result after {MAX_EXECUTION_TIME} seconds")
+        collector.add_artifacts(worker.container)
+    
+    return collector.result(exit_code)
+
+def read_logs(container, collector):
+    """Pass a finished container's stdout and stderr to collector, up to what it takes."""
+    for stream in ('stdout', 'stderr'):
+        for chunk in container.logs(stdout=stream == 'stdout', stderr=stream == 'stderr', stream=True):
+            if not collector.write(stream, chunk):
+                return
+
+def execute_python(code, collector):
     """Execute Python code in a secure container."""
     # Create a unique container name
     container_name = f"python-exec-{uuid.uuid4().hex[:8]}"
@@ -74,8 +422,9 @@ def execute_python(code):
             code_file = f.name
         
         # Run in container with appropriate libraries
+        started = time.monotonic()
         container = docker_client.containers.run(
-            "python:3.11-slim",
+            SANDBOX_IMAGES['python'],
             command=f"python {os.path.basename(code_file)}",
             volumes={os.path.dirname(code_file): {'bind': '/code', 'mode': 'ro'}},
             working_dir="/code",
@@ -88,17 +437,18 @@ def execute_python(code):
                 "PYTHONPATH": "/code"
             }
         )
+        STAGE_SECONDS.labels('python', 'start').observe(time.monotonic() - started)
         
         # Wait for execution to complete with timeout
         try:
+            started = time.monotonic()
             result = container.wait(timeout=MAX_EXECUTION_TIME)
-            logs = container.logs().decode('utf-8')
+            STAGE_SECONDS.labels('python', 'run').observe(time.monotonic() - started)
+            started = time.monotonic()
+            read_logs(container, collector)
+            STAGE_SECONDS.labels('python', 'logs').observe(time.monotonic() - started)
             
-            return {
-                'success': result['StatusCode'] == 0,
-                'stdout': logs if result['StatusCode'] == 0 else '',
-                'stderr': '' if result['StatusCode'] == 0 else logs
-            }
+            return collector.result(result['StatusCode'])
         except Exception as e:
             # Kill container if it's still running
             try:
@@ -120,7 +470,7 @@ def execute_python(code):
         except:
             pass
 
-def execute_r(code):
+def execute_r(code, collector):
     """Execute R code in a secure container."""
     # Create a unique container name
     container_name = f"r-exec-{uuid.uuid4().hex[:8]}"
@@ -132,8 +482,9 @@ def execute_r(code):
             code_file = f.name
         
         # Run in container with appropriate libraries
+        started = time.monotonic()
         container = docker_client.containers.run(
-            "rocker/tidyverse:latest",  # Includes common R packages for data analysis
+            SANDBOX_IMAGES['r'],
             command=f"Rscript {os.path.basename(code_file)}",
             volumes={os.path.dirname(code_file): {'bind': '/code', 'mode': 'ro'}},
             working_dir="/code",
@@ -143,17 +494,18 @@ def execute_r(code):
             mem_limit=MAX_MEMORY,
             network_mode="none",  # No network access
         )
+        STAGE_SECONDS.labels('r', 'start').observe(time.monotonic() - started)
         
         # Wait for execution to complete with timeout
         try:
+            started = time.monotonic()
             result = container.wait(timeout=MAX_EXECUTION_TIME)
-            logs = container.logs().decode('utf-8')
+            STAGE_SECONDS.labels('r', 'run').observe(time.monotonic() - started)
+            started = time.monotonic()
+            read_logs(container, collector)
+            STAGE_SECONDS.labels('r', 'logs').observe(time.monotonic() - started)
             
-            return {
-                'success': result['StatusCode'] == 0,
-                'stdout': logs if result['StatusCode'] == 0 else '',
-                'stderr': '' if result['StatusCode'] == 0 else logs
-            }
+            return collector.result(result['StatusCode'])
         except Exception as e:
             # Kill container if it's still running
             try:
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Python Session Kernel
+---------------------
+Runs inside a session sandbox. Preloads the configured modules, then runs
+the snippets the code executor writes to /code one after the other in the
+same namespace, so variables and imports carry over between runs. A
+snippet prints to the kernel's own stdout and stderr, which the executor
+reads; once it is done, each stream gets a marker line carrying
+SESSION_TOKEN and, on stdout, its exit status. Matplotlib figures it
+leaves open are saved to /out, the working directory, as images.
+"""
+
+import os
+import sys
+import time
+import warnings
+import traceback
+
+CODE_DIR = "/code"
+OUT_DIR = "/out"
+DATA_DIR = "/data"
+TOKEN = os.getenv("SESSION_TOKEN", "")
+
+namespace = {"__name__": "__main__"}
+
+# plt.show() has nothing to show on without a display; the figures are returned instead
+warnings.filterwarnings("ignore", message=".*non-interactive.*")
+
+def preload():
+    """Import the modules in SESSION_PYTHON_MODULES and run /data/preload.py."""
+    for module in filter(None, os.getenv("SESSION_PYTHON_MODULES", "").split(",")):
+        try:
+            __import__(module.strip())
+        except ImportError:
+            print(f"Module {module} is not installed", file=sys.stderr)
+    script = os.path.join(DATA_DIR, "preload.py")
+    if os.path.exists(script):
+        with open(script, "r") as f:
+            exec(compile(f.read(), script, "exec"), namespace)
+
+def signal(stream, text):
+    """Write a marker line for the executor, after the output before it."""
+    stream.write(f"\x1e{TOKEN}:{text}\n")
+    stream.flush()
+
+def save_figures(seq):
+    """Save the open matplotlib figures to /out and close them."""
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is None:
+        return
+    for number in pyplot.get_fignums():
+        pyplot.figure(number).savefig(os.path.join(OUT_DIR, f"{seq}-figure-{number}.png"), dpi=100)
+    pyplot.close("all")
+
+def run(source):
+    """Run one snippet; return its exit status."""
+    try:
+        exec(compile(source, "main.py", "exec"), namespace)
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        # Leave this kernel's own frame out of the traceback
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        return 1
+    finally:
+        # In case the snippet replaced them
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+def main():
+    preload()
+    os.chdir(OUT_DIR)
+    signal(sys.stdout, "ready")
+
+    seq = 0
+    while True:
+        path = os.path.join(CODE_DIR, f"snippet-{seq}.py")
+        if not os.path.exists(path):
+            time.sleep(0.02)
+            continue
+        with open(path, "r") as f:
+            source = f.read()
+        status = run(source)
+        try:
+            save_figures(seq)
+        except Exception as e:
+            print(f"Could not save the figures: {e}", file=sys.stderr)
+        signal(sys.stderr, f"done:{seq}")
+        signal(sys.stdout, f"done:{seq}:{status}")
+        seq += 1
+
+if __name__ == "__main__":
+    main()
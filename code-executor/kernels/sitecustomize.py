@@ -0,0 +1,27 @@
+"""
+Python Sandbox Start-up
+-----------------------
+Imported by Python on start-up in a pooled sandbox. When the code exits,
+the matplotlib figures it left open are saved to /out, from where the
+code executor returns them as images.
+"""
+
+import os
+import sys
+import atexit
+import warnings
+
+OUT_DIR = "/out"
+
+# plt.show() has nothing to show on without a display; the figures are returned instead
+warnings.filterwarnings("ignore", message=".*non-interactive.*")
+
+def save_figures():
+    """Save the open matplotlib figures to /out."""
+    pyplot = sys.modules.get("matplotlib.pyplot")
+    if pyplot is None:
+        return
+    for number in pyplot.get_fignums():
+        pyplot.figure(number).savefig(os.path.join(OUT_DIR, f"figure-{number}.png"), dpi=100)
+
+atexit.register(save_figures)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Execution Output for the Code Executor
+--------------------------------------
+Collects the output of a run as it arrives, keeping stdout and stderr
+apart, capping its size, and picking up the images it saved.
+"""
+
+import io
+import os
+import base64
+import codecs
+import tarfile
+
+ARTIFACT_TYPES = {
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+    ".svg": "image/svg+xml"
+}
+
+class ArchiveStream(io.RawIOBase):
+    """A readable file over the chunks of a tar archive from the Docker API."""
+
+    def __init__(self, chunks):
+        """Wrap an iterator of bytes."""
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        """Fill b from the next chunks; return the number of bytes read, 0 at the end."""
+        while not self.buffer:
+            self.buffer = next(self.chunks, None)
+            if self.buffer is None:
+                self.buffer = b""
+                return 0
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+class OutputCollector:
+    """The output of one run, split into stdout and stderr.
+
+    Output beyond max_bytes (both streams together) is dropped, and a
+    marker saying so is appended. Each piece of text kept is also passed
+    to on_output(stream, text) as it arrives, so that it can be streamed
+    to the user before the run finishes. Images the run saved are
+    returned base64-encoded, up to max_artifacts of them and only those
+    under max_artifact_bytes.
+    """
+
+    def __init__(self, max_bytes=128 * 1024, max_artifacts=10, max_artifact_bytes=512 * 1024, on_output=None):
+        """Initialize an empty collector."""
+        self.max_bytes = max_bytes
+        self.max_artifacts = max_artifacts
+        self.max_artifact_bytes = max_artifact_bytes
+        self.on_output = on_output
+        self.size = 0
+        self.truncated = False
+        self.parts = {"stdout": [], "stderr": []}
+        # Chunks may split a multi-byte character
+        self.decoders = {stream: codecs.getincrementaldecoder("utf-8")(errors="replace") for stream in self.parts}
+        self.artifacts = []
+
+    def write(self, stream, data):
+        """Add bytes written to stream; return False once output is being dropped."""
+        if self.truncated:
+            return False
+        room = self.max_bytes - self.size
+        if len(data) > room:
+            data = data[:room]
+            self.truncated = True
+        self.size += len(data)
+        self._append(stream, self.decoders[stream].decode(data, final=self.truncated))
+        if self.truncated:
+            self._append(stream, f"\n[Output truncated: more than {self.max_bytes // 1024} KB]\n")
+        return not self.truncated
+
+    def note(self, stream, text):
+        """Add a message about the run to stream, regardless of max_bytes."""
+        self._append(stream, text)
+
+    def add_artifacts(self, container, directory="/out"):
+        """Pick up the images saved in a container's directory, in name order.
+
+        The directory is read through the Docker API, since it is a tmpfs
+        inside the container. Returns the names of all the images found,
+        returned or not.
+        """
+        chunks, _ = container.get_archive(directory)
+        found = []
+        with tarfile.open(fileobj=ArchiveStream(chunks), mode="r|") as archive:
+            for member in archive:
+                parts = member.name.split("/")
+                # The directory is written by the sandbox: only regular files directly in it
+                if len(parts) != 2 or not member.isreg():
+                    continue
+                mime_type = ARTIFACT_TYPES.get(os.path.splitext(parts[1])[1].lower())
+                if mime_type is None:
+                    continue
+                data = archive.extractfile(member).read() if member.size <= self.max_artifact_bytes else None
+                found.append((parts[1], mime_type, data))
+
+        for name, mime_type, data in sorted(found, key=lambda artifact: artifact[0]):
+            if len(self.artifacts) >= self.max_artifacts:
+                self._append("stderr", f"\n[{name} not returned: only {self.max_artifacts} images are returned]\n")
+                continue
+            if data is None:
+                self._append("stderr", f"\n[{name} not returned: larger than {self.max_artifact_bytes // 1024} KB]\n")
+                continue
+            self.artifacts.append({
+                "name": name,
+                "mime_type": mime_type,
+                "data": base64.b64encode(data).decode("ascii")
+            })
+        return [name for name, _, _ in found]
+
+    def result(self, exit_code):
+        """Return the result of a run that exited with exit_code."""
+        for stream, decoder in self.decoders.items():
+            self._append(stream, decoder.decode(b"", final=True))
+        return {
+            'success': exit_code == 0,
+            'stdout': "".join(self.parts["stdout"]),
+            'stderr': "".join(self.parts["stderr"]),
+            'truncated': self.truncated,
+            'artifacts': self.artifacts
+        }
+
+    def _append(self, stream, text):
+        """Keep text and pass it on."""
+        if not text:
+            return
+        self.parts[stream].append(text)
+        if self.on_output is not None:
+            self.on_output(stream, text)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Execution Cache Pre-warming
+---------------------------
+Runs every code block extracted from the book once through the code
+executor, so that their results are in the result cache before users run
+them. Blocks that are not deterministic are skipped; blocks already cached
+are served from the cache and cost nothing.
+
+Run it after ingestion, inside the code-executor container:
+    docker-compose exec code-executor python prewarm.py
+"""
+
+import os
+import json
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from result_cache import is_deterministic
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def load_code_blocks(chunks_file):
+    """Return the distinct (language, code) pairs in the chunks written by the pdf-processor."""
+    blocks = {}
+    with open(chunks_file, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for block in json.loads(line).get("code_blocks", []):
+                language = block.get("language", "").lower()
+                if language in ("python", "r") and block.get("code", "").strip():
+                    blocks[(language, block["code"])] = None
+    return list(blocks)
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed the execution result cache with the book's code blocks")
+    parser.add_argument("--chunks", default=os.getenv('CHUNKS_FILE', '/data/output/chunks.jsonl'),
+                        help="chunks.jsonl written by the pdf-processor")
+    parser.add_argument("--executor", default=os.getenv('CODE_EXECUTOR_URL', 'http://localhost:5000'),
+                        help="URL of the code executor")
+    parser.add_argument("--workers", type=int, default=2, help="Code blocks run at the same time")
+    parser.add_argument("--timeout", type=int, default=120, help="Seconds to wait for one code block")
+    args = parser.parse_args()
+
+    blocks = load_code_blocks(args.chunks)
+    runnable = [(language, code) for language, code in blocks if is_deterministic(code, language)]
+    logger.info(f"Found {len(blocks)} code blocks, {len(runnable)} deterministic")
+
+    session = requests.Session()
+    counts = {"cached": 0, "ran": 0, "error": 0, "failed": 0}
+
+    def run(block):
+        language, code = block
+        try:
+            response = session.post(f"{args.executor.rstrip('/')}/execute",
+                                    json={"code": code, "language": language}, timeout=args.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Could not run a {language} block: {e}")
+            return "failed"
+        if result.get("cached"):
+            return "cached"
+        return "ran" if result.get("success") else "error"
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for i, outcome in enumerate(pool.map(run, runnable), start=1):
+            counts[outcome] += 1
+            if i % 25 == 0:
+                logger.info(f"{i}/{len(runnable)} code blocks done")
+
+    logger.info(f"Pre-warming finished: {counts['ran']} ran, {counts['error']} exited with an error, "
+                f"{counts['cached']} were already cached, {counts['failed']} could not be run")
+
+if __name__ == "__main__":
+    main()
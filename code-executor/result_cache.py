@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Execution Result Cache for the Code Executor
+--------------------------------------------
+Serves the output of deterministic code from Redis, so that the book's
+examples, which many users run unchanged, do not need a sandbox each time.
+"""
+
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import redis
+import docker
+
+logger = logging.getLogger(__name__)
+
+ENTRY_PREFIX = "execution:entry:"
+LRU_KEY = "execution:lru"
+SIZES_KEY = "execution:sizes"
+STATS_KEY = "execution:stats"
+
+# Code whose output changes from run to run: unseeded random numbers,
+# clocks and input
+RANDOM_PATTERNS = {
+    "python": re.compile(r"\b(random|secrets|uuid)\b|default_rng\(\s*\)"),
+    "r": re.compile(r"\b(r(norm|unif|binom|pois|exp|t|chisq|gamma|beta|cauchy|logis|lnorm|weibull|multinom|geom|"
+                    r"hyper|nbinom|std|sstd|ged|sged)|sample|simulate|arima\.sim|garchSim|ugarchsim|ugarchpath)\s*\(")
+}
+SEED_PATTERNS = {
+    "python": re.compile(r"\.seed\(\s*\d|default_rng\(\s*\d|RandomState\(\s*\d"),
+    "r": re.compile(r"\bset\.seed\(\s*\d")
+}
+CLOCK_PATTERNS = {
+    "python": re.compile(r"\btime\.(time|perf_counter|monotonic)\(|\b(now|today|utcnow)\(\)|\burandom\(|\binput\("),
+    "r": re.compile(r"\b(Sys\.time|Sys\.Date|date|proc\.time|readline)\(\)")
+}
+
+def is_deterministic(code, language):
+    """Guess whether code prints the same output on every run.
+
+    Code that reads a clock or input, or draws random numbers without
+    setting a seed, is not cached.
+    """
+    if CLOCK_PATTERNS[language].search(code):
+        return False
+    return not RANDOM_PATTERNS[language].search(code) or bool(SEED_PATTERNS[language].search(code))
+
+class ResultCache:
+    """Results of code executions, keyed by code, language and sandbox image.
+
+    The key includes the image ID (a digest of the image), so results are
+    not served across image updates, which may change package versions.
+    Entries are evicted least recently used first once they take up more
+    than max_bytes; results larger than max_entry_bytes are not cached.
+    """
+
+    def __init__(self, redis_client, docker_client, max_bytes=64 * 1024 * 1024, max_entry_bytes=256 * 1024,
+                 digest_ttl=60):
+        """Initialize the cache."""
+        self.redis_client = redis_client
+        self.docker_client = docker_client
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.digest_ttl = digest_ttl
+        self.lock = threading.Lock()
+        self.digests = {}
+
+    def image_digest(self, image):
+        """Return the ID of a local image, re-read at most every digest_ttl seconds."""
+        with self.lock:
+            digest, checked_at = self.digests.get(image, (None, 0.0))
+            if time.monotonic() - checked_at < self.digest_ttl:
+                return digest
+        try:
+            digest = self.docker_client.images.get(image).id
+        except docker.errors.ImageNotFound:
+            digest = None
+        except docker.errors.APIError as e:
+            logger.error(f"Could not read the digest of {image}: {e}")
+            digest = None
+        with self.lock:
+            self.digests[image] = (digest, time.monotonic())
+        return digest
+
+    def key(self, code, language, image):
+        """Return the cache key for code, or None if it cannot be cached."""
+        if not is_deterministic(code, language):
+            return None
+        digest = self.image_digest(image)
+        if digest is None:
+            return None
+        return hashlib.sha256(f"{language}\0{digest}\0{code}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached result for a key, or None."""
+        try:
+            data = self.redis_client.get(ENTRY_PREFIX + key)
+            if data is None:
+                self.redis_client.hincrby(STATS_KEY, "misses", 1)
+                return None
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.zadd(LRU_KEY, {key: time.time()})
+            pipe.hincrby(STATS_KEY, "hits", 1)
+            pipe.execute()
+            return json.loads(data)
+        except redis.RedisError as e:
+            logger.error(f"Error reading execution cache: {e}")
+            return None
+
+    def put(self, key, result):
+        """Cache a result, evicting the least recently used ones beyond max_bytes."""
+        data = json.dumps(result)
+        if len(data) > self.max_entry_bytes:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.set(ENTRY_PREFIX + key, data)
+            pipe.zadd(LRU_KEY, {key: time.time()})
+            pipe.hset(SIZES_KEY, key, len(data))
+            pipe.execute()
+            self._evict()
+        except redis.RedisError as e:
+            logger.error(f"Error writing execution cache: {e}")
+
+    def stats(self):
+        """Return the hit and miss counters, and the cache size."""
+        counters = {"hits": 0, "misses": 0}
+        counters.update({name: int(value) for name, value in self.redis_client.hgetall(STATS_KEY).items()})
+        counters["entries"] = self.redis_client.zcard(LRU_KEY)
+        counters["bytes"] = sum(int(size) for size in self.redis_client.hvals(SIZES_KEY))
+        return counters
+
+    def _evict(self):
+        """Evict the least recently used results while the cache is over max_bytes."""
+        total = sum(int(size) for size in self.redis_client.hvals(SIZES_KEY))
+        while total > self.max_bytes:
+            evicted = [key for key, _ in self.redis_client.zpopmin(LRU_KEY, 16)]
+            if not evicted:
+                break
+            sizes = self.redis_client.hmget(SIZES_KEY, evicted)
+            total -= sum(int(size or 0) for size in sizes)
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(*[ENTRY_PREFIX + key for key in evicted])
+            pipe.hdel(SIZES_KEY, *evicted)
+            pipe.execute()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Sandbox Pool for the Code Executor
+----------------------------------
+Keeps sandbox containers started ahead of time, so that running a code
+example does not wait for a container (and an R or Python runtime) to
+start.
+"""
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import docker
+
+logger = logging.getLogger(__name__)
+
+POOL_LABEL = "cerebras-rag.sandbox"
+
+class PoolExhausted(Exception):
+    """Raised when no sandbox became free in time."""
+
+class SandboxWorker:
+    """A started sandbox container and its directory.
+
+    The directory's code subdirectory is mounted read-only as the
+    sandbox's /code. Its working directory, /out, is a size-limited tmpfs
+    inside the container, so the code cannot fill the host's disk; the
+    images it saves there are read back through the Docker API.
+    """
+
+    def __init__(self, container, directory):
+        """Wrap a started container."""
+        self.container = container
+        self.directory = directory
+        self.jobs = 0
+        self.broken = False
+        self.idle_since = time.monotonic()
+
+    @property
+    def code_dir(self):
+        return os.path.join(self.directory, "code")
+
+    def run(self, filename, code, command, timeout, collector, files=()):
+        """Run code in the sandbox, passing its output to collector; return (exit code, timed out).
+
+        The code and files are written to the code directory, then
+        command runs inside the container under coreutils' timeout, which
+        kills it after timeout seconds. Output is read as it is written;
+        once collector stops taking it, the sandbox is killed.
+        """
+        for name in os.listdir(self.code_dir):
+            path = os.path.join(self.code_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        for source in files:
+            shutil.copy(source, os.path.join(self.code_dir, os.path.basename(source)))
+        path = os.path.join(self.code_dir, filename)
+        with open(path, "w") as f:
+            f.write(code)
+        os.chmod(path, 0o644)
+
+        api = self.container.client.api
+        if self.jobs:
+            # Clear what the previous job left in the working directory
+            api.exec_start(api.exec_create(self.container.id, ["find", "/out", "-mindepth", "1", "-delete"])["Id"])
+        self.jobs += 1
+        started = time.monotonic()
+        exec_id = api.exec_create(
+            self.container.id,
+            ["timeout", "-s", "KILL", str(timeout)] + command + [f"/code/{filename}"],
+            workdir="/out"
+        )["Id"]
+        for stdout, stderr in api.exec_start(exec_id, stream=True, demux=True):
+            if (stdout and not collector.write("stdout", stdout)) or (stderr and not collector.write("stderr", stderr)):
+                # Stop code that keeps printing; the sandbox is replaced
+                self.broken = True
+                try:
+                    self.container.kill()
+                except docker.errors.APIError:
+                    pass
+                return -1, False
+        exit_code = api.exec_inspect(exec_id)["ExitCode"]
+        # With KILL, timeout also kills itself, so the exit code does not tell
+        timed_out = exit_code != 0 and time.monotonic() - started >= timeout
+        return exit_code, timed_out
+
+class SandboxPool:
+    """Started sandboxes for one language.
+
+    A background thread keeps `size` idle sandboxes ready, never running
+    more than max_size at once; idle sandboxes beyond `size` are stopped
+    after idle_timeout seconds. A sandbox is retired after max_jobs jobs
+    (by default after every job, so that no state carries over from one
+    user's code to the next), or after a job that timed out or broke the
+    sandbox, and a fresh one is started in its place. Sandboxes have the same
+    isolation as one-off containers: no network, a memory limit and the
+    code mounted read-only. Their working directory is a tmpfs of at most
+    workdir_size, which counts towards mem_limit. `files` are copied next
+    to the code for every run.
+    """
+
+    def __init__(self, docker_client, language, image, command, filename, size=2, max_size=8,
+                 idle_timeout=600, max_jobs=1, mem_limit="512m", workdir_size="64m", environment=None, files=()):
+        """Initialize the pool; call start() to begin filling it."""
+        self.docker_client = docker_client
+        self.language = language
+        self.image = image
+        self.command = command
+        self.filename = filename
+        self.size = size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_jobs = max_jobs
+        self.mem_limit = mem_limit
+        self.workdir_size = workdir_size
+        self.environment = environment or {}
+        self.files = list(files)
+
+        self.lock = threading.Condition()
+        self.idle = deque()
+        self.busy = 0
+        self.starting = 0
+        self.retiring = deque()
+        self.wakeup = threading.Event()
+
+    def start(self):
+        """Remove sandboxes left over from a previous run and start filling the pool."""
+        for container in self.docker_client.containers.list(
+                all=True, filters={"label": f"{POOL_LABEL}={self.language}"}):
+            try:
+                container.remove(force=True)
+            except docker.errors.APIError:
+                pass
+        self.wakeup.set()
+        threading.Thread(target=self._maintain, name=f"sandbox-pool-{self.language}", daemon=True).start()
+
+    @contextmanager
+    def worker(self, wait=30):
+        """Check out a sandbox for the duration of the with-block.
+
+        Takes an idle sandbox, or starts one if the pool has room, or
+        waits up to `wait` seconds for one to be returned. If the block
+        raises, the sandbox is retired.
+        """
+        worker = self._acquire(wait)
+        healthy = False
+        try:
+            yield worker
+            healthy = True
+        finally:
+            self._release(worker, healthy)
+
+    def stats(self):
+        """Return the number of idle, busy and starting sandboxes."""
+        with self.lock:
+            return {"idle": len(self.idle), "busy": self.busy, "starting": self.starting}
+
+    def _acquire(self, wait):
+        """Take an idle sandbox, start one, or wait for one."""
+        deadline = time.monotonic() + wait
+        with self.lock:
+            while True:
+                if self.idle:
+                    worker = self.idle.pop()
+                    self.busy += 1
+                    self.wakeup.set()  # Top the pool back up
+                    return worker
+                if self.busy + self.starting < self.max_size:
+                    self.starting += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(f"All {self.max_size} {self.language} sandboxes are busy")
+                self.lock.wait(remaining)
+
+        # No warm sandbox: start one for this request
+        logger.info(f"No idle {self.language} sandbox, starting one")
+        try:
+            worker = self._create()
+        except Exception:
+            with self.lock:
+                self.starting -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.starting -= 1
+            self.busy += 1
+        return worker
+
+    def _release(self, worker, healthy):
+        """Return a sandbox to the pool, or retire it."""
+        with self.lock:
+            self.busy -= 1
+            if healthy and not worker.broken and worker.jobs < self.max_jobs:
+                worker.idle_since = time.monotonic()
+                self.idle.append(worker)
+            else:
+                self.retiring.append(worker)
+            self.lock.notify()
+        self.wakeup.set()
+
+    def _create(self):
+        """Start a sandbox container."""
+        directory = tempfile.mkdtemp(prefix=f"sandbox-{self.language}-")
+        os.makedirs(os.path.join(directory, "code"))
+        os.chmod(directory, 0o755)
+        os.chmod(os.path.join(directory, "code"), 0o755)
+        try:
+            container = self.docker_client.containers.run(
+                self.image,
+                command=["sleep", "infinity"],
+                volumes={os.path.join(directory, "code"): {'bind': '/code', 'mode': 'ro'}},
+                tmpfs={'/out': f'size={self.workdir_size}'},
+                working_dir="/out",
+                detach=True,
+                auto_remove=True,
+                labels={POOL_LABEL: self.language},
+                mem_limit=self.mem_limit,
+                network_mode="none",  # No network access
+                environment=self.environment
+            )
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return SandboxWorker(container, directory)
+
+    def _destroy(self, worker):
+        """Remove a sandbox container and its directory."""
+        try:
+            worker.container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+        shutil.rmtree(worker.directory, ignore_errors=True)
+
+    def _maintain(self):
+        """Retire used sandboxes, stop surplus idle ones and start replacements."""
+        while True:
+            self.wakeup.wait(5)
+            self.wakeup.clear()
+
+            expired = []
+            with self.lock:
+                while self.retiring:
+                    expired.append(self.retiring.popleft())
+                now = time.monotonic()
+                while len(self.idle) > self.size and now - self.idle[0].idle_since > self.idle_timeout:
+                    expired.append(self.idle.popleft())
+                missing = min(self.size - len(self.idle) - self.starting,
+                              self.max_size - len(self.idle) - self.busy - self.starting)
+                missing = max(0, missing)
+                self.starting += missing
+            for worker in expired:
+                self._destroy(worker)
+
+            for _ in range(missing):
+                try:
+                    worker = self._create()
+                except Exception as e:
+                    logger.error(f"Could not start a {self.language} sandbox: {e}")
+                    with self.lock:
+                        self.starting -= 1
+                    continue
+                with self.lock:
+                    self.starting -= 1
+                    self.idle.append(worker)
+                    self.lock.notify()
+
+    def close(self):
+        """Remove all idle sandboxes."""
+        with self.lock:
+            workers = list(self.idle) + list(self.retiring)
+            self.idle.clear()
+            self.retiring.clear()
+        for worker in workers:
+            self._destroy(worker)
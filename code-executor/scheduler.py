@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Job Scheduler for the Code Executor
+-----------------------------------
+Runs code executions on a fixed number of workers, takes turns between
+users, and turns work away once the queue is full.
+"""
+
+import os
+import re
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+MEMORY_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_memory(value):
+    """Convert a Docker memory limit such as "512m" to bytes."""
+    match = re.fullmatch(r"(\d+)([bkmg]?)", value.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid memory limit: {value}")
+    return int(match.group(1)) * MEMORY_UNITS[match.group(2)]
+
+def default_workers(memory_per_job, reserved=0, reserve=0.25):
+    """Return how many jobs the host can run at once.
+
+    One per CPU, but no more than fit in the host's memory after keeping
+    `reserve` of it free for everything else and setting aside `reserved`
+    bytes for containers that are not jobs (idle sandboxes, sessions).
+    """
+    cpus = os.cpu_count() or 1
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return cpus
+    budget = int(total * (1 - reserve)) - reserved
+    if budget < memory_per_job:
+        logger.warning("Sandboxes and sessions may use more than the host's memory; running one job at a time")
+    return max(1, min(cpus, budget // memory_per_job))
+
+class Job:
+    """A submitted execution, with the output it has written so far."""
+
+    def __init__(self, user, function):
+        """Initialize a queued job that will call function(job)."""
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.function = function
+        self.status = "queued"
+        self.result = None
+        self.output = []  # (stream, text) pieces, in order
+        self.changed = threading.Condition()
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+        self.done = threading.Event()
+
+    def write(self, stream, text):
+        """Add a piece of output."""
+        with self.changed:
+            self.output.append((stream, text))
+            self.changed.notify_all()
+
+    def wait(self, offset, timeout):
+        """Wait up to timeout seconds for output past offset or for the job to finish.
+
+        Returns the output past offset and whether the job has finished,
+        in which case that is all of its output.
+        """
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.output) > offset or self.done.is_set(), timeout)
+            return self.output[offset:], self.done.is_set()
+
+    def finish(self):
+        """Wake up whoever is waiting for the result."""
+        with self.changed:
+            self.done.set()
+            self.changed.notify_all()
+
+class Scheduler:
+    """A bounded queue of jobs served by `workers` threads.
+
+    Each user has their own FIFO queue, and workers take turns between
+    users, so one user submitting many jobs does not hold up the others.
+    submit() raises QueueFull when max_queued jobs are waiting in total,
+    or max_queued_per_user for that user. Finished jobs are kept for
+    result_ttl seconds so that their results can be polled.
+    """
+
+    def __init__(self, workers, max_queued=100, max_queued_per_user=5, result_ttl=300):
+        """Initialize the scheduler; call start() to start its workers."""
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.result_ttl = result_ttl
+        self.lock = threading.Condition()
+        self.queues = OrderedDict()  # user -> deque of jobs, in turn order
+        self.queued = 0
+        self.running = 0
+        self.jobs = {}
+        self.average_runtime = 5.0
+
+    def start(self):
+        """Start the worker threads."""
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"executor-worker-{i}", daemon=True).start()
+        logger.info(f"Started {self.workers} execution workers")
+
+    def submit(self, user, function):
+        """Queue function(job) to run for user and return its Job."""
+        with self.lock:
+            self._expire()
+            queue = self.queues.get(user)
+            if self.queued >= self.max_queued:
+                raise QueueFull(f"The code executor is busy ({self.queued} jobs waiting)", self._retry_after())
+            if queue is not None and len(queue) >= self.max_queued_per_user:
+                raise QueueFull(f"You already have {len(queue)} jobs waiting", self._retry_after())
+            job = Job(user, function)
+            if queue is None:
+                self.queues[user] = queue = deque()
+            queue.append(job)
+            self.queued += 1
+            self.jobs[job.id] = job
+            self.lock.notify()
+            return job
+
+    def get(self, job_id):
+        """Return a job by ID, or None if it is unknown or expired."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def position(self, job):
+        """Return the number of jobs that will start before job, or 0 if it is not queued."""
+        with self.lock:
+            if job.status != "queued":
+                return 0
+            queue = self.queues.get(job.user)
+            if queue is None or job not in queue:
+                return 0
+            # Turns alternate between users: before the job's turn comes,
+            # users ahead in the rotation get one more turn than those after
+            rounds = queue.index(job)
+            ahead = rounds
+            before = True
+            for user, other in self.queues.items():
+                if user == job.user:
+                    before = False
+                    continue
+                ahead += min(len(other), rounds + 1 if before else rounds)
+            return ahead + 1
+
+    def stats(self):
+        """Return the number of workers, running and queued jobs."""
+        with self.lock:
+            return {"workers": self.workers, "running": self.running, "queued": self.queued}
+
+    def _next(self):
+        """Take the next job, taking turns between users; call with the lock held."""
+        user, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        del self.queues[user]
+        if queue:
+            self.queues[user] = queue  # To the back of the line
+        self.queued -= 1
+        return job
+
+    def _work(self):
+        """Run jobs as they are submitted."""
+        while True:
+            with self.lock:
+                while not self.queues:
+                    self.lock.wait()
+                job = self._next()
+                job.status = "running"
+                self.running += 1
+
+            started = time.monotonic()
+            try:
+                result = job.function(job)
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {e}")
+                result = {'success': False, 'stdout': '', 'stderr': f"Error: {str(e)}"}
+
+            with self.lock:
+                self.running -= 1
+                job.result = result
+                job.status = "done"
+                job.function = None
+                job.finished_at = time.monotonic()
+                self.average_runtime = 0.9 * self.average_runtime + 0.1 * (job.finished_at - started)
+            job.finish()
+
+    def _expire(self):
+        """Forget finished jobs older than result_ttl; call with the lock held."""
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _retry_after(self):
+        """Estimate the seconds until there is room in the queue; call with the lock held."""
+        return max(1, int(self.average_runtime * (self.queued + 1) / self.workers))
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""
+Interpreter Sessions for the Code Executor
+------------------------------------------
+Keeps an R or Python interpreter alive per conversation, with the book's
+common packages preloaded, so successive snippets run in the same state
+without reloading libraries and datasets.
+"""
+
+import os
+import time
+import shutil
+import logging
+import secrets
+import tempfile
+import threading
+
+import docker
+
+logger = logging.getLogger(__name__)
+
+SESSION_LABEL = "cerebras-rag.session"
+KERNEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernels")
+MARKER_TEXT_MAX = 64  # Longest text after the token on a marker line
+
+class SessionError(Exception):
+    """Raised when a session could not be started or ended while running a snippet."""
+
+class KernelSession:
+    """A sandbox running a kernel script (kernels/kernel.py or kernels/kernel.R).
+
+    The executor writes snippet N to the session's code directory, mounted
+    read-only at /code. The kernel runs it with its output going to the
+    container's stdout and stderr, which the executor reads through an
+    attached stream, and ends each stream with a marker line carrying the
+    session's token. Images are saved to /out, the working directory, a
+    size-limited tmpfs read back through the Docker API.
+    """
+
+    def __init__(self, key, container, directory, extension, token):
+        """Wrap a created session container."""
+        self.key = key
+        self.container = container
+        self.directory = directory
+        self.extension = extension
+        self.marker = f"\x1e{token}:".encode("ascii")
+        self.seq = 0
+        self.broken = False
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        # State shared with the thread reading the kernel's output
+        self.changed = threading.Condition()
+        self.ready = False
+        self.closed = False
+        self.collector = None
+        self.finished = {}
+        self.pending = {"stdout": b"", "stderr": b""}
+
+    @property
+    def code_dir(self):
+        return os.path.join(self.directory, "code")
+
+    def attach(self, stream):
+        """Read the kernel's output from an attached (stdout, stderr) stream until the container ends."""
+        threading.Thread(target=self._read, args=(stream,), name=f"session-{self.key[1]}", daemon=True).start()
+
+    def wait_ready(self, timeout):
+        """Wait until the kernel has loaded its packages; return whether it did."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.ready or self.closed, timeout)
+            return self.ready and not self.closed
+
+    def run(self, code, timeout, collector):
+        """Run a snippet, passing its output to collector; return (exit code, timed out).
+
+        Output is passed on as the kernel prints it. Once collector stops
+        taking it, the session is marked broken, to be ended by the caller.
+        """
+        seq = self.seq
+        self.seq += 1
+        with self.changed:
+            self.collector = collector
+            self.finished = {}
+
+        path = os.path.join(self.code_dir, f"snippet-{seq}{self.extension}")
+        with open(path + ".tmp", "w") as f:
+            f.write(code)
+        os.chmod(path + ".tmp", 0o644)
+        os.rename(path + ".tmp", path)
+
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            # The snippet is done once both streams carry its marker
+            while len(self.finished) < 2 and not self.closed and not collector.truncated:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+            self.collector = None
+            finished = dict(self.finished)
+            closed = self.closed
+        os.unlink(path)
+
+        if len(finished) < 2:
+            if collector.truncated:
+                # Stop code that keeps printing
+                self.broken = True
+                collector.note("stderr", "[The session was restarted; variables from earlier runs are lost]\n")
+                return -1, False
+            if closed:
+                raise SessionError("The session ended, possibly because it ran out of memory; "
+                                   "variables from earlier runs are lost")
+            return -1, True
+
+        # What the snippet saved is collected, then its images are removed
+        images = collector.add_artifacts(self.container)
+        if images:
+            self.container.exec_run(["rm", "-f", "--"] + [f"/out/{name}" for name in images])
+        return finished["stdout"], False
+
+    def _read(self, stream):
+        """Pass the kernel's output on until the stream ends."""
+        try:
+            for stdout, stderr in stream:
+                with self.changed:
+                    if stdout:
+                        self._feed("stdout", stdout)
+                    if stderr:
+                        self._feed("stderr", stderr)
+        except Exception as e:
+            logger.debug(f"Session output stream failed: {e}")
+        finally:
+            with self.changed:
+                self.closed = True
+                self.changed.notify_all()
+
+    def _feed(self, stream, data):
+        """Split data into output and marker lines; called with self.changed held."""
+        data = self.pending[stream] + data
+        line_limit = len(self.marker) + MARKER_TEXT_MAX
+        keep = 0
+        while True:
+            start = data.find(self.marker)
+            if start < 0:
+                # Hold back what may be the start of a marker
+                for size in range(min(len(self.marker) - 1, len(data)), 0, -1):
+                    if data.endswith(self.marker[:size]):
+                        keep = size
+                        break
+                break
+            end = data.find(b"\n", start, start + line_limit)
+            if end < 0:
+                if len(data) - start < line_limit:
+                    keep = len(data) - start  # The rest of the marker line is still to come
+                    break
+                # Too long for a marker line: it is output
+                self._output(stream, data[:start + len(self.marker)])
+                data = data[start + len(self.marker):]
+                continue
+            self._output(stream, data[:start])
+            self._signal(stream, data[start + len(self.marker):end].decode("ascii", "replace"))
+            data = data[end + 1:]
+        self._output(stream, data[:len(data) - keep])
+        self.pending[stream] = data[len(data) - keep:]
+
+    def _output(self, stream, data):
+        """Pass output of the running snippet to its collector; other output is dropped."""
+        if data and self.collector is not None and not self.collector.write(stream, data):
+            self.changed.notify_all()
+
+    def _signal(self, stream, text):
+        """Handle a marker line: "ready", or "done:N" followed by ":status" on stdout."""
+        fields = text.split(":")
+        if fields == ["ready"]:
+            self.ready = True
+        elif fields[0] == "done" and len(fields) >= 2 and fields[1] == str(self.seq - 1):
+            try:
+                self.finished[stream] = int(fields[2]) if stream == "stdout" else 0
+            except (IndexError, ValueError):
+                self.finished[stream] = 1
+        self.changed.notify_all()
+
+class SessionManager:
+    """Interpreter sessions, keyed by session ID and language.
+
+    A session starts on its first snippet (loading its packages takes a
+    while) and is ended after idle_timeout seconds without use, when it
+    times out, or when its container dies, for instance on reaching
+    mem_limit. At most max_sessions are kept; starting one more ends the
+    least recently used idle session. Sessions have the same isolation as
+    one-off sandboxes: no network, a memory limit, the code mounted
+    read-only and a working directory on a tmpfs of at most workdir_size. If data_dir is set, it is mounted read-only at /data, and
+    a preload.py or preload.R there is run when a session starts.
+    """
+
+    def __init__(self, docker_client, languages, max_sessions=20, idle_timeout=900, mem_limit="1g",
+                 workdir_size="64m", start_timeout=120, data_dir=None):
+        """Initialize the manager.
+
+        languages maps a language to its image, kernel command, snippet
+        file extension and environment.
+        """
+        self.docker_client = docker_client
+        self.languages = languages
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.mem_limit = mem_limit
+        self.workdir_size = workdir_size
+        self.start_timeout = start_timeout
+        self.data_dir = data_dir
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def start(self):
+        """Remove sessions left over from a previous run and start ending idle ones."""
+        for container in self.docker_client.containers.list(all=True, filters={"label": SESSION_LABEL}):
+            try:
+                container.remove(force=True)
+            except docker.errors.APIError:
+                pass
+        threading.Thread(target=self._reap, name="session-reaper", daemon=True).start()
+
+    def run(self, session_id, language, code, timeout, collector):
+        """Run code in the session, passing its output to collector; return (exit code, timed out).
+
+        A snippet that times out or prints more than collector takes ends
+        its session.
+        """
+        session = self._get(session_id, language)
+        if not session.lock.acquire(timeout=timeout):
+            raise SessionError("The session is still busy with an earlier snippet")
+        try:
+            try:
+                exit_code, timed_out = session.run(code, timeout, collector)
+            except SessionError:
+                self.end(session_id, language)
+                raise
+            if timed_out or session.broken:
+                self.end(session_id, language)
+            session.last_used = time.monotonic()
+            return exit_code, timed_out
+        finally:
+            session.lock.release()
+
+    def end(self, session_id, language):
+        """End a session, if there is one."""
+        with self.lock:
+            session = self.sessions.pop((session_id, language), None)
+        if session is not None:
+            self._destroy(session)
+
+    def stats(self):
+        """Return the number of sessions per language."""
+        with self.lock:
+            counts = {language: 0 for language in self.languages}
+            for _, language in self.sessions:
+                counts[language] += 1
+            return counts
+
+    def _get(self, session_id, language):
+        """Return the session for a key, starting it if needed."""
+        key = (session_id, language)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None:
+                session.last_used = time.monotonic()  # Keep the reaper away
+                return session
+            evicted = None
+            if len(self.sessions) >= self.max_sessions:
+                idle = [s for s in self.sessions.values() if not s.lock.locked()]
+                if not idle:
+                    raise SessionError(f"All {self.max_sessions} sessions are busy")
+                evicted = min(idle, key=lambda s: s.last_used)
+                del self.sessions[evicted.key]
+        if evicted is not None:
+            self._destroy(evicted)
+
+        # Start the session outside the lock: loading packages takes seconds
+        started = time.monotonic()
+        session = self._create(key)
+        if not session.wait_ready(self.start_timeout):
+            self._destroy(session)
+            raise SessionError(f"The {language} session did not start")
+        logger.info(f"Started {language} session in {time.monotonic() - started:.1f}s")
+
+        with self.lock:
+            existing = self.sessions.setdefault(key, session)
+        if existing is not session:
+            # Another request started the same session meanwhile
+            self._destroy(session)
+        return existing
+
+    def _create(self, key):
+        """Start a session container running the language's kernel."""
+        language = key[1]
+        settings = self.languages[language]
+        directory = tempfile.mkdtemp(prefix=f"session-{language}-")
+        code_dir = os.path.join(directory, "code")
+        os.makedirs(code_dir)
+        os.chmod(directory, 0o755)
+        os.chmod(code_dir, 0o755)
+        kernel = settings["kernel"]
+        shutil.copy(os.path.join(KERNEL_DIR, kernel), os.path.join(code_dir, kernel))
+
+        volumes = {code_dir: {'bind': '/code', 'mode': 'ro'}}
+        if self.data_dir:
+            volumes[self.data_dir] = {'bind': '/data', 'mode': 'ro'}
+        token = secrets.token_hex(16)
+        try:
+            container = self.docker_client.containers.create(
+                settings["image"],
+                command=settings["command"] + [f"/code/{kernel}"],
+                volumes=volumes,
+                tmpfs={'/out': f'size={self.workdir_size}'},
+                working_dir="/code",
+                auto_remove=True,
+                labels={SESSION_LABEL: language},
+                mem_limit=self.mem_limit,
+                network_mode="none",  # No network access
+                # The output is read from the attached stream; logging it would fill the disk
+                log_config=docker.types.LogConfig(type=docker.types.LogConfig.types.NONE),
+                environment=dict(settings.get("environment", {}), SESSION_TOKEN=token)
+            )
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        session = KernelSession(key, container, directory, settings["extension"], token)
+        try:
+            # Attach before starting, so that no output is missed
+            session.attach(container.attach(stdout=True, stderr=True, stream=True, demux=True))
+            container.start()
+        except Exception:
+            self._destroy(session)
+            raise
+        return session
+
+    def _destroy(self, session):
+        """Remove a session's container and its directory."""
+        try:
+            session.container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+        shutil.rmtree(session.directory, ignore_errors=True)
+
+    def _reap(self):
+        """End sessions idle for longer than idle_timeout."""
+        while True:
+            time.sleep(30)
+            now = time.monotonic()
+            with self.lock:
+                expired = [session for session in self.sessions.values()
+                           if not session.lock.locked() and now - session.last_used > self.idle_timeout]
+                for session in expired:
+                    del self.sessions[session.key]
+            for session in expired:
+                logger.info(f"Ending idle {session.key[1]} session")
+                self._destroy(session)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Adaptive Batch Writer for Weaviate
+----------------------------------
+Writes objects through Weaviate's REST batch endpoint with several batches
+in flight, adapting batch size and concurrency to the server's latency.
+"""
+
+import time
+import uuid
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Namespace for content-derived object IDs; never change it, or every
+# object would get a new ID and be written again
+CHUNK_NAMESPACE = uuid.UUID("6f1c1f0e-5d7a-4b8e-9c55-3f1d2a7b9e41")
+
+# Responses worth retrying: rate limiting and server-side trouble
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def chunk_uuid(chunk_hash):
+    """Return the deterministic Weaviate object ID for a chunk hash."""
+    return str(uuid.uuid5(CHUNK_NAMESPACE, chunk_hash))
+
+class BatchWriteError(Exception):
+    """Raised when a batch still fails after all retries."""
+
+class AdaptiveBatchWriter:
+    """Write objects to Weaviate in concurrent, self-tuning batches.
+
+    Objects are (key, properties, vector) tuples; the key is the chunk hash
+    and determines the object ID, so writing the same object twice is an
+    idempotent upsert. After every batch the batch size and the number of
+    batches in flight are tuned: both grow while batches come back well
+    under target_latency and shrink when a batch is slow or fails. Failed
+    batches are retried with jittered exponential backoff. on_written is
+    called with the keys of every batch the server accepted, and
+    on_rejected with the keys of the objects in it that it rejected.
+    """
+
+    def __init__(self, url, class_name, api_key=None, batch_size=50, min_batch_size=10,
+                 max_batch_size=500, concurrency=2, max_concurrency=8, target_latency=2.0,
+                 max_retries=5, timeout=60, session=None, on_written=None, on_rejected=None):
+        """Initialize the writer for a Weaviate instance and class."""
+        self.batch_url = f"{url.rstrip('/')}/v1/batch/objects"
+        self.class_name = class_name
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.on_written = on_written
+        self.on_rejected = on_rejected
+        self.session = session or requests.Session()
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+
+    def write(self, objects):
+        """Write all objects and return the number the server accepted."""
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            batch = []
+            for obj in objects:
+                batch.append(obj)
+                if len(batch) >= self.batch_size:
+                    self._submit(pool, pending, batch)
+                    batch = []
+            if batch:
+                self._submit(pool, pending, batch)
+
+            for future in pending:
+                future.result()
+
+        if self.failed:
+            logger.warning(f"{self.failed} objects were rejected by Weaviate")
+        return self.written
+
+    def _submit(self, pool, pending, batch):
+        """Send a batch once fewer than `concurrency` batches are in flight."""
+        while len(pending) >= self.concurrency:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                future.result()  # Propagate failures
+        pending.add(pool.submit(self._send, batch))
+
+    def _send(self, batch):
+        """POST a batch, retrying transient failures with backoff."""
+        payload = {"objects": [self._object(key, properties, vector) for key, properties, vector in batch]}
+
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                response = self.session.post(self.batch_url, json=payload, timeout=self.timeout)
+                if response.status_code not in RETRYABLE_STATUS:
+                    response.raise_for_status()
+                    self._adjust(time.monotonic() - start, failed=False)
+                    self._record(batch, response.json())
+                    return
+                error = f"HTTP {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+
+            self._adjust(time.monotonic() - start, failed=True)
+            delay = min(30, 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Batch of {len(batch)} failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+        raise BatchWriteError(f"Batch of {len(batch)} objects failed after {self.max_retries} retries")
+
+    def _object(self, key, properties, vector):
+        """Build the REST representation of one object."""
+        obj = {"class": self.class_name, "id": chunk_uuid(key), "properties": properties}
+        if vector is not None:
+            obj["vector"] = vector
+        return obj
+
+    def _record(self, batch, results):
+        """Count accepted and rejected objects and report their keys."""
+        written, rejected = [], []
+        for (key, _, _), result in zip(batch, results):
+            errors = (result.get("result") or {}).get("errors")
+            if errors:
+                logger.error(f"Weaviate rejected chunk {key}: {errors}")
+                rejected.append(key)
+            else:
+                written.append(key)
+
+        with self.lock:
+            self.written += len(written)
+            self.failed += len(rejected)
+            if self.on_written and written:
+                self.on_written(written)
+            if self.on_rejected and rejected:
+                self.on_rejected(rejected)
+
+    def _adjust(self, latency, failed):
+        """Tune batch size and concurrency after a batch round trip."""
+        with self.lock:
+            if failed or latency > self.target_latency:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+                self.concurrency = max(1, self.concurrency - 1)
+            elif latency < self.target_latency / 2:
+                self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.batch_size // 4))
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
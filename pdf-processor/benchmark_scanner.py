@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Structural Scanner Benchmark
+----------------------------
+Compares PDFProcessor.scan_structure, which uses the StructureScanner,
+against the per-chapter regex rescans of identify_chapters_and_sections
+and detect_code_blocks, and checks that both produce the same structure.
+Both write structure.json, so the timings cover the same work.
+"""
+
+import argparse
+import tempfile
+import time
+
+from extract_pdf import PDFProcessor
+
+def run_legacy(processor, text_file):
+    """Structure and code blocks the way chunk_content used to find them."""
+    chapters = processor.identify_chapters_and_sections(text_file)
+
+    # chunk_content re-read the file and sliced every section again
+    with open(text_file, "r") as f:
+        content = f.read()
+
+    code_blocks = []
+    for chapter in chapters:
+        chapter_content = content[chapter["start_position"]:chapter["end_position"]]
+        for section in chapter["sections"]:
+            section_content = chapter_content[section["start_position"] - chapter["start_position"]:
+                                              section["end_position"] - chapter["start_position"]]
+            code_blocks.append(processor.detect_code_blocks(section_content))
+    return chapters, code_blocks
+
+def run_scanner(processor, text_file):
+    """Structure and code blocks the way chunk_content finds them now."""
+    with open(text_file, "r") as f:
+        content = f.read()
+
+    chapters = processor.scan_structure(content)
+    code_blocks = [section["code_blocks"] for chapter in chapters for section in chapter["sections"]]
+    return chapters, code_blocks
+
+def same_structure(legacy_chapters, scanned_chapters):
+    """Check that two chapter lists agree on chapters and sections."""
+    def outline(chapters):
+        return [
+            (chapter["number"], chapter["title"], chapter["start_position"], chapter["end_position"],
+             [(s["number"], s["title"], s["start_position"], s["end_position"]) for s in chapter["sections"]])
+            for chapter in chapters
+        ]
+    return outline(legacy_chapters) == outline(scanned_chapters)
+
+def best_of(repeat, func, *args):
+    """Return the fastest of several timed runs and the last result."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the structural scanner against the regex rescans")
+    parser.add_argument("--text-file", default="output/raw_text.txt", help="Extracted text to scan")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per method (best is reported)")
+
+    args = parser.parse_args()
+
+    processor = PDFProcessor(args.text_file, tempfile.mkdtemp())
+    legacy_time, (legacy_chapters, legacy_code) = best_of(args.repeat, run_legacy, processor, args.text_file)
+    scanner_time, (scanned_chapters, scanned_code) = best_of(args.repeat, run_scanner, processor, args.text_file)
+
+    sections = sum(len(chapter["sections"]) for chapter in scanned_chapters)
+    blocks = sum(len(blocks) for blocks in scanned_code)
+    print(f"{len(scanned_chapters)} chapters, {sections} sections, {blocks} code blocks")
+    print(f"Regex rescans:      {legacy_time * 1000:8.1f} ms")
+    print(f"Structural scanner: {scanner_time * 1000:8.1f} ms ({legacy_time / scanner_time:.2f}x)")
+
+    if not same_structure(legacy_chapters, scanned_chapters) or legacy_code != scanned_code:
+        raise SystemExit("Scanner output differs from the regex rescans")
+    print("Outputs match")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+BM25 Index Builder for Ruppert's Book
+-------------------------------------
+Builds a compact on-disk inverted index over the chunks, which the webapp
+loads for lexical retrieval and as a fallback when Weaviate is unavailable.
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+from array import array
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+# The webapp tokenizes queries the same way (webapp/lexical.py); bump the
+# version whenever tokenize() changes so that stale indexes are rejected
+TOKENIZER_VERSION = 1
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+COMPOUND_PATTERN = re.compile(r"[a-z0-9]+(?:[-.,(][a-z0-9]+)+\)?")
+
+CURRENT_FILE = "CURRENT"
+INDEX_FILE = "bm25.json"
+POSTINGS_FILE = "postings.u32"
+DOCUMENTS_FILE = "documents.jsonl"
+
+def tokenize(text):
+    """Split text into lower-case terms.
+
+    Besides plain words and numbers, compound terms such as "garch(1,1)",
+    "ljung-box" or "14.3" are kept whole, so exact notation can be matched.
+    """
+    text = text.lower()
+    return TOKEN_PATTERN.findall(text) + COMPOUND_PATTERN.findall(text)
+
+def document_text(properties):
+    """Return the text of a chunk that is indexed: its headings and content."""
+    return " ".join(str(properties.get(field, "")) for field in
+                    ("chapterNumber", "chapterTitle", "sectionNumber", "sectionTitle", "content"))
+
+def build_bm25_index(chunks, index_root, to_properties):
+    """Build the index for a stream of chunks under index_root.
+
+    to_properties converts a chunk into the properties stored in Weaviate;
+    the same properties are stored with the index, so the webapp can answer
+    from it alone. Each build goes into its own directory, named after a
+    digest of the chunk hashes, and the CURRENT file is switched to it
+    atomically once it is complete. If CURRENT already names an index of
+    the same chunks, nothing is rebuilt. Returns the index directory.
+
+    Layout of an index directory:
+      bm25.json         term dictionary (term -> [offset, document frequency]),
+                        document lengths, chunk hashes and document offsets
+      postings.u32      (document, term frequency) pairs as uint32, per term
+      documents.jsonl   the properties of every document, one per line
+    """
+    os.makedirs(index_root, exist_ok=True)
+    build_dir = os.path.join(index_root, "build.tmp")
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    postings = defaultdict(list)
+    doc_lengths = []
+    chunk_hashes = []
+    doc_offsets = []
+    digest = hashlib.sha256()
+
+    with open(os.path.join(build_dir, DOCUMENTS_FILE), "wb") as f:
+        for doc, chunk in enumerate(chunks):
+            properties = to_properties(chunk)
+            terms = tokenize(document_text(properties))
+            for term, frequency in Counter(terms).items():
+                postings[term].append((doc, frequency))
+            doc_lengths.append(len(terms))
+            chunk_hashes.append(properties["chunkHash"])
+            digest.update(properties["chunkHash"].encode("utf-8"))
+
+            doc_offsets.append(f.tell())
+            f.write(json.dumps(properties).encode("utf-8") + b"\n")
+
+    version = digest.hexdigest()[:16]
+    version_dir = os.path.join(index_root, version)
+    if current_version(index_root) == version and os.path.isdir(version_dir):
+        shutil.rmtree(build_dir)
+        logger.info(f"BM25 index {version} is up to date")
+        return version_dir
+
+    terms = {}
+    flat = array("I")
+    for term in sorted(postings):
+        terms[term] = [len(flat) // 2, len(postings[term])]
+        for doc, frequency in postings[term]:
+            flat.append(doc)
+            flat.append(frequency)
+    with open(os.path.join(build_dir, POSTINGS_FILE), "wb") as f:
+        flat.tofile(f)
+
+    with open(os.path.join(build_dir, INDEX_FILE), "w") as f:
+        json.dump({
+            "tokenizer_version": TOKENIZER_VERSION,
+            "doc_count": len(doc_lengths),
+            "avg_doc_length": sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0,
+            "doc_lengths": doc_lengths,
+            "chunk_hashes": chunk_hashes,
+            "doc_offsets": doc_offsets,
+            "terms": terms
+        }, f)
+
+    # Publish: move the build into place, then switch CURRENT to it
+    previous = current_version(index_root)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.rename(build_dir, version_dir)
+    tmp_file = os.path.join(index_root, CURRENT_FILE + ".tmp")
+    with open(tmp_file, "w") as f:
+        f.write(version)
+    os.replace(tmp_file, os.path.join(index_root, CURRENT_FILE))
+    logger.info(f"Built BM25 index {version}: {len(doc_lengths)} documents, {len(terms)} terms")
+
+    # Keep the previous version for readers that have not reloaded yet
+    for name in os.listdir(index_root):
+        path = os.path.join(index_root, name)
+        if os.path.isdir(path) and name not in (version, previous):
+            shutil.rmtree(path, ignore_errors=True)
+    return version_dir
+
+def current_version(index_root):
+    """Return the version named in CURRENT, or None."""
+    try:
+        with open(os.path.join(index_root, CURRENT_FILE), "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
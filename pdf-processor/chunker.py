@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Token-Budget Chunker for Ruppert's Book
+---------------------------------------
+Packs structural units (sections, or paragraphs of chapters without
+sections) into chunks that fit the embedding model's token budget.
+"""
+
+import re
+
+# Tokenizer of the t2v-transformers model configured in docker-compose.yml
+DEFAULT_TOKENIZER = "sentence-transformers/all-mpnet-base-v2"
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+NON_SPACE_PATTERN = re.compile(r"\S+")
+SENTENCE_BREAK_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z(\[])")
+
+class TokenCounter:
+    """Count tokens with the embedding model's tokenizer, or estimate them.
+
+    The model's tokenizer.json is loaded with the `tokenizers` package
+    (the Docker image downloads it at build time); if it cannot be loaded,
+    a word-piece estimate stands in.
+    """
+
+    def __init__(self, model_name=DEFAULT_TOKENIZER):
+        """Load the tokenizer for model_name, if possible."""
+        self.tokenizer = None
+        self.name = "estimate"
+        if model_name:
+            try:
+                from tokenizers import Tokenizer
+                self.tokenizer = Tokenizer.from_pretrained(model_name)
+                self.name = model_name
+            except Exception:
+                # tokenizers is not installed or the model is not available
+                self.tokenizer = None
+
+    def count(self, text):
+        """Return the number of tokens in text."""
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        # Roughly one word piece per word or symbol, more for long words
+        return sum(1 + len(word) // 8 for word in WORD_PATTERN.findall(text))
+
+class SentenceSplitter:
+    """Find sentence spans with NLTK's Punkt model, or a regex fallback."""
+
+    def __init__(self):
+        """Load the English Punkt model, if its data is installed."""
+        try:
+            from nltk.tokenize.punkt import PunktTokenizer
+            self.punkt = PunktTokenizer("english")
+        except (ImportError, LookupError):
+            self.punkt = None
+
+    def spans(self, text):
+        """Return the (start, end) spans of the sentences in text."""
+        if self.punkt is not None:
+            return list(self.punkt.span_tokenize(text))
+
+        spans = []
+        start = 0
+        for match in SENTENCE_BREAK_PATTERN.finditer(text):
+            spans.append((start, match.start()))
+            start = match.end()
+        if text[start:].strip():
+            spans.append((start, len(text)))
+        return spans
+
+class TokenBudgetChunker:
+    """Pack units of text into chunks between min_tokens and max_tokens.
+
+    A unit is a dict with absolute "start"/"end" positions in the content
+    and the "metadata" of the section (or chapter) it belongs to. Empty
+    units are dropped, consecutive small units are merged until they reach
+    min_tokens, and units over max_tokens are split at sentence boundaries
+    into windows that overlap by about overlap_tokens. Each chunk is
+    returned as a dict with its span, token count and the units it covers;
+    its metadata is that of its first unit.
+    """
+
+    def __init__(self, content, counter, min_tokens=64, max_tokens=384, overlap_tokens=48):
+        """Initialize the chunker over the full text."""
+        self.content = content
+        self.counter = counter
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.splitter = SentenceSplitter()
+
+    def pack(self, units):
+        """Pack consecutive units into chunks within the token budget."""
+        chunks = []
+        group = None
+
+        for unit in units:
+            start, end = self.strip_span(unit["start"], unit["end"])
+            if start == end:
+                continue
+            tokens = self.counter.count(self.content[start:end])
+
+            if tokens > self.max_tokens:
+                lead = None
+                if group and group["tokens"] < self.min_tokens:
+                    # Let a fragment lead into the first window of the split
+                    lead = group
+                elif group:
+                    self.emit(chunks, group)
+                group = None
+                chunks.extend(self.split(unit, start, end, lead))
+            elif group is None:
+                group = {"start": start, "end": end, "tokens": tokens, "units": [unit]}
+            elif group["tokens"] < self.min_tokens and group["tokens"] + tokens <= self.max_tokens:
+                group["end"] = end
+                group["tokens"] += tokens
+                group["units"].append(unit)
+            else:
+                self.emit(chunks, group)
+                group = {"start": start, "end": end, "tokens": tokens, "units": [unit]}
+
+        if group:
+            self.emit(chunks, group)
+        return chunks
+
+    def emit(self, chunks, group):
+        """Append a group, folding it into the previous chunk if it is too small."""
+        previous = chunks[-1] if chunks else None
+        if (group["tokens"] < self.min_tokens and previous is not None
+                and previous["tokens"] + group["tokens"] <= self.max_tokens):
+            previous["end"] = group["end"]
+            previous["tokens"] += group["tokens"]
+            previous["units"].extend(group["units"])
+        else:
+            chunks.append(group)
+
+    def split(self, unit, start, end, lead=None):
+        """Split an oversized span into overlapping windows of whole sentences.
+
+        A small lead group preceding the span becomes part of the first window.
+        """
+        units = [unit]
+        pieces = []
+        if lead:
+            units = lead["units"] + units
+            pieces.append((lead["start"], lead["end"], lead["tokens"]))
+        for sentence_start, sentence_end in self.splitter.spans(self.content[start:end]):
+            sentence_start += start
+            sentence_end += start
+            tokens = self.counter.count(self.content[sentence_start:sentence_end])
+            if tokens > self.max_tokens:
+                # A "sentence" this long is a table or formula dump; split on words
+                pieces.extend(self.word_pieces(sentence_start, sentence_end))
+            else:
+                pieces.append((sentence_start, sentence_end, tokens))
+
+        windows = []
+        first = 0
+        while first < len(pieces):
+            last = first
+            tokens = pieces[first][2]
+            while last + 1 < len(pieces) and tokens + pieces[last + 1][2] <= self.max_tokens:
+                last += 1
+                tokens += pieces[last][2]
+            windows.append([first, last, tokens])
+            if last + 1 >= len(pieces):
+                break
+
+            # Start the next window a few sentences back to overlap
+            next_first = last + 1
+            overlap = 0
+            while next_first - 1 > first and overlap + pieces[next_first - 1][2] <= self.overlap_tokens:
+                next_first -= 1
+                overlap += pieces[next_first][2]
+            first = next_first
+
+        # Pull the start of short windows (typically the last one, or one
+        # wedged in front of a piece too big to join it) back to reach min_tokens
+        for window in windows:
+            first, last, tokens = window
+            while first > 0 and tokens < self.min_tokens and tokens + pieces[first - 1][2] <= self.max_tokens:
+                first -= 1
+                tokens += pieces[first][2]
+            window[:] = [first, last, tokens]
+
+        return [
+            {
+                "start": pieces[first][0],
+                "end": pieces[last][1],
+                "tokens": tokens,
+                "units": units
+            }
+            for first, last, tokens in windows
+        ]
+
+    def word_pieces(self, start, end):
+        """Split a span into pieces of whole words within max_tokens."""
+        pieces = []
+        piece_start = piece_end = None
+        tokens = 0
+        for match in NON_SPACE_PATTERN.finditer(self.content, start, end):
+            word_tokens = self.counter.count(match.group())
+            if piece_start is not None and tokens + word_tokens > self.max_tokens:
+                pieces.append((piece_start, piece_end, tokens))
+                piece_start = None
+                tokens = 0
+            if piece_start is None:
+                piece_start = match.start()
+            piece_end = match.end()
+            tokens += word_tokens
+        if piece_start is not None:
+            pieces.append((piece_start, piece_end, tokens))
+        return pieces
+
+    def strip_span(self, start, end):
+        """Narrow a span so it does not start or end with whitespace."""
+        while start < end and self.content[start].isspace():
+            start += 1
+        while end > start and self.content[end - 1].isspace():
+            end -= 1
+        return start, end
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Client-Side Embedding for Ruppert's Book
+----------------------------------------
+Embeds chunks in the ingest process and caches the vectors on disk, so that
+chunks can be uploaded to Weaviate together with their vectors.
+"""
+
+import os
+import json
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Same model as the t2v-transformers container, so that query vectors
+# computed by Weaviate stay comparable with the uploaded ones
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
+
+class VectorCache:
+    """Float32 vectors stored on disk, keyed by chunk hash.
+
+    Vectors are appended as raw float32 rows to vectors.f32 and
+    vectors.json maps each chunk hash to its row. The cache is tied to one
+    model; switching models starts an empty cache.
+    """
+
+    def __init__(self, cache_dir, model_name):
+        """Open (or create) the cache in cache_dir for model_name."""
+        os.makedirs(cache_dir, exist_ok=True)
+        self.vectors_file = os.path.join(cache_dir, "vectors.f32")
+        self.index_file = os.path.join(cache_dir, "vectors.json")
+        self.model_name = model_name
+
+        index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                index = json.load(f)
+        if index.get("model") != model_name:
+            if index:
+                logger.info(f"Vector cache was built with {index.get('model')}, starting over")
+            index = {"model": model_name, "dim": None, "rows": {}}
+            open(self.vectors_file, "wb").close()
+
+        self.dim = index["dim"]
+        self.rows = index["rows"]
+        # Appends always go to the end, reads seek to their row
+        self.file = open(self.vectors_file, "a+b")
+
+    def get(self, chunk_hash):
+        """Return the cached vector of a chunk, or None."""
+        row = self.rows.get(chunk_hash)
+        if row is None:
+            return None
+        self.file.seek(row * self.dim * 4)
+        vector = array("f")
+        vector.frombytes(self.file.read(self.dim * 4))
+        return vector.tolist()
+
+    def put_many(self, items):
+        """Append (chunk_hash, vector) pairs and persist the index."""
+        if not items:
+            return
+        if self.dim is None:
+            self.dim = len(items[0][1])
+
+        self.file.seek(0, os.SEEK_END)
+        row = self.file.tell() // (self.dim * 4)
+        for chunk_hash, vector in items:
+            self.file.write(array("f", vector).tobytes())
+            self.rows[chunk_hash] = row
+            row += 1
+        self.file.flush()
+        self.save()
+
+    def save(self):
+        """Atomically write the index next to the vectors."""
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"model": self.model_name, "dim": self.dim, "rows": self.rows}, f)
+        os.replace(tmp_file, self.index_file)
+
+    def close(self):
+        """Close the vectors file."""
+        self.file.close()
+
+class ChunkEmbedder:
+    """Embed chunk contents with sentence-transformers, reusing cached vectors.
+
+    Chunks are embedded in groups of batch_size * workers * 4, spread over
+    a pool of worker processes when workers > 1. Only chunks missing from
+    the cache are embedded.
+    """
+
+    def __init__(self, cache, model_name=DEFAULT_EMBEDDING_MODEL, batch_size=64, workers=1):
+        """Load the embedding model."""
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            raise RuntimeError("Client-side embedding requires the sentence-transformers package")
+
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.pool = None
+        if self.workers > 1:
+            self.pool = self.model.start_multi_process_pool(["cpu"] * self.workers)
+        self.embedded = 0
+        self.cached = 0
+
+    def embed(self, texts):
+        """Return one vector (a list of floats) per text."""
+        if self.pool is not None:
+            vectors = self.model.encode_multi_process(texts, self.pool, batch_size=self.batch_size)
+        else:
+            vectors = self.model.encode(texts, batch_size=self.batch_size)
+        return [vector.tolist() for vector in vectors]
+
+    def embed_chunks(self, chunks, key=lambda chunk: chunk["metadata"]["chunk_hash"]):
+        """Yield (chunk, vector) pairs, embedding cache misses group by group."""
+        group_size = self.batch_size * self.workers * 4
+        group = []
+        for chunk in chunks:
+            group.append(chunk)
+            if len(group) >= group_size:
+                yield from self._embed_group(group, key)
+                group = []
+        if group:
+            yield from self._embed_group(group, key)
+
+    def _embed_group(self, group, key):
+        """Fill in the vectors of a group of chunks from the cache or the model."""
+        vectors = [self.cache.get(key(chunk)) for chunk in group]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if missing:
+            embedded = self.embed([group[i]["content"] for i in missing])
+            self.cache.put_many([(key(group[i]), vector) for i, vector in zip(missing, embedded)])
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+
+        self.embedded += len(missing)
+        self.cached += len(group) - len(missing)
+        return zip(group, vectors)
+
+    def close(self):
+        """Stop the worker pool and close the cache."""
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+        self.cache.close()
@@ -7,22 +7,142 @@ chunks it appropriately, and prepares it for ingestion into Weaviate.
 """
 
 import os
-import re
 import json
+import bisect
+import hashlib
 import argparse
 import subprocess
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import nltk
 from nltk.tokenize import sent_tokenize
 
+from chunker import DEFAULT_TOKENIZER, TokenBudgetChunker, TokenCounter
+from scanner import (CHAPTER_PATTERN, SECTION_PATTERN, R_CODE_PATTERN, PYTHON_CODE_PATTERN,
+                     StructureScanner)
+
 # Download NLTK data
 nltk.download('punkt', quiet=True)
+nltk.download('punkt_tab', quiet=True)
+
+def extract_page_range(pdf_path, first_page, last_page):
+    """Extract the text of an inclusive page range with pdftotext.
+
+    Runs in a worker process; pdftotext ends every page with a form feed,
+    so the outputs of consecutive ranges can simply be concatenated.
+    """
+    result = subprocess.run([
+        "pdftotext",
+        "-layout",  # Maintain layout
+        "-f", str(first_page),
+        "-l", str(last_page),
+        pdf_path,
+        "-"  # Write to stdout
+    ], capture_output=True, check=True)
+    return result.stdout.decode("utf-8", errors="replace")
+
+def split_page_ranges(page_count, parts):
+    """Split pages 1..page_count into at most `parts` contiguous ranges."""
+    parts = max(1, min(parts, page_count))
+    size, remainder = divmod(page_count, parts)
+    ranges = []
+    first_page = 1
+    for i in range(parts):
+        last_page = first_page + size - 1 + (1 if i < remainder else 0)
+        ranges.append((first_page, last_page))
+        first_page = last_page + 1
+    return ranges
+
+def find_page_offsets(content):
+    """Return the character offset at which each page starts (page 1 first)."""
+    offsets = [0]
+    position = content.find("\f")
+    while position != -1 and position + 1 < len(content):
+        offsets.append(position + 1)
+        position = content.find("\f", position + 1)
+    return offsets
+
+def page_at(page_offsets, position):
+    """Return the 1-based page number containing a character offset."""
+    return max(1, bisect.bisect_right(page_offsets, position))
+
+MANIFEST_FILE = "manifest.json"
+CHUNKS_FILE = "chunks.jsonl"
+
+def file_sha256(path):
+    """Return the SHA-256 hex digest of a file, read in 1 MB blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def text_sha256(text):
+    """Return the SHA-256 hex digest of a string."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def chunk_hash(chunk):
+    """Return the content hash of a chunk (its text, metadata and code blocks)."""
+    metadata = {k: v for k, v in chunk.get("metadata", {}).items() if k != "chunk_hash"}
+    return text_sha256(json.dumps({
+        "content": chunk.get("content", ""),
+        "metadata": metadata,
+        "code_blocks": chunk.get("code_blocks", [])
+    }, sort_keys=True))
+
+def load_manifest(output_dir):
+    """Load the processing manifest from the output directory, if any."""
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+def save_manifest(output_dir, manifest):
+    """Atomically write the processing manifest to the output directory."""
+    manifest_file = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, manifest_file)
+
+def read_chunks(chunks_file):
+    """Lazily yield chunks from a JSONL chunks file.
+
+    Legacy chunks.json files holding a single JSON array are still
+    accepted, but have to be loaded whole.
+    """
+    with open(chunks_file, "r") as f:
+        if chunks_file.endswith(".json"):
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
 
 class PDFProcessor:
-    def __init__(self, pdf_path, output_dir):
-        """Initialize the PDF processor with paths."""
+    def __init__(self, pdf_path, output_dir, workers=1, force=False,
+                 min_tokens=64, max_tokens=384, overlap_tokens=48, tokenizer=DEFAULT_TOKENIZER):
+        """Initialize the PDF processor with paths.
+
+        With workers > 1 the text is extracted in page ranges across a
+        process pool and pdftohtml runs alongside it. Unless force is set,
+        work already recorded as up to date in the manifest is skipped.
+        Chunks are kept between min_tokens and max_tokens of the tokenizer
+        (the embedding model's by default), with oversized sections split
+        into windows overlapping by overlap_tokens.
+        """
         self.pdf_path = pdf_path
         self.output_dir = output_dir
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.force = force
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.token_counter = TokenCounter(tokenizer)
+        if tokenizer and self.token_counter.tokenizer is None:
+            print(f"Could not load the {tokenizer} tokenizer, estimating token counts")
+        self.result = None
         self.ensure_output_dir()
         
     def ensure_output_dir(self):
@@ -44,6 +164,30 @@ class PDFProcessor:
         print(f"Extracted raw text to {output_file}")
         return output_file
     
+    def extract_text_parallel(self, page_count):
+        """Extract text in page ranges across a process pool.
+
+        The ranges are stitched back together in page order, so the result
+        is equivalent to a single pdftotext run over the whole document.
+        """
+        output_file = os.path.join(self.output_dir, "raw_text.txt")
+        ranges = split_page_ranges(page_count, self.workers * 4)
+        
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            texts = pool.map(
+                extract_page_range,
+                [self.pdf_path] * len(ranges),
+                [first for first, _ in ranges],
+                [last for _, last in ranges]
+            )
+            with open(output_file, "w") as f:
+                for text in texts:
+                    f.write(text)
+        
+        print(f"Extracted raw text from {page_count} pages in {len(ranges)} ranges "
+              f"using {self.workers} workers to {output_file}")
+        return output_file
+    
     def extract_text_with_pdftohtml(self):
         """Extract text and structure using pdftohtml (from poppler-utils)."""
         output_file = os.path.join(self.output_dir, "content.html")
@@ -87,8 +231,8 @@ class PDFProcessor:
             content = f.read()
         
         # Regular expressions for chapter and section detection
-        chapter_pattern = re.compile(r'Chapter\s+(\d+)[.\s]+([^\n]+)', re.IGNORECASE)
-        section_pattern = re.compile(r'(\d+\.\d+)[.\s]+([^\n]+)')
+        chapter_pattern = CHAPTER_PATTERN
+        section_pattern = SECTION_PATTERN
         
         # Find chapters
         chapters = []
@@ -149,11 +293,37 @@ class PDFProcessor:
         print(f"Extracted structure to {structure_file}")
         return chapters
     
+    def scan_structure(self, content):
+        """Identify chapters, sections, code blocks and paragraphs in one scan.
+
+        Equivalent to identify_chapters_and_sections, but works on text that
+        is already in memory and also records code blocks and paragraph
+        spans for the chunker.
+        """
+        chapters = StructureScanner(content).scan()
+        
+        # Save structure to file, in the same format as before
+        structure_file = os.path.join(self.output_dir, "structure.json")
+        with open(structure_file, "w") as f:
+            json.dump([
+                {
+                    **{k: v for k, v in chapter.items() if k not in ("sections", "paragraphs")},
+                    "sections": [
+                        {k: v for k, v in section.items() if k != "code_blocks"}
+                        for section in chapter["sections"]
+                    ]
+                }
+                for chapter in chapters
+            ], f, indent=2)
+        
+        print(f"Extracted structure to {structure_file}")
+        return chapters
+    
     def detect_code_blocks(self, text):
         """Detect code blocks in text."""
         # Patterns for R and Python code
-        r_pattern = re.compile(r'```r\s*(.*?)\s*```|> (.*?)(\n\n|\Z)', re.DOTALL)
-        python_pattern = re.compile(r'```python\s*(.*?)\s*```|>>> (.*?)(\n\n|\Z)', re.DOTALL)
+        r_pattern = R_CODE_PATTERN
+        python_pattern = PYTHON_CODE_PATTERN
         
         code_blocks = []
         
@@ -181,120 +351,303 @@ class PDFProcessor:
         
         return code_blocks
     
-    def chunk_content(self, chapters, text_file):
-        """Chunk content based on chapters and sections."""
-        with open(text_file, "r") as f:
-            content = f.read()
+    def chapter_units(self, chapter, scanner):
+        """Return the units a chapter is chunked from: its sections or paragraphs.
+
+        Each unit carries its absolute span, its metadata and its code blocks
+        with absolute positions.
+        """
+        chapter_metadata = {
+            "chapter_number": chapter["number"],
+            "chapter_title": chapter["title"]
+        }
+        units = []
+        
+        # If chapter has sections, chunk by section
+        if chapter["sections"]:
+            for section in chapter["sections"]:
+                start, end = section["start_position"], section["end_position"]
+                code_blocks = section.get("code_blocks")
+                if code_blocks is None:
+                    code_blocks = scanner.code_blocks(start, end)
+                units.append({
+                    "start": start,
+                    "end": end,
+                    "metadata": {
+                        **chapter_metadata,
+                        "section_number": section["number"],
+                        "section_title": section["title"]
+                    },
+                    "code_blocks": [
+                        {**block, "start": block["start"] + start, "end": block["end"] + start}
+                        for block in code_blocks
+                    ]
+                })
+        else:
+            # If no sections, chunk the chapter by paragraphs
+            paragraphs = chapter.get("paragraphs")
+            if paragraphs is None:
+                paragraphs = scanner.paragraph_spans(chapter["start_position"], chapter["end_position"])
+            for start, end in paragraphs:
+                units.append({
+                    "start": start,
+                    "end": end,
+                    "metadata": chapter_metadata,
+                    "code_blocks": [
+                        {**block, "start": block["start"] + start, "end": block["end"] + start}
+                        for block in scanner.code_blocks(start, end)
+                    ]
+                })
         
-        chunks = []
+        return units
+    
+    def iter_chunks(self, chapters, content):
+        """Yield chunks based on chapters and sections, one at a time.
+
+        Sections (or the paragraphs of chapters without sections) are packed
+        into chunks within the token budget: empty ones are dropped, small
+        ones merged and oversized ones split at sentence boundaries with
+        overlap.
+        """
+        page_offsets = find_page_offsets(content)
+        scanner = StructureScanner(content)
+        chunker = TokenBudgetChunker(
+            content,
+            self.token_counter,
+            min_tokens=self.min_tokens,
+            max_tokens=self.max_tokens,
+            overlap_tokens=self.overlap_tokens
+        )
         
         for chapter in chapters:
-            chapter_content = content[chapter["start_position"]:chapter["end_position"]]
-            
-            # If chapter has sections, chunk by section
-            if chapter["sections"]:
-                for section in chapter["sections"]:
-                    section_start = section["start_position"] - chapter["start_position"]
-                    section_end = section["end_position"] - chapter["start_position"]
-                    section_content = chapter_content[section_start:section_end]
-                    
-                    # Detect code blocks
-                    code_blocks = self.detect_code_blocks(section_content)
-                    
-                    # Create chunk
-                    chunk = {
-                        "content": section_content,
-                        "metadata": {
-                            "chapter_number": chapter["number"],
-                            "chapter_title": chapter["title"],
-                            "section_number": section["number"],
-                            "section_title": section["title"],
-                            "has_code": len(code_blocks) > 0
-                        },
-                        "code_blocks": code_blocks
-                    }
-                    chunks.append(chunk)
-            else:
-                # If no sections, chunk the chapter into smaller pieces
-                # Use simple paragraph splitting instead of sentence tokenization
-                paragraphs = re.split(r'\n\s*\n', chapter_content)
+            for packed in chunker.pack(self.chapter_units(chapter, scanner)):
+                start, end = packed["start"], packed["end"]
                 
-                # Group paragraphs into chunks of approximately 1000 characters
-                current_chunk = ""
-                for paragraph in paragraphs:
-                    if len(current_chunk) + len(paragraph) < 1000:
-                        current_chunk += paragraph + "\n\n"
-                    else:
-                        # Detect code blocks
-                        code_blocks = self.detect_code_blocks(current_chunk)
-                        
-                        # Create chunk
-                        chunk = {
-                            "content": current_chunk.strip(),
-                            "metadata": {
-                                "chapter_number": chapter["number"],
-                                "chapter_title": chapter["title"],
-                                "has_code": len(code_blocks) > 0
-                            },
-                            "code_blocks": code_blocks
-                        }
-                        chunks.append(chunk)
-                        current_chunk = paragraph + "\n\n"
+                # Keep the code blocks that lie entirely within the chunk
+                code_blocks = [
+                    {**block, "start": block["start"] - start, "end": block["end"] - start}
+                    for unit in packed["units"]
+                    for block in unit["code_blocks"]
+                    if start <= block["start"] and block["end"] <= end
+                ]
                 
-                # Add the last chunk if not empty
-                if current_chunk.strip():
-                    code_blocks = self.detect_code_blocks(current_chunk)
-                    chunk = {
-                        "content": current_chunk.strip(),
-                        "metadata": {
-                            "chapter_number": chapter["number"],
-                            "chapter_title": chapter["title"],
-                            "has_code": len(code_blocks) > 0
-                        },
-                        "code_blocks": code_blocks
-                    }
-                    chunks.append(chunk)
-        
-        # Save chunks to file
-        chunks_file = os.path.join(self.output_dir, "chunks.json")
-        with open(chunks_file, "w") as f:
-            json.dump(chunks, f, indent=2)
-        
-        print(f"Created {len(chunks)} chunks and saved to {chunks_file}")
-        return chunks
+                # Create chunk
+                chunk = {
+                    "content": content[start:end],
+                    "metadata": {
+                        **packed["units"][0]["metadata"],
+                        "page_start": page_at(page_offsets, start),
+                        "page_end": page_at(page_offsets, end - 1),
+                        "token_count": packed["tokens"],
+                        "has_code": len(code_blocks) > 0
+                    },
+                    "code_blocks": code_blocks
+                }
+                yield self.finish_chunk(chunk)
     
-    def process(self):
-        """Process the PDF and extract all necessary information."""
+    def finish_chunk(self, chunk):
+        """Record a content hash on the chunk for incremental ingestion."""
+        chunk["metadata"]["chunk_hash"] = chunk_hash(chunk)
+        return chunk
+    
+    def stream_chunks(self, chapters, content):
+        """Chunk content and write each chunk to chunks.jsonl as it is produced.
+
+        Chunks are yielded as soon as they are written, so a consumer such
+        as the Weaviate ingestor can start before chunking has finished.
+        The file only replaces the previous one once chunking completes.
+        """
+        chunks_file = self.output_path(CHUNKS_FILE)
+        tmp_file = chunks_file + ".tmp"
+        count = 0
+        with open(tmp_file, "w") as f:
+            for chunk in self.iter_chunks(chapters, content):
+                f.write(json.dumps(chunk) + "\n")
+                f.flush()
+                count += 1
+                yield chunk
+        os.replace(tmp_file, chunks_file)
+        
+        print(f"Created {count} chunks and saved to {chunks_file}")
+    
+    def chunk_content(self, chapters, text_file):
+        """Chunk content based on chapters and sections."""
+        with open(text_file, "r") as f:
+            content = f.read()
+        
+        return list(self.stream_chunks(chapters, content))
+    
+    def output_path(self, name):
+        """Return the path of a file in the output directory."""
+        return os.path.join(self.output_dir, name)
+    
+    def load_outputs(self, *names):
+        """Load JSON outputs of a previous run."""
+        loaded = []
+        for name in names:
+            with open(self.output_path(name), "r") as f:
+                loaded.append(json.load(f))
+        return loaded
+    
+    def outputs_exist(self, *names):
+        """Check whether all the named outputs of a previous run exist."""
+        return all(os.path.exists(self.output_path(name)) for name in names)
+    
+    def hash_pages(self, content):
+        """Hash the text of every page (pages are separated by form feeds)."""
+        return [text_sha256(page) for page in content.rstrip("\f").split("\f")]
+    
+    def chunking_settings(self):
+        """Return the settings that determine chunk boundaries, for the manifest."""
+        return {
+            "min_tokens": self.min_tokens,
+            "max_tokens": self.max_tokens,
+            "overlap_tokens": self.overlap_tokens,
+            "tokenizer": self.token_counter.name
+        }
+    
+    def process_stream(self):
+        """Process the PDF, yielding chunks as they become available.
+
+        A manifest in the output directory records the PDF hash, per-page
+        text hashes, chunking settings and per-chunk content hashes. An
+        unchanged PDF skips extraction, and unchanged page text and chunking
+        settings skip restructuring and re-chunking; the previous chunks are streamed back from
+        chunks.jsonl instead. The run's outputs are left in self.result
+        once the stream is exhausted.
+        """
+        manifest = load_manifest(self.output_dir)
+        previous = {} if self.force else manifest
+        pdf_hash = file_sha256(self.pdf_path)
+        chunking = self.chunking_settings()
+        chunks_file = self.output_path(CHUNKS_FILE)
+        pdf_unchanged = (previous.get("pdf_sha256") == pdf_hash
+                         and self.outputs_exist("raw_text.txt", "metadata.json"))
+        
+        if (pdf_unchanged and previous.get("chunking") == chunking
+                and self.outputs_exist("structure.json", CHUNKS_FILE)):
+            metadata, chapters = self.load_outputs("metadata.json", "structure.json")
+            print(f"PDF unchanged since last run, reusing {chunks_file}")
+            count = 0
+            for chunk in read_chunks(chunks_file):
+                count += 1
+                yield chunk
+            self.result = {
+                "text_file": self.output_path("raw_text.txt"),
+                "html_file": self.output_path("content.html"),
+                "metadata": metadata,
+                "chapters": chapters,
+                "chunks_file": chunks_file,
+                "chunk_count": count,
+                "manifest": manifest
+            }
+            return
+        
         # Extract text and metadata
-        text_file = self.extract_text_with_pdftotext()
-        html_file = self.extract_text_with_pdftohtml()
-        metadata = self.extract_metadata()
+        if pdf_unchanged:
+            # Only the chunking settings changed
+            print("PDF unchanged since last run, reusing extracted text")
+            text_file = self.output_path("raw_text.txt")
+            html_file = self.output_path("content.html")
+            metadata, = self.load_outputs("metadata.json")
+        elif self.workers > 1:
+            # The page count from pdfinfo drives the page-range split, and
+            # pdftohtml runs in the background while the ranges are extracted
+            metadata = self.extract_metadata()
+            with ThreadPoolExecutor(max_workers=1) as html_pool:
+                html_future = html_pool.submit(self.extract_text_with_pdftohtml)
+                text_file = self.extract_text_parallel(int(metadata.get("Pages", 1)))
+                html_file = html_future.result()
+        else:
+            text_file = self.extract_text_with_pdftotext()
+            html_file = self.extract_text_with_pdftohtml()
+            metadata = self.extract_metadata()
+        
+        # Read the text once; hashing, scanning and chunking all share it
+        with open(text_file, "r") as f:
+            content = f.read()
         
-        # Identify structure
-        chapters = self.identify_chapters_and_sections(text_file)
+        page_hashes = self.hash_pages(content)
+        if (previous.get("pages") == page_hashes and previous.get("chunking") == chunking
+                and self.outputs_exist("structure.json", CHUNKS_FILE)):
+            # Only the PDF container changed (e.g. its metadata), not the text
+            chapters, = self.load_outputs("structure.json")
+            print(f"Page text unchanged since last run, reusing {chunks_file}")
+            chunks = read_chunks(chunks_file)
+        else:
+            changed_pages = sum(
+                1 for i, page_hash in enumerate(page_hashes)
+                if i >= len(previous.get("pages", [])) or previous["pages"][i] != page_hash
+            )
+            print(f"{changed_pages} of {len(page_hashes)} pages new or changed since last run")
+            
+            # Identify structure
+            chapters = self.scan_structure(content)
+            
+            # Chunk content
+            chunks = self.stream_chunks(chapters, content)
         
-        # Chunk content
-        chunks = self.chunk_content(chapters, text_file)
+        chunk_hashes = []
+        for chunk in chunks:
+            chunk_hashes.append(chunk["metadata"].get("chunk_hash") or chunk_hash(chunk))
+            yield chunk
         
-        return {
+        # Re-read the manifest in case a consumer updated it while streaming
+        manifest = load_manifest(self.output_dir)
+        manifest.update({
+            "pdf_sha256": pdf_hash,
+            "pages": page_hashes,
+            "chunking": chunking,
+            "chunks": chunk_hashes
+        })
+        save_manifest(self.output_dir, manifest)
+        
+        self.result = {
             "text_file": text_file,
             "html_file": html_file,
             "metadata": metadata,
             "chapters": chapters,
-            "chunks": chunks
+            "chunks_file": chunks_file,
+            "chunk_count": len(chunk_hashes),
+            "manifest": manifest
         }
+    
+    def process(self):
+        """Process the PDF and extract all necessary information."""
+        for _ in self.process_stream():
+            pass
+        return self.result
 
 def main():
     parser = argparse.ArgumentParser(description="Process Ruppert's book PDF for RAG ingestion")
     parser.add_argument("pdf_path", help="Path to the PDF file")
     parser.add_argument("--output-dir", default="output", help="Output directory for processed files")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for page-range text extraction (0 = one per CPU)")
+    parser.add_argument("--force", action="store_true",
+                        help="Ignore the manifest and reprocess everything")
+    parser.add_argument("--min-tokens", type=int, default=64, help="Minimum tokens per chunk")
+    parser.add_argument("--max-tokens", type=int, default=384, help="Maximum tokens per chunk")
+    parser.add_argument("--overlap-tokens", type=int, default=48,
+                        help="Tokens shared between consecutive pieces of a split section")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER,
+                        help="Hugging Face tokenizer used to count tokens ('' for the local estimate)")
     
     args = parser.parse_args()
     
-    processor = PDFProcessor(args.pdf_path, args.output_dir)
+    processor = PDFProcessor(
+        args.pdf_path,
+        args.output_dir,
+        workers=args.workers,
+        force=args.force,
+        min_tokens=args.min_tokens,
+        max_tokens=args.max_tokens,
+        overlap_tokens=args.overlap_tokens,
+        tokenizer=args.tokenizer
+    )
     result = processor.process()
     
-    print(f"Processing complete. {len(result['chunks'])} chunks created.")
+    print(f"Processing complete. {result['chunk_count']} chunks in {result['chunks_file']}.")
 
 if __name__ == "__main__":
     main()
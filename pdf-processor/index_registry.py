@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Versioned Index Registry for Ruppert's Book
+-------------------------------------------
+Tracks the versioned RuppertContent_vN classes in Weaviate and the Redis
+pointer that tells the webapp which one to query.
+"""
+
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+BASE_CLASS = "RuppertContent"
+VERSION_PATTERN = re.compile(rf"^{BASE_CLASS}_v(\d+)$")
+
+# Redis keys shared with the webapp
+ACTIVE_CLASS_KEY = "index:active_class"
+GENERATION_KEY = "index:generation"
+SWITCH_CHANNEL = "index:switched"
+
+class IndexRegistry:
+    """Versioned Weaviate classes behind a Redis pointer.
+
+    A rebuild goes into a new RuppertContent_vN class while the webapp keeps
+    querying the active one; activate() then moves the pointer in a single
+    Redis transaction. The generation counter is bumped on every change to
+    the active index (a switch or an in-place update), so caches keyed on it
+    are invalidated. The unversioned RuppertContent class of older
+    deployments counts as version 0.
+    """
+
+    def __init__(self, weaviate_client, redis_client):
+        """Initialize the registry with Weaviate and Redis clients."""
+        self.weaviate_client = weaviate_client
+        self.redis_client = redis_client
+
+    def versions(self):
+        """Return the existing versioned classes as sorted (version, class) pairs."""
+        versions = []
+        for weaviate_class in self.weaviate_client.schema.get().get("classes", []):
+            name = weaviate_class["class"]
+            match = VERSION_PATTERN.match(name)
+            if match:
+                versions.append((int(match.group(1)), name))
+            elif name == BASE_CLASS:
+                versions.append((0, name))
+        return sorted(versions)
+
+    def active_class(self):
+        """Return the class the webapp queries, or None if there is none yet."""
+        active = self.redis_client.get(ACTIVE_CLASS_KEY)
+        if active:
+            return active.decode() if isinstance(active, bytes) else active
+        # Deployments from before versioning only have the base class
+        if self.weaviate_client.schema.exists(BASE_CLASS):
+            return BASE_CLASS
+        return None
+
+    def next_class(self):
+        """Return the name for the next version of the index."""
+        versions = self.versions()
+        return f"{BASE_CLASS}_v{versions[-1][0] + 1 if versions else 1}"
+
+    def activate(self, class_name):
+        """Point the webapp at class_name in one atomic step."""
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.set(ACTIVE_CLASS_KEY, class_name)
+        pipe.incr(GENERATION_KEY)
+        pipe.execute()
+        self.redis_client.publish(SWITCH_CHANNEL, class_name)
+        logger.info(f"Switched the active index to {class_name}")
+
+    def touch(self):
+        """Record an in-place update of the active index."""
+        self.redis_client.incr(GENERATION_KEY)
+
+    def collect_garbage(self, keep=1):
+        """Delete old versions, keeping the active one and the `keep` newest others.
+
+        Keeping the previous version around lets requests that started
+        before a switch finish, and allows a quick rollback.
+        """
+        active = self.active_class()
+        others = [name for _, name in self.versions() if name != active]
+        stale = others[:-keep] if keep > 0 else others
+        for name in stale:
+            self.weaviate_client.schema.delete_class(name)
+            logger.info(f"Deleted old index version {name}")
+        return stale
@@ -6,12 +6,19 @@ Ingests processed chunks from Ruppert's book into Weaviate.
 """
 
 import os
-import json
+import redis
 import weaviate
 import logging
+import threading
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+from batch_writer import AdaptiveBatchWriter
+from bm25_index import build_bm25_index
+from embedder import DEFAULT_EMBEDDING_MODEL, ChunkEmbedder, VectorCache
+from index_registry import IndexRegistry
+from extract_pdf import CHUNKS_FILE, PDFProcessor, chunk_hash, load_manifest, read_chunks, save_manifest
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -19,12 +26,74 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
+CHECKPOINT_FILE = "ingest_checkpoint.txt"
+
+class IngestCheckpoint:
+    """Append-only record of the chunk hashes written by an unfinished ingest run.
+
+    The file exists only while a run is in progress. If the run is
+    interrupted, the next run reads it back and skips the chunks that were
+    already written.
+    """
+    
+    def __init__(self, output_dir):
+        """Initialize the checkpoint in the output directory."""
+        self.checkpoint_file = os.path.join(output_dir, CHECKPOINT_FILE)
+        self.lock = threading.Lock()
+    
+    def exists(self):
+        """Check whether an interrupted run left a checkpoint behind."""
+        return os.path.exists(self.checkpoint_file)
+    
+    def load(self):
+        """Return the chunk hashes recorded by the interrupted run."""
+        if not self.exists():
+            return set()
+        with open(self.checkpoint_file, "r") as f:
+            return {line.strip() for line in f if line.strip()}
+    
+    def start(self):
+        """Create the checkpoint file for a new run."""
+        open(self.checkpoint_file, "a").close()
+    
+    def record(self, chunk_hashes):
+        """Append written chunk hashes, flushed to disk straight away."""
+        with self.lock, open(self.checkpoint_file, "a") as f:
+            f.write("".join(f"{chunk_hash}\n" for chunk_hash in chunk_hashes))
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def clear(self):
+        """Remove the checkpoint once the run has completed."""
+        if self.exists():
+            os.remove(self.checkpoint_file)
+
 class WeaviateIngestor:
     def __init__(self):
         """Initialize the Weaviate ingestor with connection details."""
         self.weaviate_url = os.getenv("WEAVIATE_URL", "http://weaviate:8080")
         self.weaviate_api_key = os.getenv("WEAVIATE_API_KEY")
+        self.batch_size = int(os.getenv("INGEST_BATCH_SIZE", 50))
+        self.concurrency = int(os.getenv("INGEST_CONCURRENCY", 2))
+        self.max_concurrency = int(os.getenv("INGEST_MAX_CONCURRENCY", 8))
+        self.target_latency = float(os.getenv("INGEST_TARGET_LATENCY", 2.0))
+        # "weaviate" leaves vectorization to text2vec-transformers, "client"
+        # embeds chunks here and uploads them with their vectors
+        self.vector_mode = os.getenv("INGEST_VECTORS", "weaviate")
+        self.embedding_model = os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+        self.embed_batch_size = int(os.getenv("EMBED_BATCH_SIZE", 64))
+        self.embed_workers = int(os.getenv("EMBED_WORKERS", 0))
+        self.vector_cache_dir = os.getenv("VECTOR_CACHE_DIR", "/data/output/vectors")
+        self.keep_versions = int(os.getenv("INDEX_KEEP_VERSIONS", 1))
         self.client = self._connect_to_weaviate()
+        self.registry = IndexRegistry(self.client, redis.Redis(
+            host=os.getenv("REDIS_HOST", "redis"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            password=os.getenv("REDIS_PASSWORD", ""),
+            decode_responses=True
+        ))
+        # Class the chunks are written to; set by sync_chunks
+        self.class_name = self.registry.active_class() or "RuppertContent"
         
     def _connect_to_weaviate(self):
         """Connect to Weaviate instance."""
@@ -41,11 +110,11 @@ class WeaviateIngestor:
             logger.error(f"Failed to connect to Weaviate: {e}")
             raise
     
-    def create_schema(self):
+    def create_schema(self, class_name="RuppertContent"):
         """Create the schema for Ruppert's book content."""
         # Define the class for book content
         ruppert_class = {
-            "class": "RuppertContent",
+            "class": class_name,
             "description": "Content chunks from Ruppert's Statistics and Data Analysis for Financial Engineering book",
             "vectorizer": "text2vec-transformers",
             "moduleConfig": {
@@ -65,6 +134,17 @@ class WeaviateIngestor:
                         }
                     }
                 },
+                {
+                    "name": "chunkHash",
+                    "description": "Content hash of the chunk, used for incremental updates",
+                    "dataType": ["text"],
+                    "tokenization": "field",
+                    "moduleConfig": {
+                        "text2vec-transformers": {
+                            "skip": True
+                        }
+                    }
+                },
                 {
                     "name": "chapterNumber",
                     "description": "Chapter number",
@@ -105,6 +185,26 @@ class WeaviateIngestor:
                         }
                     }
                 },
+                {
+                    "name": "pageStart",
+                    "description": "First page of the book covered by the chunk",
+                    "dataType": ["int"],
+                    "moduleConfig": {
+                        "text2vec-transformers": {
+                            "skip": True
+                        }
+                    }
+                },
+                {
+                    "name": "pageEnd",
+                    "description": "Last page of the book covered by the chunk",
+                    "dataType": ["int"],
+                    "moduleConfig": {
+                        "text2vec-transformers": {
+                            "skip": True
+                        }
+                    }
+                },
                 {
                     "name": "hasCode",
                     "description": "Whether the chunk contains code examples",
@@ -140,88 +240,244 @@ class WeaviateIngestor:
         
         # Create the schema
         try:
-            if self.client.schema.exists("RuppertContent"):
-                logger.info("RuppertContent class already exists, deleting it first")
-                self.client.schema.delete_class("RuppertContent")
+            if self.client.schema.exists(class_name):
+                logger.info(f"{class_name} class already exists, deleting it first")
+                self.client.schema.delete_class(class_name)
             
             self.client.schema.create_class(ruppert_class)
-            logger.info("Created RuppertContent schema in Weaviate")
+            logger.info(f"Created {class_name} schema in Weaviate")
         except Exception as e:
             logger.error(f"Failed to create schema: {e}")
             raise
     
+    def class_exists(self, class_name=None):
+        """Check whether a class (by default the current one) has been created."""
+        return self.client.schema.exists(class_name or self.class_name)
+    
+    def chunk_properties(self, chunk):
+        """Convert a processed chunk into RuppertContent properties."""
+        # Extract code blocks and languages
+        code_blocks = []
+        code_languages = []
+        for code_block in chunk.get("code_blocks", []):
+            code_blocks.append(code_block["code"])
+            code_languages.append(code_block["language"])
+        
+        # Prepare properties
+        properties = {
+            "content": chunk["content"],
+            "chunkHash": chunk["metadata"].get("chunk_hash") or chunk_hash(chunk),
+            "hasCode": chunk["metadata"].get("has_code", False),
+            "chapterNumber": chunk["metadata"].get("chapter_number", ""),
+            "chapterTitle": chunk["metadata"].get("chapter_title", ""),
+            "codeBlocks": code_blocks,
+            "codeLanguages": code_languages
+        }
+        
+        # Add section info if available
+        if "section_number" in chunk["metadata"]:
+            properties["sectionNumber"] = chunk["metadata"]["section_number"]
+        if "section_title" in chunk["metadata"]:
+            properties["sectionTitle"] = chunk["metadata"]["section_title"]
+        
+        # Add page range if available
+        if "page_start" in chunk["metadata"]:
+            properties["pageStart"] = chunk["metadata"]["page_start"]
+        if "page_end" in chunk["metadata"]:
+            properties["pageEnd"] = chunk["metadata"]["page_end"]
+        
+        return properties
+    
+    def add_chunks(self, chunks, checkpoint=None, rejected=None):
+        """Upsert chunks into Weaviate in concurrent, adaptively sized batches.
+
+        Chunks may be any iterable, including a generator that is still
+        producing them; each batch is sent as soon as it fills up. Object
+        IDs are derived from the chunk hashes, so re-sending a chunk
+        overwrites it instead of duplicating it. Written hashes are recorded
+        in the checkpoint, if one is given, and the hashes of chunks Weaviate
+        rejected are added to the `rejected` set. In client vector mode the chunks
+        are embedded here (or taken from the vector cache) and uploaded with
+        their vectors.
+        """
+        writer = AdaptiveBatchWriter(
+            self.weaviate_url,
+            self.class_name,
+            api_key=self.weaviate_api_key,
+            batch_size=self.batch_size,
+            concurrency=self.concurrency,
+            max_concurrency=self.max_concurrency,
+            target_latency=self.target_latency,
+            on_written=checkpoint.record if checkpoint else None,
+            on_rejected=rejected.update if rejected is not None else None
+        )
+        
+        properties = map(self.chunk_properties, tqdm(chunks, desc="Ingesting chunks"))
+        
+        if self.vector_mode != "client":
+            count = writer.write((props["chunkHash"], props, None) for props in properties)
+            logger.info(f"Final batch size {writer.batch_size}, concurrency {writer.concurrency}")
+            return count
+        
+        embedder = ChunkEmbedder(
+            VectorCache(self.vector_cache_dir, self.embedding_model),
+            model_name=self.embedding_model,
+            batch_size=self.embed_batch_size,
+            workers=self.embed_workers
+        )
+        try:
+            count = writer.write(
+                (props["chunkHash"], props, vector)
+                for props, vector in embedder.embed_chunks(properties, key=lambda props: props["chunkHash"])
+            )
+        finally:
+            embedder.close()
+        logger.info(f"Final batch size {writer.batch_size}, concurrency {writer.concurrency}; "
+                    f"{embedder.embedded} chunks embedded, {embedder.cached} vectors from cache")
+        return count
+    
+    def delete_chunks(self, chunk_hashes):
+        """Delete the objects of the given chunk hashes from Weaviate."""
+        chunk_hashes = list(chunk_hashes)
+        for i in range(0, len(chunk_hashes), 100):
+            self.client.batch.delete_objects(
+                class_name=self.class_name,
+                where={
+                    "path": ["chunkHash"],
+                    "operator": "ContainsAny",
+                    "valueTextArray": chunk_hashes[i:i + 100]
+                }
+            )
+        logger.info(f"Deleted {len(chunk_hashes)} stale chunks from Weaviate")
+    
     def ingest_chunks(self, chunks_file):
         """Ingest chunks from the processed file into Weaviate."""
         try:
-            with open(chunks_file, 'r') as f:
-                chunks = json.load(f)
-            
-            logger.info(f"Loaded {len(chunks)} chunks from {chunks_file}")
+            logger.info(f"Streaming chunks from {chunks_file}")
             
-            # Batch import for better performance
-            with self.client.batch as batch:
-                batch.batch_size = 50
-                
-                for i, chunk in enumerate(tqdm(chunks, desc="Ingesting chunks")):
-                    # Extract code blocks and languages
-                    code_blocks = []
-                    code_languages = []
-                    for code_block in chunk.get("code_blocks", []):
-                        code_blocks.append(code_block["code"])
-                        code_languages.append(code_block["language"])
-                    
-                    # Prepare properties
-                    properties = {
-                        "content": chunk["content"],
-                        "hasCode": chunk["metadata"].get("has_code", False),
-                        "chapterNumber": chunk["metadata"].get("chapter_number", ""),
-                        "chapterTitle": chunk["metadata"].get("chapter_title", ""),
-                        "codeBlocks": code_blocks,
-                        "codeLanguages": code_languages
-                    }
-                    
-                    # Add section info if available
-                    if "section_number" in chunk["metadata"]:
-                        properties["sectionNumber"] = chunk["metadata"]["section_number"]
-                    if "section_title" in chunk["metadata"]:
-                        properties["sectionTitle"] = chunk["metadata"]["section_title"]
-                    
-                    # Add to batch
-                    batch.add_data_object(
-                        data_object=properties,
-                        class_name="RuppertContent"
-                    )
+            count = self.add_chunks(read_chunks(chunks_file))
             
-            logger.info(f"Successfully ingested {len(chunks)} chunks into Weaviate")
+            logger.info(f"Successfully ingested {count} chunks into Weaviate")
         except Exception as e:
             logger.error(f"Failed to ingest chunks: {e}")
             raise
+    
+    def sync_chunks(self, chunks, output_dir):
+        """Bring Weaviate in line with a stream of chunks, sending only the difference.
+
+        The manifest's ingested_chunks list records what the last successful
+        ingestion stored in the active class, and the checkpoint what an
+        interrupted run managed to write. New or changed chunks are upserted
+        as they arrive and chunks that no longer exist are deleted once the
+        stream ends, in place. Without either record (or without an active
+        class) a new class version is built while the webapp keeps serving
+        the active one, and the webapp is switched over once it is complete.
+        """
+        manifest = load_manifest(output_dir)
+        checkpoint = IngestCheckpoint(output_dir)
+        active = self.registry.active_class()
+        building = manifest.get("building_class")
+        current_hashes = []
+        
+        def track(chunks):
+            for chunk in chunks:
+                current_hashes.append(chunk["metadata"].get("chunk_hash") or chunk_hash(chunk))
+                yield chunk
+        
+        if checkpoint.exists() and building and self.class_exists(building):
+            written = checkpoint.load()
+            logger.info(f"Resuming interrupted build of {building}, {len(written)} chunks already written")
+            self.class_name = building
+            ingested = written
+        elif checkpoint.exists() and not building and active and self.class_exists(active):
+            written = checkpoint.load()
+            logger.info(f"Resuming interrupted update of {active}, {len(written)} chunks already written")
+            self.class_name = active
+            ingested = set(manifest.get("ingested_chunks", [])) | written
+        elif "ingested_chunks" in manifest and active and self.class_exists(active):
+            self.class_name = active
+            building = None
+            ingested = set(manifest["ingested_chunks"])
+            checkpoint.start()
+        else:
+            building = self.registry.next_class()
+            logger.info(f"Building new index version {building}, still serving {active}")
+            self.class_name = building
+            self.create_schema(building)
+            checkpoint.clear()
+            manifest["building_class"] = building
+            save_manifest(output_dir, manifest)
+            ingested = set()
+            checkpoint.start()
+        
+        rejected = set()
+        added = self.add_chunks(
+            (chunk for chunk in track(chunks) if current_hashes[-1] not in ingested),
+            checkpoint,
+            rejected
+        )
+        removed = ingested - set(current_hashes)
+        if removed:
+            self.delete_chunks(removed)
+        
+        logger.info(f"{added} new or changed chunks, {len(removed)} removed, "
+                    f"{len(current_hashes) - added - len(rejected)} unchanged")
+        if rejected:
+            logger.warning(f"{len(rejected)} chunks were rejected by Weaviate; the next run retries them")
+        
+        # Re-read the manifest, the processor may have updated it meanwhile.
+        # Rejected chunks are left out, so that the next run sends them again
+        manifest = load_manifest(output_dir)
+        manifest["ingested_chunks"] = [h for h in current_hashes if h not in rejected]
+        manifest.pop("building_class", None)
+        save_manifest(output_dir, manifest)
+        checkpoint.clear()
+        
+        if building:
+            self.registry.activate(building)
+            self.registry.collect_garbage(keep=self.keep_versions)
+        else:
+            self.registry.touch()
 
 def main():
     """Main function to run the ingestion process."""
     # Define paths
-    chunks_file = "/data/output/chunks.json"
+    pdf_path = "/data/ruppert.pdf"
+    output_dir = "/data/output"
+    chunks_file = os.path.join(output_dir, CHUNKS_FILE)
+    legacy_chunks_file = os.path.join(output_dir, "chunks.json")
     
-    # Check if chunks file exists
-    if not os.path.exists(chunks_file):
+    # (Re)process the PDF and ingest chunks while they are being produced;
+    # the manifest makes processing a no-op when nothing changed
+    if os.path.exists(pdf_path):
+        logger.info(f"Found PDF at {pdf_path}, extracting content...")
+        workers = int(os.getenv("PDF_EXTRACT_WORKERS", 0))
+        processor = PDFProcessor(
+            pdf_path,
+            output_dir,
+            workers=workers,
+            min_tokens=int(os.getenv("CHUNK_MIN_TOKENS", 64)),
+            max_tokens=int(os.getenv("CHUNK_MAX_TOKENS", 384)),
+            overlap_tokens=int(os.getenv("CHUNK_OVERLAP_TOKENS", 48))
+        )
+        chunks = processor.process_stream()
+    elif os.path.exists(chunks_file):
+        chunks = read_chunks(chunks_file)
+    elif os.path.exists(legacy_chunks_file):
+        chunks = read_chunks(legacy_chunks_file)
+    else:
         logger.error(f"Chunks file not found: {chunks_file}")
-        # Try to extract the PDF first
-        pdf_path = "/data/ruppert.pdf"
-        output_dir = "/data/output"
-        
-        if os.path.exists(pdf_path):
-            logger.info(f"Found PDF at {pdf_path}, extracting content...")
-            from extract_pdf import PDFProcessor
-            processor = PDFProcessor(pdf_path, output_dir)
-            processor.process()
-        else:
-            logger.error(f"PDF file not found: {pdf_path}")
-            return
+        logger.error(f"PDF file not found: {pdf_path}")
+        return
     
     # Initialize and run the ingestor
     ingestor = WeaviateIngestor()
-    ingestor.create_schema()
-    ingestor.ingest_chunks(chunks_file)
+    ingestor.sync_chunks(chunks, output_dir)
+    
+    # Rebuild the webapp's lexical index from the chunks just ingested
+    index_dir = os.getenv("BM25_INDEX_DIR", os.path.join(output_dir, "bm25"))
+    source_file = chunks_file if os.path.exists(chunks_file) else legacy_chunks_file
+    build_bm25_index(read_chunks(source_file), index_dir, ingestor.chunk_properties)
     
     logger.info("Ingestion process completed successfully")
 
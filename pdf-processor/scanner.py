@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Structural Scanner for Ruppert's Book
+-------------------------------------
+Finds chapters, sections, code blocks and paragraph boundaries in the
+extracted text, running each pattern over the part of the text it applies
+to, in place, instead of over sliced copies.
+"""
+
+import re
+
+# Patterns shared with the PDFProcessor methods
+CHAPTER_PATTERN = re.compile(r'Chapter\s+(\d+)[.\s]+([^\n]+)', re.IGNORECASE)
+SECTION_PATTERN = re.compile(r'(\d+\.\d+)[.\s]+([^\n]+)')
+R_CODE_PATTERN = re.compile(r'```r\s*(.*?)\s*```|> (.*?)(\n\n|\Z)', re.DOTALL)
+PYTHON_CODE_PATTERN = re.compile(r'```python\s*(.*?)\s*```|>>> (.*?)(\n\n|\Z)', re.DOTALL)
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\s*\n')
+
+class StructureScanner:
+    """Scan extracted text for its structure without copying it.
+
+    Every pattern is run over the original string with pos/endpos bounds
+    instead of over sliced substrings, and each region of the text is
+    visited once per pattern, so the scan is linear in the size of the
+    text. The result matches PDFProcessor.identify_chapters_and_sections,
+    with two additions: each section carries the code blocks that
+    detect_code_blocks would find in it, and chapters without sections
+    carry the absolute spans of their paragraphs.
+    """
+
+    def __init__(self, content):
+        """Initialize the scanner with the full text."""
+        self.content = content
+
+    def scan(self):
+        """Return the chapters of the text with their sections and code blocks."""
+        chapter_matches = list(CHAPTER_PATTERN.finditer(self.content))
+        chapters = []
+
+        for i, match in enumerate(chapter_matches):
+            start = match.start()
+            end = chapter_matches[i + 1].start() if i + 1 < len(chapter_matches) else len(self.content)
+            chapter = {
+                "number": match.group(1),
+                "title": match.group(2).strip(),
+                "start_position": start,
+                "end_position": end,
+                "sections": self.scan_sections(start, end)
+            }
+            if not chapter["sections"]:
+                chapter["paragraphs"] = self.paragraph_spans(start, end)
+            chapters.append(chapter)
+
+        return chapters
+
+    def scan_sections(self, start, end):
+        """Find the sections between two positions, with their code blocks."""
+        sections = []
+        for match in SECTION_PATTERN.finditer(self.content, start, end):
+            sections.append({
+                "number": match.group(1),
+                "title": match.group(2).strip(),
+                "start_position": match.start()
+            })
+
+        # Each section ends where the next one starts, the last one at the end
+        for i, section in enumerate(sections):
+            section["end_position"] = sections[i + 1]["start_position"] if i + 1 < len(sections) else end
+            section["code_blocks"] = self.code_blocks(section["start_position"], section["end_position"])
+
+        return sections
+
+    def code_blocks(self, start, end):
+        """Find code blocks between two positions.
+
+        Block positions are relative to start, as detect_code_blocks reports
+        them for the equivalent substring.
+        """
+        code_blocks = []
+        for language, pattern in (("r", R_CODE_PATTERN), ("python", PYTHON_CODE_PATTERN)):
+            for match in pattern.finditer(self.content, start, end):
+                code = match.group(1) or match.group(2)
+                if code:
+                    code_blocks.append({
+                        "language": language,
+                        "code": code.strip(),
+                        "start": match.start() - start,
+                        "end": match.end() - start
+                    })
+        return code_blocks
+
+    def paragraph_spans(self, start, end):
+        """Return the (start, end) spans of the paragraphs between two positions."""
+        spans = []
+        paragraph_start = start
+        for match in PARAGRAPH_BREAK_PATTERN.finditer(self.content, start, end):
+            spans.append((paragraph_start, match.start()))
+            paragraph_start = match.end()
+        spans.append((paragraph_start, end))
+        return spans
+
+def scan_structure(content):
+    """Scan text for chapters, sections, code blocks and paragraphs."""
+    return StructureScanner(content).scan()
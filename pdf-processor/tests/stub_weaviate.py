@@ -0,0 +1,66 @@
+"""A local stand-in for Weaviate's REST batch endpoint."""
+
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubWeaviate:
+    """Serves POST /v1/batch/objects, storing objects by ID.
+
+    A fraction of requests fail with a 503 before anything is stored, and
+    objects whose content contains `reject` are rejected one by one, the
+    way Weaviate reports per-object errors.
+    """
+
+    def __init__(self, failure_rate=0.0, reject="REJECT", seed=0):
+        self.failure_rate = failure_rate
+        self.reject = reject
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.writes = {}
+        self.requests = 0
+        self.failures = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, results = stub.handle(body["objects"])
+                data = json.dumps(results).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def handle(self, objects):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.failure_rate:
+                self.failures += 1
+                return 503, {"error": "unavailable"}
+            results = []
+            for obj in objects:
+                if self.reject in obj["properties"].get("content", ""):
+                    results.append({"id": obj["id"], "result": {"errors": {"error": [{"message": "invalid"}]}}})
+                    continue
+                self.objects[obj["id"]] = obj
+                self.writes[obj["id"]] = self.writes.get(obj["id"], 0) + 1
+                results.append({"id": obj["id"], "result": {}})
+            return 200, results
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
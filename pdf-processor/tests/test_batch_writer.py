@@ -0,0 +1,47 @@
+import pytest
+
+import batch_writer
+from batch_writer import AdaptiveBatchWriter, chunk_uuid
+from stub_weaviate import StubWeaviate
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(batch_writer.time, "sleep", lambda seconds: None)
+
+def objects(count, rejected=()):
+    for i in range(count):
+        content = f"chunk {i} REJECT" if i in rejected else f"chunk {i}"
+        yield f"hash-{i}", {"content": content}, None
+
+def test_every_object_lands_exactly_once_despite_failures():
+    with StubWeaviate(failure_rate=0.1) as stub:
+        written = []
+        writer = AdaptiveBatchWriter(stub.url, "Test", max_batch_size=50, on_written=written.extend)
+        assert writer.write(objects(5000)) == 5000
+    assert stub.failures > 0
+    assert len(stub.objects) == 5000
+    assert set(stub.writes.values()) == {1}
+    assert sorted(written) == sorted(f"hash-{i}" for i in range(5000))
+
+def test_batch_size_grows_while_batches_are_fast():
+    with StubWeaviate() as stub:
+        writer = AdaptiveBatchWriter(stub.url, "Test", batch_size=50, max_batch_size=500)
+        writer.write(objects(5000))
+    assert writer.batch_size == 500
+
+def test_rejected_objects_are_reported_and_not_counted_as_written():
+    with StubWeaviate() as stub:
+        written, rejected = [], []
+        writer = AdaptiveBatchWriter(stub.url, "Test", on_written=written.extend, on_rejected=rejected.extend)
+        assert writer.write(objects(200, rejected={3, 150})) == 198
+    assert sorted(rejected) == ["hash-150", "hash-3"]
+    assert writer.failed == 2
+    assert "hash-3" not in written
+    assert chunk_uuid("hash-3") not in stub.objects
+
+def test_rewriting_an_object_keeps_its_id():
+    with StubWeaviate() as stub:
+        AdaptiveBatchWriter(stub.url, "Test").write(objects(10))
+        AdaptiveBatchWriter(stub.url, "Test").write(objects(10))
+    assert len(stub.objects) == 10
+    assert set(stub.writes.values()) == {2}
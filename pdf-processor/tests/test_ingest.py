@@ -0,0 +1,66 @@
+import pytest
+
+import batch_writer
+from extract_pdf import load_manifest, save_manifest
+from ingest import WeaviateIngestor
+from stub_weaviate import StubWeaviate
+
+class FakeRegistry:
+    def active_class(self):
+        return "Test"
+
+    def touch(self):
+        pass
+
+class FakeClient:
+    """The weaviate.Client calls made by an in-place update."""
+
+    class schema:
+        @staticmethod
+        def exists(class_name):
+            return True
+
+    class batch:
+        @staticmethod
+        def delete_objects(**kwargs):
+            pass
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(batch_writer.time, "sleep", lambda seconds: None)
+
+def make_ingestor(url):
+    ingestor = WeaviateIngestor.__new__(WeaviateIngestor)
+    ingestor.weaviate_url = url
+    ingestor.weaviate_api_key = None
+    ingestor.batch_size = 10
+    ingestor.concurrency = 2
+    ingestor.max_concurrency = 4
+    ingestor.target_latency = 2.0
+    ingestor.vector_mode = "weaviate"
+    ingestor.keep_versions = 1
+    ingestor.client = FakeClient()
+    ingestor.registry = FakeRegistry()
+    ingestor.class_name = "Test"
+    return ingestor
+
+def chunks(texts):
+    return [{"content": text, "metadata": {"chunk_hash": f"hash-{i}"}} for i, text in enumerate(texts)]
+
+def test_rejected_chunks_are_not_recorded_as_ingested(tmp_path):
+    save_manifest(tmp_path, {"ingested_chunks": []})
+    texts = [f"chunk {i}" for i in range(30)]
+    texts[7] = "chunk 7 REJECT"
+
+    with StubWeaviate() as stub:
+        make_ingestor(stub.url).sync_chunks(chunks(texts), tmp_path)
+    ingested = load_manifest(tmp_path)["ingested_chunks"]
+    assert "hash-7" not in ingested
+    assert len(ingested) == 29
+
+    # Once Weaviate accepts it, the next run sends only the rejected chunk
+    texts[7] = "chunk 7"
+    with StubWeaviate() as stub:
+        make_ingestor(stub.url).sync_chunks(chunks(texts), tmp_path)
+    assert len(stub.objects) == 1
+    assert len(load_manifest(tmp_path)["ingested_chunks"]) == 30
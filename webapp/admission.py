@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Admission Control for Cerebras RAG
+----------------------------------
+Limits how many requests the webapp sends to a backend at once and queues
+the rest in arrival order.
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    """Raised when a request arrives while the queue is at capacity."""
+
+class QueueTimeout(Exception):
+    """Raised when a request waited in the queue for longer than allowed."""
+
+class AdmissionQueue:
+    """A FIFO queue in front of a backend with at most `limit` requests in flight.
+
+    A finished request hands its slot directly to the oldest waiter, so
+    requests are served in arrival order. Waiters report their position
+    through a callback whenever it changes. Requests are rejected when
+    max_waiting are already queued, and give up after max_wait seconds.
+    Under eventlet's monkey patching the lock and events are green, so
+    waiting blocks only the waiting greenlet.
+    """
+
+    def __init__(self, name, limit, max_waiting=500, max_wait=120, poll_interval=1.0):
+        """Initialize the queue for a named backend."""
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = deque()
+
+    def position(self, ticket):
+        """Return the 1-based position of a waiting ticket, or 0 if it was admitted."""
+        with self.lock:
+            try:
+                return self.waiting.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    @contextmanager
+    def slot(self, on_position=None):
+        """Hold a slot for the duration of the with-block, waiting for one if needed.
+
+        on_position(n) is called with the queue position while waiting.
+        """
+        ticket = threading.Event()
+        with self.lock:
+            if self.active < self.limit and not self.waiting:
+                self.active += 1
+                ticket.set()
+            elif len(self.waiting) >= self.max_waiting:
+                raise QueueFull(f"{self.name} queue is full ({self.max_waiting} waiting)")
+            else:
+                self.waiting.append(ticket)
+
+        if not ticket.is_set():
+            try:
+                self._wait(ticket, on_position)
+            except BaseException:
+                # Whatever interrupted the wait (a timeout, a failing
+                # on_position, the greenlet being killed), the ticket must
+                # not keep or later take a slot
+                with self.lock:
+                    if ticket in self.waiting:
+                        self.waiting.remove(ticket)
+                        handed_over = False
+                    else:
+                        handed_over = ticket.is_set()
+                if handed_over:
+                    self._release()
+                raise
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _wait(self, ticket, on_position):
+        """Wait for a slot to be handed to ticket, reporting position changes."""
+        deadline = time.monotonic() + self.max_wait
+        reported = None
+        while True:
+            position = self.position(ticket)
+            if position and position != reported and on_position:
+                on_position(position)
+                reported = position
+            if ticket.wait(self.poll_interval):
+                return
+            if time.monotonic() >= deadline:
+                with self.lock:
+                    if ticket in self.waiting:
+                        self.waiting.remove(ticket)
+                        raise QueueTimeout(f"Waited more than {self.max_wait}s for {self.name}")
+                # The slot was handed over while timing out; use it
+
+    def _release(self):
+        """Hand the slot to the oldest waiter, or free it."""
+        with self.lock:
+            if self.waiting:
+                self.waiting.popleft().set()
+            else:
+                self.active -= 1
+
+    def stats(self):
+        """Return the number of requests in flight and waiting."""
+        with self.lock:
+            return {"active": self.active, "waiting": len(self.waiting), "limit": self.limit}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Answer Cache for Cerebras RAG
+-----------------------------
+Serves answers to repeated questions from Redis, either for the same
+question or for a question with nearly the same meaning.
+"""
+
+import json
+import time
+import hashlib
+import logging
+import operator
+import threading
+
+import redis
+import requests
+
+from retrieval import normalize_question, unit_vector, encode_vector, decode_vector
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = "answer:stats"
+
+def best_match(vector, candidates):
+    """Return the (hash, similarity) of the candidate vector closest to vector."""
+    best_hash, best_similarity = None, -1.0
+    for question_hash, cached in candidates:
+        similarity = sum(map(operator.mul, vector, cached))
+        if similarity > best_similarity:
+            best_hash, best_similarity = question_hash, similarity
+    return best_hash, best_similarity
+
+class AnswerCache:
+    """Two-tier cache of answers and their sources, scoped to an index generation.
+
+    The exact tier is keyed by the hash of the normalized question. The
+    semantic tier keeps the unit vector of every cached question; a question
+    whose cosine similarity to a cached one reaches similarity_threshold is
+    served that question's answer. Entries expire after ttl seconds, and
+    once there are more than max_entries the least recently used ones are
+    evicted. All keys carry the index generation, which the pdf-processor
+    bumps on every index change, so a rebuilt index never serves stale
+    answers; the previous generation's keys are deleted when a new
+    generation is first seen.
+
+    Redis layout, per generation G:
+      answer:G:entry:<hash>   JSON {question, answer, sources}, with a TTL
+      answer:G:lru            sorted set of hashes by last use
+      answer:G:added          sorted set of hashes by insertion sequence
+      answer:G:seq            insertion sequence counter
+      answer:G:vectors        hash of question vectors by hash
+
+    Every process mirrors the vectors in memory and only fetches the ones
+    added since its last lookup.
+    """
+
+    def __init__(self, redis_client, vectorizer=None, ttl=86400, max_entries=1000,
+                 similarity_threshold=0.95, offload=None):
+        """Initialize the cache; without a vectorizer only the exact tier is used.
+
+        offload(function, *args) runs the CPU-bound similarity scan, for
+        example on a thread pool; by default it runs inline.
+        """
+        self.redis_client = redis_client
+        self.offload = offload or (lambda function, *args: function(*args))
+        self.vectorizer = vectorizer
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.lock = threading.Lock()
+        self.generation = None
+        self.vectors = {}
+        self.last_seq = 0
+
+    def key(self, generation, name):
+        """Return the Redis key of a per-generation structure."""
+        return f"answer:{generation}:{name}"
+
+    def get(self, question, generation):
+        """Look up a question.
+
+        Returns (entry, vector): the cached entry (or None) and the
+        question's vector, which put() reuses for the same question.
+        """
+        generation = str(generation)
+        question_hash = hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+        vector = None
+        try:
+            self._switch_generation(generation)
+
+            entry = self._load(generation, question_hash)
+            if entry is not None:
+                self._count("exact_hits")
+                return entry, None
+
+            if self.vectorizer is not None and self.similarity_threshold > 0:
+                vector = unit_vector(self.vectorizer.vectorize(question))
+                match_hash, similarity = self._nearest(generation, vector)
+                if match_hash is not None and similarity >= self.similarity_threshold:
+                    entry = self._load(generation, match_hash, dangling=True)
+                    if entry is not None:
+                        logger.info(f"Semantic cache hit ({similarity:.3f}) for: {question}")
+                        self._count("semantic_hits")
+                        return entry, vector
+
+            self._count("misses")
+        except (redis.RedisError, requests.RequestException) as e:
+            logger.error(f"Error reading answer cache: {e}")
+        return None, vector
+
+    def put(self, question, generation, answer, sources, vector=None):
+        """Cache the answer to a question, evicting the least recently used entries."""
+        generation = str(generation)
+        question_hash = hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+        entry = {"question": question, "answer": answer, "sources": sources}
+        try:
+            if vector is None and self.vectorizer is not None and self.similarity_threshold > 0:
+                vector = unit_vector(self.vectorizer.vectorize(question))
+
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.set(self.key(generation, f"entry:{question_hash}"), json.dumps(entry), ex=self.ttl)
+            pipe.zadd(self.key(generation, "lru"), {question_hash: time.time()})
+            if vector is not None:
+                # A sequence number lets other processes fetch only new vectors
+                seq = self.redis_client.incr(self.key(generation, "seq"))
+                pipe.hset(self.key(generation, "vectors"), question_hash, encode_vector(vector))
+                pipe.zadd(self.key(generation, "added"), {question_hash: seq})
+            for name in ("lru", "added", "seq", "vectors"):
+                pipe.expire(self.key(generation, name), self.ttl)
+            pipe.execute()
+
+            self._evict(generation)
+        except (redis.RedisError, requests.RequestException) as e:
+            logger.error(f"Error writing answer cache: {e}")
+
+    def stats(self):
+        """Return the hit and miss counters."""
+        counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+        counters.update({name: int(value) for name, value in self.redis_client.hgetall(STATS_KEY).items()})
+        lookups = sum(counters.values())
+        counters["hit_rate"] = (counters["exact_hits"] + counters["semantic_hits"]) / lookups if lookups else 0.0
+        return counters
+
+    def _count(self, counter):
+        """Increment a hit/miss counter."""
+        self.redis_client.hincrby(STATS_KEY, counter, 1)
+
+    def _load(self, generation, question_hash, dangling=False):
+        """Return a cached entry and mark it as recently used.
+
+        With dangling=True the hash came from the semantic tier, and if its
+        entry has expired it is removed from the other structures too.
+        """
+        data = self.redis_client.get(self.key(generation, f"entry:{question_hash}"))
+        if data is None:
+            if dangling:
+                self._forget(generation, [question_hash])
+            return None
+        self.redis_client.zadd(self.key(generation, "lru"), {question_hash: time.time()})
+        return json.loads(data)
+
+    def _evict(self, generation):
+        """Evict the least recently used entries beyond max_entries."""
+        lru = self.key(generation, "lru")
+        excess = self.redis_client.zcard(lru) - self.max_entries
+        if excess > 0:
+            evicted = [question_hash for question_hash, _ in self.redis_client.zpopmin(lru, excess)]
+            self._forget(generation, evicted)
+
+    def _forget(self, generation, hashes):
+        """Remove entries from every structure of a generation."""
+        if not hashes:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.delete(*[self.key(generation, f"entry:{question_hash}") for question_hash in hashes])
+        pipe.zrem(self.key(generation, "lru"), *hashes)
+        pipe.zrem(self.key(generation, "added"), *hashes)
+        pipe.hdel(self.key(generation, "vectors"), *hashes)
+        pipe.execute()
+        with self.lock:
+            if generation == self.generation:
+                for question_hash in hashes:
+                    self.vectors.pop(question_hash, None)
+
+    def _switch_generation(self, generation):
+        """Reset the local mirror, and delete the old generation, when the index changes."""
+        with self.lock:
+            previous = self.generation
+            if previous == generation:
+                return
+            self.generation = generation
+            self.vectors = {}
+            self.last_seq = 0
+
+        if previous is not None:
+            stale = self.redis_client.zrange(self.key(previous, "lru"), 0, -1)
+            for start in range(0, len(stale), 500):
+                self.redis_client.delete(*[self.key(previous, f"entry:{question_hash}")
+                                           for question_hash in stale[start:start + 500]])
+            self.redis_client.delete(*[self.key(previous, name) for name in ("lru", "added", "seq", "vectors")])
+            logger.info(f"Index generation changed to {generation}, dropped cached answers of {previous}")
+
+    def _nearest(self, generation, vector):
+        """Return the cached question most similar to vector, and its similarity."""
+        self._sync(generation)
+        with self.lock:
+            candidates = list(self.vectors.items())
+        return self.offload(best_match, vector, candidates)
+
+    def _sync(self, generation):
+        """Fetch the vectors added by any process since the last sync."""
+        added = self.redis_client.zrangebyscore(self.key(generation, "added"),
+                                                f"({self.last_seq}", "+inf", withscores=True)
+        if not added:
+            return
+        hashes = [question_hash for question_hash, _ in added]
+        encoded = self.redis_client.hmget(self.key(generation, "vectors"), hashes)
+        with self.lock:
+            if generation != self.generation:
+                return
+            for question_hash, data in zip(hashes, encoded):
+                if data is not None:
+                    self.vectors[question_hash] = decode_vector(data)
+            self.last_seq = max(self.last_seq, int(added[-1][1]))
+            if len(self.vectors) <= self.max_entries:
+                return
+
+        # Other processes have evicted entries; keep only the live ones
+        live = set(self.redis_client.hkeys(self.key(generation, "vectors")))
+        with self.lock:
+            if generation == self.generation:
+                self.vectors = {question_hash: vector for question_hash, vector in self.vectors.items()
+                                if question_hash in live}
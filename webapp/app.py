@@ -6,17 +6,22 @@ Provides a chat interface with authentication for querying Ruppert's book
 using Cerebras inference and Weaviate.
 """
 
+# Patch sockets, locks and sleeps before anything else is imported, so that
+# every network call (Redis, Weaviate, Cerebras) yields to other users
+import eventlet
+eventlet.monkey_patch()
+
 import os
 import json
+import time
 import uuid
+import hashlib
 import logging
-import requests
 from datetime import datetime, timedelta
 from functools import wraps
 
-import weaviate
 import redis
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, session, flash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_socketio import SocketIO, emit
 from flask_wtf import FlaskForm
@@ -24,6 +29,18 @@ from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Email, Length
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
+from eventlet import tpool
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+from retrieval import WeaviateClientPool, TextVectorizer, RetrievalCache, Retriever
+from answer_cache import AnswerCache
+from prompt_builder import PromptBuilder, estimate_tokens
+from lexical import LocalIndex
+from reranker import Reranker, LexicalScorer, CrossEncoderScorer
+from admission import AdmissionQueue, QueueFull, QueueTimeout
+from upstream import UpstreamClient, CircuitBreaker
+from metrics import (STAGE_SECONDS, PROMPT_TOKENS, QUESTIONS, ANSWER_CACHE_LOOKUPS,
+                     register_counter_callback, watch_queue, watch_upstream)
 
 # Load environment variables
 load_dotenv()
@@ -106,20 +123,290 @@ class RegistrationForm(FlaskForm):
 def load_user(user_id):
     return get_user_by_id(user_id)
 
-# Weaviate client
-def get_weaviate_client():
-    weaviate_url = os.getenv('WEAVIATE_URL', 'http://weaviate:8080')
-    weaviate_api_key = os.getenv('WEAVIATE_API_KEY')
-    
-    auth_config = weaviate.auth.AuthApiKey(api_key=weaviate_api_key) if weaviate_api_key else None
+# Conversation storage: a Redis list of JSON messages per conversation, a
+# per-user sorted set of conversation IDs by last activity, and a small
+# metadata hash per conversation, all maintained on write
+CONVERSATION_TTL = 60 * 60 * 24 * 30  # 30 days
+HISTORY_WINDOW = max(1, int(os.getenv('HISTORY_WINDOW', 20)))  # Recent messages read for the prompt
+HISTORY_DISPLAY_LIMIT = max(1, int(os.getenv('HISTORY_DISPLAY_LIMIT', 200)))  # Messages shown in the UI
+CONVERSATION_PAGE_SIZE = 50
+
+def conversation_keys(user_id, conversation_id):
+    """Return the Redis keys of a conversation's messages and metadata."""
+    return f"conversation:{user_id}:{conversation_id}", f"conversation_meta:{user_id}:{conversation_id}"
+
+def append_message(user_id, conversation_id, message, read_history=False):
+    """Append a message and update the conversation index in one pipelined transaction.
+    
+    Returns the new length of the conversation and, with read_history, its
+    last HISTORY_WINDOW messages (including the new one), read in the same
+    round trip.
+    """
+    conversation_key, meta_key = conversation_keys(user_id, conversation_id)
+    index_key = f"conversations:{user_id}"
+    
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.rpush(conversation_key, json.dumps(message))
+    pipe.expire(conversation_key, CONVERSATION_TTL)
+    pipe.zadd(index_key, {conversation_id: time.time()})
+    pipe.expire(index_key, CONVERSATION_TTL)
+    if message['role'] == 'user':
+        pipe.hsetnx(meta_key, 'title', message['content'][:50])
+    pipe.hset(meta_key, 'timestamp', message['timestamp'])
+    pipe.hincrby(meta_key, 'message_count', 1)
+    pipe.expire(meta_key, CONVERSATION_TTL)
+    if read_history:
+        pipe.lrange(conversation_key, -HISTORY_WINDOW, -1)
+    results = pipe.execute()
+    
+    history = [json.loads(item) for item in results[-1]] if read_history else []
+    return results[0], history
+
+def index_existing_conversations(user_id):
+    """Add a user's conversations from before the index to it, once.
+    
+    Uses SCAN on the user's key pattern, which does not block Redis the way
+    KEYS does.
+    """
+    marker_key = f"conversations_indexed:{user_id}"
+    if not redis_client.set(marker_key, 1, nx=True, ex=CONVERSATION_TTL):
+        return
     
-    return weaviate.Client(
-        url=weaviate_url,
-        auth_client_secret=auth_config
+    for conversation_key in redis_client.scan_iter(match=f"conversation:{user_id}:*", count=500):
+        conversation_id = conversation_key.split(':')[-1]
+        _, meta_key = conversation_keys(user_id, conversation_id)
+        
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.lindex(conversation_key, 0)
+        pipe.lindex(conversation_key, -1)
+        pipe.llen(conversation_key)
+        first_message, last_message, message_count = pipe.execute()
+        if not first_message:
+            continue
+        first_message = json.loads(first_message)
+        last_message = json.loads(last_message)
+        timestamp = last_message.get('timestamp', datetime.now().isoformat())
+        
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.zadd(f"conversations:{user_id}", {conversation_id: datetime.fromisoformat(timestamp).timestamp()})
+        pipe.expire(f"conversations:{user_id}", CONVERSATION_TTL)
+        pipe.hset(meta_key, mapping={
+            'title': first_message.get('content', 'Untitled')[:50],
+            'timestamp': timestamp,
+            'message_count': message_count
+        })
+        pipe.expire(meta_key, CONVERSATION_TTL)
+        pipe.execute()
+
+def load_summary(user_id, conversation_id):
+    """Return the running summary of a conversation's older turns.
+    
+    The summary is a dict with its text and the number of messages, from
+    the start of the conversation, that it covers.
+    """
+    summary = redis_client.hgetall(f"conversation_summary:{user_id}:{conversation_id}")
+    return {'text': summary.get('text', ''), 'covered': int(summary.get('covered', 0))}
+
+def update_summary(user_id, conversation_id, summary, history, history_start, turns_kept):
+    """Fold the turns that no longer fit in the prompt into the running summary.
+    
+    history holds the earlier messages of the conversation, starting with
+    message number history_start; the last turns_kept of them were in the
+    prompt verbatim. Messages between the end of the summary and
+    history_start slid out of the window read for the prompt while they
+    still fitted it; they are read back and folded in first, HISTORY_WINDOW
+    at a time. The summary is saved after each step.
+    """
+    conversation_key, _ = conversation_keys(user_id, conversation_id)
+    summary_key = f"conversation_summary:{user_id}:{conversation_id}"
+    end = history_start + len(history) - turns_kept
+    text, covered = summary['text'], summary['covered']
+    
+    while covered < end:
+        if covered < history_start:
+            stop = min(history_start, covered + HISTORY_WINDOW)
+            turns = [json.loads(item) for item in redis_client.lrange(conversation_key, covered, stop - 1)]
+        else:
+            stop = end
+            turns = history[covered - history_start:len(history) - turns_kept]
+        if not turns:
+            return
+        
+        try:
+            with llm_queue.slot():
+                text = query_cerebras(prompt_builder.summary_prompt(text, turns), max_tokens=SUMMARY_MAX_TOKENS).strip()
+        except (QueueFull, QueueTimeout) as e:
+            logger.warning(f"Skipped summarizing conversation {conversation_id}: {e}")
+            return
+        if not text or text.startswith('Error:'):
+            return
+        covered = stop
+        
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(summary_key, mapping={'text': text, 'covered': covered})
+        pipe.expire(summary_key, CONVERSATION_TTL)
+        pipe.execute()
+
+# Weaviate client, shared by all requests in the process
+weaviate_pool = WeaviateClientPool(
+    os.getenv('WEAVIATE_URL', 'http://weaviate:8080'),
+    api_key=os.getenv('WEAVIATE_API_KEY'),
+    pool_maxsize=int(os.getenv('WEAVIATE_POOL_SIZE', 50)),
+    timeout=(5, float(os.getenv('WEAVIATE_QUERY_TIMEOUT', 10))),
+    health_interval=int(os.getenv('WEAVIATE_HEALTH_INTERVAL', 30))
+)
+
+def get_weaviate_client():
+    return weaviate_pool.get()
+
+# Active index version; the pdf-processor switches it after a rebuild
+INDEX_ACTIVE_CLASS_KEY = "index:active_class"
+INDEX_GENERATION_KEY = "index:generation"
+INDEX_POINTER_TTL = 5  # seconds
+_active_index = {'class_name': 'RuppertContent', 'generation': '0', 'checked_at': 0.0}
+
+def refresh_active_index():
+    """Re-read the index pointer and generation from Redis every few seconds."""
+    now = time.monotonic()
+    if now - _active_index['checked_at'] > INDEX_POINTER_TTL:
+        try:
+            class_name, generation = redis_client.mget(INDEX_ACTIVE_CLASS_KEY, INDEX_GENERATION_KEY)
+            _active_index['class_name'] = class_name or 'RuppertContent'
+            _active_index['generation'] = generation or '0'
+            _active_index['checked_at'] = now
+        except redis.RedisError as e:
+            logger.error(f"Error reading active index pointer: {e}")
+
+def get_active_index():
+    """Return the Weaviate class to query."""
+    refresh_active_index()
+    return _active_index['class_name']
+
+def get_index_generation():
+    """Return the generation of the active index, bumped on every index change."""
+    refresh_active_index()
+    return _active_index['generation']
+
+def offload(function, *args):
+    """Run CPU-bound work on eventlet's native thread pool (EVENTLET_THREADPOOL_SIZE threads).
+    
+    The hub keeps serving other users meanwhile. Only pure computation may
+    be offloaded: green sockets and locks must not be used from the pool.
+    """
+    return tpool.execute(function, *args)
+
+# Admission control in front of the backends: a fixed number of requests in
+# flight, the rest queued in arrival order
+llm_queue = AdmissionQueue(
+    'Cerebras',
+    limit=int(os.getenv('LLM_MAX_CONCURRENCY', 16)),
+    max_waiting=int(os.getenv('LLM_MAX_QUEUE', 300)),
+    max_wait=int(os.getenv('LLM_QUEUE_TIMEOUT', 120))
+)
+executor_queue = AdmissionQueue(
+    'code executor',
+    limit=int(os.getenv('EXECUTOR_MAX_CONCURRENCY', 4)),
+    max_waiting=int(os.getenv('EXECUTOR_MAX_QUEUE', 100)),
+    max_wait=int(os.getenv('EXECUTOR_QUEUE_TIMEOUT', 60))
+)
+BUSY_MESSAGE = "The assistant is busy right now. Please try again in a minute."
+ERROR_MESSAGE = "I'm sorry, I encountered an error while processing your request. Please try again later."
+
+# Shared keep-alive sessions for the upstream services, with timeouts,
+# retries and a circuit breaker each
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = int(os.getenv('CIRCUIT_RESET_TIMEOUT', 30))
+cerebras_client = UpstreamClient(
+    'Cerebras API',
+    pool_maxsize=llm_queue.limit,
+    timeout=(float(os.getenv('CEREBRAS_CONNECT_TIMEOUT', 3)), float(os.getenv('CEREBRAS_READ_TIMEOUT', 60))),
+    retries=int(os.getenv('CEREBRAS_RETRIES', 2)),
+    breaker=CircuitBreaker('Cerebras API', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+)
+executor_client = UpstreamClient(
+    'code executor',
+    pool_maxsize=executor_queue.limit,
+    timeout=(float(os.getenv('EXECUTOR_CONNECT_TIMEOUT', 2)), float(os.getenv('EXECUTOR_READ_TIMEOUT', 45))),
+    retries=int(os.getenv('EXECUTOR_RETRIES', 1)),
+    breaker=CircuitBreaker('code executor', CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT),
+    retry_statuses={502, 503, 504}  # A 429 from the executor is back-pressure for the user
+)
+
+watch_queue(llm_queue, 'cerebras')
+watch_queue(executor_queue, 'code_executor')
+watch_upstream(cerebras_client, 'cerebras')
+watch_upstream(executor_client, 'code_executor')
+
+# Query vectors and top-k results are cached in-process, and optionally in Redis
+retrieval_cache = RetrievalCache(
+    max_entries=int(os.getenv('RETRIEVAL_CACHE_SIZE', 1024)),
+    redis_client=redis_client if os.getenv('RETRIEVAL_CACHE_REDIS', 'false').lower() == 'true' else None,
+    ttl=int(os.getenv('RETRIEVAL_CACHE_TTL', 60 * 60))
+)
+register_counter_callback(
+    'rag_retrieval_cache_lookups',
+    'Retrieval result cache lookups by result: hit or miss',
+    'result',
+    lambda: {'hit': retrieval_cache.hits, 'miss': retrieval_cache.misses}
+)
+
+# Queries are vectorized with the same t2v-transformers model that Weaviate uses
+query_vectorizer = TextVectorizer(os.getenv('T2V_INFERENCE_URL', 'http://t2v-transformers:8080'), cache=retrieval_cache)
+
+# BM25 index published by the pdf-processor, for hybrid search and as a
+# fallback when Weaviate is down
+lexical_index = LocalIndex(os.getenv('BM25_INDEX_DIR', '/data/bm25'))
+
+# Over-fetched candidates are re-ranked within a latency budget
+def create_reranker():
+    if os.getenv('RERANK_ENABLED', 'true').lower() != 'true':
+        return None
+    scorers = [(LexicalScorer(), 1.0)]
+    if os.getenv('RERANK_SCORER', 'lexical') == 'cross-encoder':
+        try:
+            scorers.append((CrossEncoderScorer(os.getenv('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')), 2.0))
+        except Exception as e:
+            logger.error(f"Could not load the cross-encoder, re-ranking lexically: {e}")
+    return Reranker(
+        scorers,
+        candidates=int(os.getenv('RERANK_CANDIDATES', 50)),
+        budget_ms=int(os.getenv('RERANK_BUDGET_MS', 150))
     )
 
+retriever = Retriever(
+    weaviate_pool,
+    vectorizer=query_vectorizer,
+    cache=retrieval_cache,
+    lexical=lexical_index if os.getenv('HYBRID_SEARCH', 'true').lower() == 'true' else None,
+    candidates=int(os.getenv('HYBRID_CANDIDATES', 20)),
+    reranker=create_reranker(),
+    offload=offload
+)
+
+CHUNK_PROPERTIES = ["content", "chunkHash", "chapterNumber", "chapterTitle", "sectionNumber", "sectionTitle",
+                    "pageStart", "pageEnd", "hasCode", "codeBlocks", "codeLanguages"]
+
+# Answer cache for repeated questions
+answer_cache = AnswerCache(
+    redis_client,
+    vectorizer=query_vectorizer,
+    ttl=int(os.getenv('ANSWER_CACHE_TTL', 60 * 60 * 24)),
+    max_entries=int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', 1000)),
+    similarity_threshold=float(os.getenv('ANSWER_CACHE_SIMILARITY', 0.95)),
+    offload=offload
+)
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+
+# Prompts are assembled within a token budget
+prompt_builder = PromptBuilder(
+    max_tokens=int(os.getenv('PROMPT_MAX_TOKENS', 6000)),
+    history_share=float(os.getenv('PROMPT_HISTORY_SHARE', 0.25)),
+    code_share=float(os.getenv('PROMPT_CODE_SHARE', 0.2))
+)
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', 256))
+
 # Cerebras client
-def query_cerebras(prompt, conversation_history=None):
+def query_cerebras(prompt, conversation_history=None, max_tokens=1024):
     api_key = os.getenv('CEREBRAS_API_KEY')
     api_url = os.getenv('CEREBRAS_API_URL', 'https://api.cerebras.ai/v1/text/completions')
     
@@ -139,39 +426,132 @@ def query_cerebras(prompt, conversation_history=None):
     payload = {
         'model': 'cerebras/Cerebras-GPT-4.5-8B',  # Adjust model as needed
         'prompt': prompt,
-        'max_tokens': 1024,
+        'max_tokens': max_tokens,
         'temperature': 0.2,
         'stream': False
     }
     
     try:
-        response = requests.post(api_url, headers=headers, json=payload)
+        response = cerebras_client.post(api_url, headers=headers, json=payload)
         response.raise_for_status()
         return response.json()['choices'][0]['text']
     except Exception as e:
         logger.error(f"Error querying Cerebras API: {e}")
         return f"Error: Unable to get response from Cerebras API. {str(e)}"
 
+def stream_cerebras(prompt):
+    """Yield the completion for prompt piece by piece as Cerebras streams it.
+    
+    Raises if the request fails or the stream breaks off, possibly after
+    part of the completion was yielded.
+    """
+    api_key = os.getenv('CEREBRAS_API_KEY')
+    api_url = os.getenv('CEREBRAS_API_URL', 'https://api.cerebras.ai/v1/text/completions')
+    
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream'
+    }
+    
+    payload = {
+        'model': 'cerebras/Cerebras-GPT-4.5-8B',  # Adjust model as needed
+        'prompt': prompt,
+        'max_tokens': 1024,
+        'temperature': 0.2,
+        'stream': True
+    }
+    
+    with cerebras_client.post(api_url, headers=headers, json=payload, stream=True) as response:
+        response.raise_for_status()
+        # Server-sent events: "data: {json}" lines, ending with "data: [DONE]"
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            choice = json.loads(data)['choices'][0]
+            delta = choice.get('text') or choice.get('delta', {}).get('content')
+            if delta:
+                yield delta
+
 # Code execution
-def execute_code(code, language):
+def execution_error(message):
+    """Return a finished job whose result is an error."""
+    return {
+        'status': 'done',
+        'result': {
+            'success': False,
+            'stdout': '',
+            'stderr': f"Error: {message}"
+        }
+    }
+
+def execute_code(code, language, user_id, session_id=None):
+    """Submit code to the executor's job queue.
+
+    Returns the job to poll ({job_id, status, position}), or a finished
+    job with its result if the executor had it cached.
+    """
     code_executor_url = os.getenv('CODE_EXECUTOR_URL', 'http://code-executor:5000')
     
     payload = {
         'code': code,
-        'language': language
+        'language': language,
+        'user': user_id
     }
+    if session_id:
+        payload['session_id'] = session_id
+    
+    try:
+        with executor_queue.slot():
+            response = executor_client.post(f"{code_executor_url}/jobs", json=payload)
+            if response.status_code == 429:
+                # The executor's queue is full; its answer is the result
+                return {'status': 'done', 'result': response.json()}
+            response.raise_for_status()
+            return response.json()
+    except (QueueFull, QueueTimeout) as e:
+        logger.warning(f"Turned away a code execution: {e}")
+        return execution_error(BUSY_MESSAGE)
+    except Exception as e:
+        logger.error(f"Error executing code: {e}")
+        return execution_error(f"Unable to execute code. {str(e)}")
+
+def stream_execution(job_id, user_id):
+    """Yield the events of an execution job as the executor streams them.
     
+    Events are status updates ({status, position}), output ({stream,
+    text}) and finally {status: done, result}.
+    """
+    code_executor_url = os.getenv('CODE_EXECUTOR_URL', 'http://code-executor:5000')
+    try:
+        with executor_client.get(f"{code_executor_url}/jobs/{job_id}/stream", params={'user': user_id},
+                                 stream=True) as response:
+            if response.status_code == 404:
+                yield execution_error("The execution expired. Please run the code again.")
+                return
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    yield json.loads(line)
+    except Exception as e:
+        logger.error(f"Error streaming code execution: {e}")
+        yield execution_error(f"Unable to execute code. {str(e)}")
+
+def execution_status(job_id, user_id):
+    """Return the status of an execution job, with its result once it is done."""
+    code_executor_url = os.getenv('CODE_EXECUTOR_URL', 'http://code-executor:5000')
     try:
-        response = requests.post(f"{code_executor_url}/execute", json=payload)
+        response = executor_client.get(f"{code_executor_url}/jobs/{job_id}", params={'user': user_id})
+        if response.status_code == 404:
+            return execution_error("The execution expired. Please run the code again.")
         response.raise_for_status()
         return response.json()
     except Exception as e:
-        logger.error(f"Error executing code: {e}")
-        return {
-            'success': False,
-            'stdout': '',
-            'stderr': f"Error: Unable to execute code. {str(e)}"
-        }
+        logger.error(f"Error polling code execution: {e}")
+        return execution_error(f"Unable to execute code. {str(e)}")
 
 # Routes
 @app.route('/')
@@ -219,6 +599,22 @@ def chat():
 def health():
     return jsonify({'status': 'ok'})
 
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/api/cache-stats', methods=['GET'])
+@login_required
+def get_cache_stats():
+    try:
+        stats = answer_cache.stats()
+        stats['retrieval'] = {'hits': retrieval_cache.hits, 'misses': retrieval_cache.misses}
+        stats['upstreams'] = {'cerebras': cerebras_client.stats(), 'code_executor': executor_client.stats()}
+        return jsonify(stats)
+    except redis.RedisError as e:
+        logger.error(f"Error reading cache stats: {e}")
+        return jsonify({'error': 'Cache statistics unavailable'}), 503
+
 # API endpoints
 @app.route('/api/conversation', methods=['GET'])
 @login_required
@@ -227,46 +623,58 @@ def get_conversation():
     if not conversation_id:
         return jsonify({'error': 'Conversation ID required'}), 400
     
-    # Get conversation from Redis
-    conversation_key = f"conversation:{current_user.id}:{conversation_id}"
-    if not redis_client.exists(conversation_key):
+    # Get the most recent messages from Redis in one round trip
+    conversation_key, _ = conversation_keys(current_user.id, conversation_id)
+    messages = redis_client.lrange(conversation_key, -HISTORY_DISPLAY_LIMIT, -1)
+    if not messages:
         return jsonify({'error': 'Conversation not found'}), 404
     
-    conversation = []
-    for i in range(redis_client.llen(conversation_key)):
-        message = json.loads(redis_client.lindex(conversation_key, i))
-        conversation.append(message)
+    conversation = [json.loads(message) for message in messages]
     
     return jsonify({'conversation': conversation})
 
 @app.route('/api/conversations', methods=['GET'])
 @login_required
 def get_conversations():
-    # Get all conversation IDs for the user
-    pattern = f"conversation:{current_user.id}:*"
-    conversation_keys = redis_client.keys(pattern)
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = min(max(1, request.args.get('limit', CONVERSATION_PAGE_SIZE, type=int)), 200)
+    index_key = f"conversations:{current_user.id}"
+    
+    index_existing_conversations(current_user.id)
+    
+    # Drop conversations whose messages have expired, then read one page,
+    # newest first
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zremrangebyscore(index_key, '-inf', time.time() - CONVERSATION_TTL)
+    pipe.zrevrange(index_key, offset, offset + limit - 1)
+    pipe.zcard(index_key)
+    _, conversation_ids, total = pipe.execute()
+    
+    pipe = redis_client.pipeline(transaction=False)
+    for conversation_id in conversation_ids:
+        pipe.hgetall(conversation_keys(current_user.id, conversation_id)[1])
+    metadata = pipe.execute()
     
     conversations = []
-    for key in conversation_keys:
-        conversation_id = key.split(':')[-1]
-        # Get the first message to use as title
-        first_message = json.loads(redis_client.lindex(key, 0))
-        title = first_message.get('content', 'Untitled')[:50] + '...'
-        
-        # Get timestamp of last message
-        last_message = json.loads(redis_client.lindex(key, -1))
-        timestamp = last_message.get('timestamp', datetime.now().isoformat())
-        
+    for conversation_id, meta in zip(conversation_ids, metadata):
         conversations.append({
             'id': conversation_id,
-            'title': title,
-            'timestamp': timestamp
+            'title': meta.get('title', 'Untitled') + '...',
+            'timestamp': meta.get('timestamp', datetime.now().isoformat()),
+            'messageCount': int(meta.get('message_count', 0))
         })
     
-    # Sort by timestamp, newest first
-    conversations.sort(key=lambda x: x['timestamp'], reverse=True)
+    next_offset = offset + limit if offset + limit < total else None
+    return jsonify({'conversations': conversations, 'total': total, 'next_offset': next_offset})
+
+def code_session_id(data):
+    """Return the executor session for a code execution request, or None.
     
-    return jsonify({'conversations': conversations})
+    With a session, successive runs in a conversation share their variables.
+    """
+    if data.get('session') and data.get('conversation_id'):
+        return hashlib.sha256(f"{current_user.id}:{data['conversation_id']}".encode('utf-8')).hexdigest()[:32]
+    return None
 
 @app.route('/api/execute-code', methods=['POST'])
 @login_required
@@ -278,8 +686,13 @@ def api_execute_code():
     if not code:
         return jsonify({'error': 'Code required'}), 400
     
-    result = execute_code(code, language)
-    return jsonify(result)
+    job = execute_code(code, language, str(current_user.id), code_session_id(data))
+    return jsonify(job)
+
+@app.route('/api/execute-code/<job_id>', methods=['GET'])
+@login_required
+def api_execution_status(job_id):
+    return jsonify(execution_status(job_id, str(current_user.id)))
 
 # Socket.IO events
 @socketio.on('connect')
@@ -298,98 +711,148 @@ def handle_new_conversation():
     emit('conversation_created', {'id': conversation_id})
     return conversation_id
 
-@socketio.on('message')
-def handle_message(data):
-    user_message = data.get('message')
-    conversation_id = data.get('conversation_id')
-    
-    if not user_message or not conversation_id:
-        emit('error', {'message': 'Message and conversation ID required'})
+@socketio.on('execute_code')
+def handle_execute_code(data):
+    """Run code, streaming its status and output to the client as it runs."""
+    code = data.get('code')
+    language = data.get('language', 'python')
+    if not code:
+        emit('error', {'message': 'Code required'})
         return
     
-    # Store user message
-    conversation_key = f"conversation:{current_user.id}:{conversation_id}"
-    user_message_obj = {
-        'role': 'user',
-        'content': user_message,
-        'timestamp': datetime.now().isoformat()
-    }
-    redis_client.rpush(conversation_key, json.dumps(user_message_obj))
-    
-    # Get conversation history
-    conversation = []
-    for i in range(redis_client.llen(conversation_key)):
-        message = json.loads(redis_client.lindex(conversation_key, i))
-        conversation.append(message)
-    
+    job = execute_code(code, language, str(current_user.id), code_session_id(data))
+    if job['status'] != 'done':
+        for event in stream_execution(job['job_id'], str(current_user.id)):
+            if event.get('status') == 'done':
+                job = event
+            elif 'stream' in event:
+                emit('execution_output', {'stream': event['stream'], 'text': event['text']})
+            else:
+                emit('execution_status', {'status': event['status'], 'position': event.get('position')})
+            socketio.sleep(0)  # Let the event go out before reading the next one
+    if job['status'] != 'done':
+        job = execution_error("The execution ended without a result. Please run the code again.")
+    emit('execution_result', job['result'])
+
+def generate_answer(user_message, history, summary, conversation_id):
+    """Retrieve passages for a question and stream Cerebras' answer to the client.
+    
+    Returns the answer, its sources, the number of recent turns of
+    history that fit in the prompt, and whether the answer completed. An
+    answer that did not complete ends in ERROR_MESSAGE. Raises QueueFull
+    or QueueTimeout if Cerebras has no capacity for the question.
+    """
     # Query Weaviate for relevant chunks
     try:
-        weaviate_client = get_weaviate_client()
-        query_result = weaviate_client.query.get(
-            "RuppertContent", 
-            ["content", "chapterNumber", "chapterTitle", "sectionNumber", "sectionTitle", "hasCode", "codeBlocks", "codeLanguages"]
-        ).with_near_text({
-            "concepts": [user_message]
-        }).with_limit(5).do()
-        
-        chunks = query_result['data']['Get']['RuppertContent']
+        with STAGE_SECONDS.labels('retrieval').time():
+            chunks = retriever.search(user_message, get_active_index(), get_index_generation(), CHUNK_PROPERTIES, limit=5)
     except Exception as e:
         logger.error(f"Error querying Weaviate: {e}")
         chunks = []
     
-    # Format context for Cerebras
-    context = ""
     sources = []
-    
-    for i, chunk in enumerate(chunks):
-        context += f"\nPassage {i+1}:\n"
-        
-        # Add chapter and section info
-        chapter_info = f"Chapter {chunk.get('chapterNumber', 'N/A')}: {chunk.get('chapterTitle', 'N/A')}"
-        if chunk.get('sectionNumber') and chunk.get('sectionTitle'):
-            chapter_info += f", Section {chunk.get('sectionNumber')}: {chunk.get('sectionTitle')}"
-        
-        context += f"{chapter_info}\n\n"
-        context += chunk.get('content', '') + "\n\n"
-        
-        # Add code blocks if present
-        code_blocks = chunk.get('codeBlocks', [])
-        code_languages = chunk.get('codeLanguages', [])
-        
-        for j, (code, lang) in enumerate(zip(code_blocks, code_languages)):
-            context += f"Code Example ({lang}):\n```{lang}\n{code}\n```\n\n"
-        
-        # Add to sources
+    for chunk in chunks:
         sources.append({
             'chapter': chunk.get('chapterNumber', 'N/A'),
             'chapterTitle': chunk.get('chapterTitle', 'N/A'),
             'section': chunk.get('sectionNumber', 'N/A'),
-            'sectionTitle': chunk.get('sectionTitle', 'N/A')
+            'sectionTitle': chunk.get('sectionTitle', 'N/A'),
+            'pageStart': chunk.get('pageStart'),
+            'pageEnd': chunk.get('pageEnd')
         })
     
-    # Create prompt for Cerebras
-    prompt = f"""You are a financial engineering assistant with expertise in statistics and data analysis.
-Based on the following passages from Ruppert's "Statistics and Data Analysis for Financial Engineering" book, 
-answer the user's question. Include relevant statistical formulas and code examples if available.
-
-{context}
-
-Previous conversation:
-"""
-    
-    # Add conversation history to prompt
-    for msg in conversation[:-1]:  # Exclude the current message
-        role = "User" if msg['role'] == 'user' else "Assistant"
-        prompt += f"{role}: {msg['content']}\n\n"
+    # Create prompt for Cerebras within the token budget
+    with STAGE_SECONDS.labels('prompt_build').time():
+        prompt, turns_kept = offload(prompt_builder.build, user_message, chunks, history, summary)
+    PROMPT_TOKENS.observe(offload(estimate_tokens, prompt))
     
-    prompt += f"User: {user_message}\n\nAssistant:"
+    # Query Cerebras once admitted, forwarding the answer to the client as it
+    # streams in; while queued, the client is told its position
+    def report_position(position):
+        emit('queued', {'conversation_id': conversation_id, 'position': position})
     
-    # Query Cerebras
+    response_parts = []
+    queued_at = time.monotonic()
     try:
-        response = query_cerebras(prompt)
+        with llm_queue.slot(on_position=report_position):
+            started = time.monotonic()
+            STAGE_SECONDS.labels('llm_queue_wait').observe(started - queued_at)
+            for delta in stream_cerebras(prompt):
+                if not response_parts:
+                    STAGE_SECONDS.labels('llm_first_token').observe(time.monotonic() - started)
+                response_parts.append(delta)
+                emit('message_delta', {
+                    'conversation_id': conversation_id,
+                    'delta': delta
+                })
+                socketio.sleep(0)  # Let the event go out before reading the next chunk
+            STAGE_SECONDS.labels('llm_total').observe(time.monotonic() - started)
+        response = ''.join(response_parts)
+        completed = bool(response)
+    except (QueueFull, QueueTimeout):
+        raise
     except Exception as e:
         logger.error(f"Error querying Cerebras: {e}")
-        response = "I'm sorry, I encountered an error while processing your request. Please try again later."
+        # Keep what the client was already shown
+        response = '\n\n'.join(filter(None, [''.join(response_parts), ERROR_MESSAGE]))
+        completed = False
+    if not response:
+        response = ERROR_MESSAGE
+    
+    return response, sources, turns_kept, completed
+
+@socketio.on('message')
+def handle_message(data):
+    user_message = data.get('message')
+    conversation_id = data.get('conversation_id')
+    
+    if not user_message or not conversation_id:
+        emit('error', {'message': 'Message and conversation ID required'})
+        return
+    
+    # Store user message and read the recent history in the same round trip
+    user_message_obj = {
+        'role': 'user',
+        'content': user_message,
+        'timestamp': datetime.now().isoformat()
+    }
+    with STAGE_SECONDS.labels('history_load').time():
+        conversation_length, conversation = append_message(current_user.id, conversation_id, user_message_obj, read_history=True)
+    
+    # Only standalone questions are cached: a follow-up's answer depends on
+    # the conversation before it
+    cacheable = ANSWER_CACHE_ENABLED and conversation_length == 1
+    cached, question_vector = None, None
+    if cacheable:
+        with STAGE_SECONDS.labels('answer_cache').time():
+            generation = get_index_generation()
+            cached, question_vector = answer_cache.get(user_message, generation)
+        ANSWER_CACHE_LOOKUPS.labels('miss' if not cached else 'semantic' if question_vector else 'exact').inc()
+    
+    # Earlier messages, leaving out those already rolled into the summary
+    history = conversation[:-1]
+    history_start = conversation_length - len(conversation)
+    with STAGE_SECONDS.labels('summary_load').time():
+        summary = load_summary(current_user.id, conversation_id) if history else {'text': '', 'covered': 0}
+    history = history[max(0, summary['covered'] - history_start):]
+    history_start = max(history_start, summary['covered'])
+    
+    turns_kept = len(history)
+    if cached:
+        response, sources = cached['answer'], cached['sources']
+        QUESTIONS.labels('cached').inc()
+    else:
+        try:
+            response, sources, turns_kept, completed = generate_answer(user_message, history, summary['text'], conversation_id)
+        except (QueueFull, QueueTimeout) as e:
+            logger.warning(f"Turned away a question: {e}")
+            QUESTIONS.labels('busy').inc()
+            emit('error', {'message': BUSY_MESSAGE})
+            return
+        QUESTIONS.labels('generated' if completed else 'failed').inc()
+        # Only answers that completed cleanly are worth serving again
+        if cacheable and sources and completed:
+            answer_cache.put(user_message, generation, response, sources, vector=question_vector)
     
     # Store assistant response
     assistant_message_obj = {
@@ -398,16 +861,21 @@ Previous conversation:
         'sources': sources,
         'timestamp': datetime.now().isoformat()
     }
-    redis_client.rpush(conversation_key, json.dumps(assistant_message_obj))
+    with STAGE_SECONDS.labels('redis_write').time():
+        append_message(current_user.id, conversation_id, assistant_message_obj)
     
-    # Set expiration on conversation (30 days)
-    redis_client.expire(conversation_key, 60 * 60 * 24 * 30)
-    
-    # Send response to client
+    # Send the complete response to the client
     emit('message', {
+        'conversation_id': conversation_id,
         'message': response,
         'sources': sources
     })
+    
+    # Roll the turns that no longer fit in the prompt, and any that slid out of
+    # the history window unsummarized, into the running summary
+    if turns_kept < len(history) or summary['covered'] < history_start:
+        with STAGE_SECONDS.labels('summary_update').time():
+            update_summary(current_user.id, conversation_id, summary, history, history_start, turns_kept)
 
 # Main entry point
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Lexical Retrieval for Cerebras RAG
+----------------------------------
+Loads the BM25 index built by the pdf-processor (pdf-processor/bm25_index.py)
+and searches it, for hybrid retrieval and as a fallback when Weaviate is
+unavailable.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import heapq
+import logging
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Must match pdf-processor/bm25_index.py
+TOKENIZER_VERSION = 1
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+COMPOUND_PATTERN = re.compile(r"[a-z0-9]+(?:[-.,(][a-z0-9]+)+\)?")
+
+CURRENT_FILE = "CURRENT"
+INDEX_FILE = "bm25.json"
+POSTINGS_FILE = "postings.u32"
+DOCUMENTS_FILE = "documents.jsonl"
+
+def tokenize(text):
+    """Split text into lower-case terms, keeping compounds like "garch(1,1)" whole."""
+    text = text.lower()
+    return TOKEN_PATTERN.findall(text) + COMPOUND_PATTERN.findall(text)
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge ranked lists of keys; a key scores 1 / (k + rank) in every list it appears in.
+
+    Returns (key, score) pairs, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+class BM25Index:
+    """A BM25 index loaded from one index directory.
+
+    The term dictionary and postings are held in memory (a few MB for the
+    book); document properties are read from disk on demand.
+    """
+
+    def __init__(self, index_dir, k1=1.2, b=0.75):
+        """Load the index in index_dir."""
+        with open(os.path.join(index_dir, INDEX_FILE), "r") as f:
+            index = json.load(f)
+        if index.get("tokenizer_version") != TOKENIZER_VERSION:
+            raise ValueError(f"BM25 index in {index_dir} uses tokenizer version "
+                             f"{index.get('tokenizer_version')}, expected {TOKENIZER_VERSION}")
+
+        self.k1 = k1
+        self.b = b
+        self.doc_count = index["doc_count"]
+        self.avg_doc_length = index["avg_doc_length"] or 1.0
+        self.doc_lengths = index["doc_lengths"]
+        self.chunk_hashes = index["chunk_hashes"]
+        self.doc_offsets = index["doc_offsets"]
+        self.terms = index["terms"]
+
+        self.postings = array("I")
+        with open(os.path.join(index_dir, POSTINGS_FILE), "rb") as f:
+            self.postings.frombytes(f.read())
+
+        self.documents_file = os.path.join(index_dir, DOCUMENTS_FILE)
+        self.lock = threading.Lock()
+        self.documents = open(self.documents_file, "rb")
+
+    def search(self, query, limit=20):
+        """Return up to limit (document, score) pairs for query, best first."""
+        scores = {}
+        for term in set(tokenize(query)):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            offset, df = entry
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            for i in range(offset * 2, (offset + df) * 2, 2):
+                doc, frequency = self.postings[i], self.postings[i + 1]
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc] / self.avg_doc_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def document(self, doc):
+        """Return the stored properties of a document."""
+        with self.lock:
+            self.documents.seek(self.doc_offsets[doc])
+            return json.loads(self.documents.readline())
+
+    def close(self):
+        """Close the documents file."""
+        self.documents.close()
+
+class LocalIndex:
+    """The current BM25 index under index_root, reloaded when the pdf-processor publishes a new one.
+
+    The CURRENT file is re-read at most every reload_interval seconds.
+    """
+
+    def __init__(self, index_root, reload_interval=30):
+        """Initialize the index; it is loaded on first use."""
+        self.index_root = index_root
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.index = None
+        self.version = None
+        self.checked_at = 0.0
+
+    def get(self):
+        """Return the current BM25Index, or None if there is none."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked_at < self.reload_interval:
+                return self.index
+            self.checked_at = now
+
+            try:
+                with open(os.path.join(self.index_root, CURRENT_FILE), "r") as f:
+                    version = f.read().strip()
+            except FileNotFoundError:
+                return self.index
+
+            if version and version != self.version:
+                try:
+                    index = BM25Index(os.path.join(self.index_root, version))
+                except (OSError, ValueError) as e:
+                    logger.error(f"Could not load BM25 index {version}: {e}")
+                    return self.index
+                if self.index is not None:
+                    self.index.close()
+                self.index, self.version = index, version
+                logger.info(f"Loaded BM25 index {version} ({index.doc_count} documents)")
+            return self.index
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Metrics for Cerebras RAG
+------------------------
+Prometheus metrics of the chat application: how long each stage of
+answering a question takes, cache hit rates and queue depths. They are
+served in the Prometheus text format on /metrics.
+"""
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily
+
+# Stages of answering a question, in order:
+#   history_load     storing the question and reading the history (Redis)
+#   answer_cache     looking the question up in the answer cache
+#   summary_load     reading the running summary (Redis)
+#   retrieval        vector, BM25 and re-ranking, or the retrieval cache
+#   prompt_build     assembling the prompt
+#   llm_queue_wait   waiting for a Cerebras slot
+#   llm_first_token  from sending the prompt to the first streamed text
+#   llm_total        from sending the prompt to the end of the answer
+#   redis_write      storing the answer (Redis)
+#   summary_update   rolling old turns into the summary (Cerebras and Redis)
+STAGE_SECONDS = Histogram(
+    'rag_stage_duration_seconds',
+    'Time spent in each stage of answering a question',
+    ['stage'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+PROMPT_TOKENS = Histogram(
+    'rag_prompt_tokens',
+    'Estimated size of the prompts sent to Cerebras',
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 5000, 6000, 8000, 12000)
+)
+
+QUESTIONS = Counter(
+    'rag_questions',
+    'Questions by how they were answered: generated, cached, busy (turned away) or failed',
+    ['outcome']
+)
+
+ANSWER_CACHE_LOOKUPS = Counter(
+    'rag_answer_cache_lookups',
+    'Answer cache lookups by result: exact, semantic or miss',
+    ['result']
+)
+
+QUEUE_ACTIVE = Gauge('rag_queue_active', 'Requests in flight to a backend', ['queue'])
+QUEUE_WAITING = Gauge('rag_queue_waiting', 'Requests waiting for a backend', ['queue'])
+CIRCUIT_OPEN = Gauge('rag_circuit_open', 'Whether calls to an upstream are being refused (1) or not (0)', ['upstream'])
+
+class CounterCallback:
+    """A labelled counter whose values are read at scrape time.
+
+    read() returns a dict of label value -> count, taken from an object
+    that keeps its own counts (such as RetrievalCache).
+    """
+
+    def __init__(self, name, documentation, label, read):
+        """Initialize the collector."""
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.read = read
+
+    def collect(self):
+        """Yield the current values."""
+        family = CounterMetricFamily(self.name, self.documentation, labels=[self.label])
+        for value, count in self.read().items():
+            family.add_metric([value], count)
+        yield family
+
+def register_counter_callback(name, documentation, label, read):
+    """Expose counts kept elsewhere as a Prometheus counter."""
+    REGISTRY.register(CounterCallback(name, documentation, label, read))
+
+def watch_queue(queue, label):
+    """Report the depth of an AdmissionQueue at scrape time."""
+    QUEUE_ACTIVE.labels(label).set_function(lambda: queue.stats()['active'])
+    QUEUE_WAITING.labels(label).set_function(lambda: queue.stats()['waiting'])
+
+def watch_upstream(client, label):
+    """Report the circuit breaker of an UpstreamClient at scrape time."""
+    CIRCUIT_OPEN.labels(label).set_function(lambda: client.breaker.state != 'closed')
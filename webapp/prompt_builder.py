@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Prompt Builder for Cerebras RAG
+-------------------------------
+Assembles the Cerebras prompt from retrieved passages, their code examples
+and the conversation, within a fixed token budget.
+"""
+
+import re
+
+WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+TERM_PATTERN = re.compile(r"[a-z0-9]+")
+SENTENCE_BREAK_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z(\[])")
+
+# Words that say nothing about which sentences of a passage are relevant
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "how", "i", "in", "is", "it", "of", "on", "or", "the", "this", "to",
+    "what", "when", "where", "which", "why", "with", "you", "explain", "me"
+}
+
+SYSTEM_TEXT = """You are a financial engineering assistant with expertise in statistics and data analysis.
+Based on the following passages from Ruppert's "Statistics and Data Analysis for Financial Engineering" book,
+answer the user's question. Include relevant statistical formulas and code examples if available.
+"""
+
+SUMMARY_PROMPT = """Summarize the following conversation between a student and a financial engineering assistant
+in at most {max_words} words. Keep the topics, formulas, definitions and conclusions the student may refer back to.
+
+{summary}{turns}
+Summary:"""
+
+def estimate_tokens(text):
+    """Estimate the number of tokens in text: about one per word or symbol, more for long words."""
+    return sum(1 + len(word) // 8 for word in WORD_PATTERN.findall(text))
+
+def query_terms(text):
+    """Return the content words of a question."""
+    return {term for term in TERM_PATTERN.findall(text.lower()) if term not in STOP_WORDS and len(term) > 1}
+
+def format_turn(message):
+    """Format one message of the conversation for the prompt."""
+    role = "User" if message['role'] == 'user' else "Assistant"
+    return f"{role}: {message['content']}\n\n"
+
+class PromptBuilder:
+    """Build prompts that never exceed max_tokens.
+
+    The system text and the question are always included. Of the remaining
+    budget, up to history_share goes to the conversation: the running
+    summary of earlier turns first, then as many recent turns as fit,
+    newest first. What is left is split between passages and code
+    examples (code_share). Passages that do not fit their share are
+    compressed to their sentences sharing the most words with the
+    question, in their original order; code examples are added whole while
+    they fit, and budget left over by the passages goes to code.
+    """
+
+    def __init__(self, max_tokens=6000, history_share=0.25, code_share=0.2, max_question_tokens=1000):
+        """Initialize the builder with a token budget and its allocation."""
+        self.max_tokens = max_tokens
+        self.history_share = history_share
+        self.code_share = code_share
+        self.max_question_tokens = max_question_tokens
+
+    def build(self, question, chunks, history, summary=None):
+        """Return (prompt, turns_kept) for a question.
+
+        history holds the earlier messages of the conversation, oldest
+        first; turns_kept is how many of the most recent ones made it into
+        the prompt verbatim.
+        """
+        question = self.truncate(question, self.max_question_tokens)
+        tail = f"User: {question}\n\nAssistant:"
+        available = self.max_tokens - estimate_tokens(SYSTEM_TEXT) - estimate_tokens(tail) - 16
+
+        history_text, turns_kept = self.history_section(history, summary, int(available * self.history_share))
+        available -= estimate_tokens(history_text)
+
+        code_budget = int(available * self.code_share)
+        context, used = self.passages_section(question, chunks, available - code_budget)
+        context += self.code_section(chunks, available - used)
+
+        prompt = f"{SYSTEM_TEXT}\n{context}\n{history_text}{tail}"
+        return prompt, turns_kept
+
+    def history_section(self, history, summary, budget):
+        """Fit the summary and the most recent turns into budget."""
+        summary_text = ""
+        if summary:
+            summary_text = f"Summary of the earlier conversation: {self.truncate(summary, budget // 2)}\n\n"
+        budget -= estimate_tokens(summary_text)
+
+        turns = []
+        for message in reversed(history):
+            turn = format_turn(message)
+            tokens = estimate_tokens(turn)
+            if tokens > budget:
+                break
+            turns.append(turn)
+            budget -= tokens
+
+        if turns:
+            # No header without turns, as on the first question of a conversation
+            summary_text += "Previous conversation:\n" + "".join(reversed(turns))
+        return summary_text, len(turns)
+
+    def passages_section(self, question, chunks, budget):
+        """Format the passages, compressing those over their share of budget.
+
+        Returns the text and the number of tokens it uses.
+        """
+        terms = query_terms(question)
+        headers = []
+        for i, chunk in enumerate(chunks):
+            chapter_info = f"Chapter {chunk.get('chapterNumber', 'N/A')}: {chunk.get('chapterTitle', 'N/A')}"
+            if chunk.get('sectionNumber') and chunk.get('sectionTitle'):
+                chapter_info += f", Section {chunk.get('sectionNumber')}: {chunk.get('sectionTitle')}"
+            headers.append(f"\nPassage {i+1}:\n{chapter_info}\n\n")
+        budget -= sum(estimate_tokens(header) for header in headers)
+
+        # Share the budget evenly, handing what short passages leave over to the longer ones
+        contents = [chunk.get('content', '') for chunk in chunks]
+        sizes = [estimate_tokens(content) for content in contents]
+        shares = [0] * len(chunks)
+        remaining = max(0, budget)
+        order = sorted(range(len(chunks)), key=lambda i: sizes[i])
+        for position, i in enumerate(order):
+            shares[i] = min(sizes[i], remaining // (len(order) - position))
+            remaining -= shares[i]
+
+        context = ""
+        used = 0
+        for header, content, size, share in zip(headers, contents, sizes, shares):
+            if size > share:
+                content = self.compress(content, terms, share)
+            context += header + content + "\n\n"
+            used += estimate_tokens(header + content)
+        return context, used
+
+    def code_section(self, chunks, budget):
+        """Add whole code examples, in passage order, while they fit in budget."""
+        context = ""
+        for chunk in chunks:
+            for code, lang in zip(chunk.get('codeBlocks') or [], chunk.get('codeLanguages') or []):
+                example = f"Code Example ({lang}):\n```{lang}\n{code}\n```\n\n"
+                tokens = estimate_tokens(example)
+                if tokens <= budget:
+                    context += example
+                    budget -= tokens
+        return context
+
+    def compress(self, text, terms, budget):
+        """Keep the sentences of text that share the most terms with the question."""
+        if budget <= 0:
+            return ""
+        sentences = [sentence for sentence in SENTENCE_BREAK_PATTERN.split(text) if sentence.strip()]
+        scored = []
+        for position, sentence in enumerate(sentences):
+            overlap = len(terms & set(TERM_PATTERN.findall(sentence.lower())))
+            scored.append((-overlap, position))
+
+        # Every sentence may need a "..." marker (3 tokens) in front of it,
+        # and one more may close the passage
+        budget -= 3
+        chosen = []
+        for _, position in sorted(scored):
+            tokens = estimate_tokens(sentences[position]) + 3
+            if tokens <= budget:
+                chosen.append(position)
+                budget -= tokens
+
+        if not chosen:
+            # Not even one sentence fits; cut the passage instead
+            return self.truncate(text, budget)
+
+        # Keep the original order and mark where sentences were left out
+        parts = []
+        previous = -1
+        for position in sorted(chosen):
+            if position != previous + 1:
+                parts.append("...")
+            parts.append(sentences[position])
+            previous = position
+        if previous != len(sentences) - 1 and parts:
+            parts.append("...")
+        return " ".join(parts)
+
+    def truncate(self, text, budget):
+        """Cut text down to about budget tokens."""
+        if estimate_tokens(text) <= budget:
+            return text
+        for match in WORD_PATTERN.finditer(text):
+            budget -= 1 + len(match.group()) // 8
+            if budget < 0:
+                return text[:match.start()].rstrip() + " ..."
+        return text
+
+    def summary_prompt(self, summary, turns, max_words=150):
+        """Return the prompt that folds turns into the running summary."""
+        previous = f"Summary so far: {summary}\n\n" if summary else ""
+        return SUMMARY_PROMPT.format(
+            max_words=max_words,
+            summary=previous,
+            turns="".join(format_turn(message) for message in turns)
+        )
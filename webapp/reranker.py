@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Candidate Re-ranking for Cerebras RAG
+-------------------------------------
+Re-scores an over-fetched list of retrieved chunks and keeps the best few,
+within a latency budget.
+"""
+
+import re
+import time
+
+from lexical import COMPOUND_PATTERN, tokenize
+
+CODE_INTENT_PATTERN = re.compile(
+    r"\b(code|implement\w*|script|snippet|syntax)\b|\b(in|using|with) (r|python)\b|show me how"
+    r"|how (do|can) i (fit|compute|calculate|estimate|simulate|plot)",
+    re.IGNORECASE
+)
+SECTION_PATTERN = re.compile(r"\b(\d{1,2}\.\d{1,2})\b")
+WORD_PATTERN = re.compile(r"\w+")
+
+class LexicalScorer:
+    """Score candidates by the share of the query's terms they contain.
+
+    Compound terms such as "garch(1,1)" count double, since they pin down
+    exact notation. Cheap enough to run on every candidate.
+    """
+
+    def score(self, query, candidates):
+        """Return one score per candidate."""
+        weights = {term: 2.0 if COMPOUND_PATTERN.fullmatch(term) else 1.0 for term in tokenize(query)}
+        total = sum(weights.values())
+        if not total:
+            return [0.0] * len(candidates)
+        scores = []
+        for candidate in candidates:
+            document = set(tokenize(candidate.get("content") or ""))
+            scores.append(sum(weight for term, weight in weights.items() if term in document) / total)
+        return scores
+
+class CrossEncoderScorer:
+    """Score (query, passage) pairs with a sentence-transformers cross-encoder."""
+
+    def __init__(self, model_name="cross-encoder/ms-marco-MiniLM-L-6-v2", max_length=512):
+        """Load the cross-encoder model."""
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            raise RuntimeError("The cross-encoder scorer requires the sentence-transformers package")
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+
+    def score(self, query, candidates):
+        """Return one score per candidate."""
+        pairs = [(query, candidate.get("content") or "") for candidate in candidates]
+        return [float(score) for score in self.model.predict(pairs)]
+
+class Reranker:
+    """Re-rank candidates and return the best k.
+
+    Every candidate starts with a prior from its position in the retrieved
+    list. Scorers then run in order, each on batches of candidates taken
+    in that order, until the time budget (budget_ms) is spent; candidates
+    a scorer did not reach get its lowest score, so they keep their
+    relative order below the scored ones. Scores are min-max normalized
+    per scorer and combined by weight. Metadata boosts are added: hasCode
+    when the question asks for code, and a matching sectionNumber when the
+    question names a section. Finally duplicates are dropped: chunks whose
+    text is mostly contained in a better chunk of the same section; chunks
+    beyond max_per_section from one section are only used to fill up k.
+
+    rerank runs on a native thread, so it does not log; it returns the
+    scorers the budget did not reach for the caller to report.
+    """
+
+    def __init__(self, scorers, candidates=50, budget_ms=150, batch_size=16, code_boost=0.15,
+                 section_boost=0.3, max_per_section=2, overlap_threshold=0.6):
+        """Initialize the reranker with (scorer, weight) pairs."""
+        self.scorers = scorers
+        self.candidates = candidates
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.code_boost = code_boost
+        self.section_boost = section_boost
+        self.max_per_section = max_per_section
+        self.overlap_threshold = overlap_threshold
+
+    def rerank(self, query, candidates, k):
+        """Return the best k candidates for query, and the names of the scorers that were skipped."""
+        if len(candidates) <= 1:
+            return candidates[:k], []
+        deadline = time.monotonic() + self.budget_ms / 1000.0
+
+        count = len(candidates)
+        totals = [0.1 * (count - i) / count for i in range(count)]
+        skipped = []
+        for scorer, weight in self.scorers:
+            if skipped or time.monotonic() >= deadline:
+                skipped.append(type(scorer).__name__)
+                continue
+            scores = self.run_scorer(scorer, query, candidates, deadline)
+            low, high = min(scores), max(scores)
+            for i, score in enumerate(scores):
+                totals[i] += weight * ((score - low) / (high - low) if high > low else 0.0)
+
+        wants_code = bool(CODE_INTENT_PATTERN.search(query))
+        sections = set(SECTION_PATTERN.findall(query))
+        for i, candidate in enumerate(candidates):
+            if wants_code and candidate.get("hasCode"):
+                totals[i] += self.code_boost
+            if sections and str(candidate.get("sectionNumber")) in sections:
+                totals[i] += self.section_boost
+
+        ranked = sorted(range(count), key=lambda i: totals[i], reverse=True)
+        return self.deduplicate([candidates[i] for i in ranked], k), skipped
+
+    def run_scorer(self, scorer, query, candidates, deadline):
+        """Score candidates batch by batch until the deadline."""
+        scores = []
+        for start in range(0, len(candidates), self.batch_size):
+            if start and time.monotonic() >= deadline:
+                break
+            scores.extend(scorer.score(query, candidates[start:start + self.batch_size]))
+        if len(scores) < len(candidates):
+            scores.extend([min(scores)] * (len(candidates) - len(scores)))
+        return scores
+
+    def deduplicate(self, ranked, k):
+        """Keep the best k candidates, skipping overlapping chunks of the same section."""
+        kept = []
+        overflow = []
+        per_section = {}
+        for candidate in ranked:
+            section = (candidate.get("chapterNumber"), candidate.get("sectionNumber"))
+            if per_section.get(section, 0) >= self.max_per_section:
+                overflow.append(candidate)
+                continue
+            words = set(WORD_PATTERN.findall((candidate.get("content") or "").lower()))
+            duplicate = False
+            for other, other_words in kept:
+                if (other.get("chapterNumber"), other.get("sectionNumber")) != section:
+                    continue
+                if words and len(words & other_words) / len(words) >= self.overlap_threshold:
+                    duplicate = True
+                    break
+            if duplicate:
+                continue
+            kept.append((candidate, words))
+            per_section[section] = per_section.get(section, 0) + 1
+            if len(kept) == k:
+                break
+        # Too few distinct sections: fill up with the best of the rest
+        results = [candidate for candidate, _ in kept]
+        return results + overflow[:k - len(results)]
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Retrieval Helpers for Cerebras RAG
+----------------------------------
+Long-lived, pooled access to Weaviate and the query vectorizer for the
+chat application, and a cache of query vectors and retrieval results.
+"""
+
+import re
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+
+import redis
+import requests
+import weaviate
+from weaviate.config import Config, ConnectionConfig
+
+from lexical import reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+PUNCTUATION_PATTERN = re.compile(r"^[\W_]+|[\W_]+$")
+
+def normalize_question(question):
+    """Lower-case a question and collapse whitespace and surrounding punctuation."""
+    return PUNCTUATION_PATTERN.sub("", " ".join(question.lower().split()))
+
+def unit_vector(vector):
+    """Scale a vector to length 1, so that dot products are cosine similarities."""
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector] if norm else list(vector)
+
+def encode_vector(vector):
+    """Pack a vector as base64 float32, compact enough for a Redis string or hash."""
+    return base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+
+def decode_vector(data):
+    """Unpack a vector written by encode_vector."""
+    vector = array("f")
+    vector.frombytes(base64.b64decode(data))
+    return vector.tolist()
+
+class WeaviateClientPool:
+    """A process-wide Weaviate client with pooled keep-alive connections.
+
+    The client (and its metadata/readiness handshake) is created once and
+    shared by every request; its HTTP session keeps up to pool_maxsize
+    connections alive. Before use, a client idle for more than
+    health_interval seconds is health-checked and rebuilt if Weaviate no
+    longer answers, and a query that fails with a connection error is
+    retried once on a fresh client. The lock is a plain threading.Lock,
+    which eventlet's monkey patching turns into a green lock, so
+    greenlets wait on each other instead of racing to reconnect.
+    """
+
+    def __init__(self, url, api_key=None, pool_connections=10, pool_maxsize=50,
+                 health_interval=30, timeout=(5, 30)):
+        """Initialize the pool; the client is created on first use."""
+        self.url = url
+        self.api_key = api_key
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.client = None
+        self.checked_at = 0.0
+
+    def _connect(self):
+        """Create a client with a pooled, keep-alive HTTP session."""
+        auth_config = weaviate.auth.AuthApiKey(api_key=self.api_key) if self.api_key else None
+        client = weaviate.Client(
+            url=self.url,
+            auth_client_secret=auth_config,
+            timeout_config=self.timeout,
+            additional_config=Config(connection_config=ConnectionConfig(
+                session_pool_connections=self.pool_connections,
+                session_pool_maxsize=self.pool_maxsize
+            ))
+        )
+        logger.info(f"Connected to Weaviate at {self.url}")
+        return client
+
+    def get(self):
+        """Return the shared client, health-checking it if it has been idle."""
+        with self.lock:
+            now = time.monotonic()
+            if self.client is None:
+                self.client = self._connect()
+            elif now - self.checked_at > self.health_interval:
+                try:
+                    ready = self.client.is_ready()
+                except requests.RequestException:
+                    ready = False
+                if not ready:
+                    logger.warning("Weaviate client failed its health check, reconnecting")
+                    self.client = None
+                    self.client = self._connect()
+            self.checked_at = now
+            return self.client
+
+    def reset(self):
+        """Drop the shared client so that the next use reconnects."""
+        with self.lock:
+            self.client = None
+
+    def run(self, operation):
+        """Run operation(client), retrying once on a fresh client after a connection error.
+
+        Read timeouts are not retried, so that a slow Weaviate costs one
+        timeout before the caller falls back.
+        """
+        try:
+            return operation(self.get())
+        except requests.ConnectionError as e:
+            logger.warning(f"Weaviate connection error ({e}), reconnecting")
+            self.reset()
+            return operation(self.get())
+
+class TextVectorizer:
+    """Vectorize text with the t2v-transformers inference container.
+
+    This is the same model Weaviate uses to vectorize chunks and nearText
+    queries, so the vectors are comparable with the indexed ones. With a
+    RetrievalCache, vectors are memoized by normalized text.
+    """
+
+    def __init__(self, url, timeout=(2, 10), cache=None):
+        """Initialize the vectorizer for an inference API URL."""
+        self.vectors_url = f"{url.rstrip('/')}/vectors"
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+
+    def vectorize(self, text):
+        """Return the vector of text as a list of floats."""
+        if self.cache is not None:
+            vector = self.cache.get_vector(text)
+            if vector is not None:
+                return vector
+
+        response = self.session.post(self.vectors_url, json={"text": text}, timeout=self.timeout)
+        response.raise_for_status()
+        vector = response.json()["vector"]
+
+        if self.cache is not None:
+            self.cache.put_vector(text, vector)
+        return vector
+
+class LRUDict:
+    """A bounded mapping that evicts its least recently used entries."""
+
+    def __init__(self, max_entries):
+        """Initialize an empty mapping holding at most max_entries entries."""
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None, marking it as recently used."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entry if full."""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Remove every entry."""
+        with self.lock:
+            self.entries.clear()
+
+class RetrievalCache:
+    """Memoized query vectors and top-k retrieval results.
+
+    Both live in a bounded in-process LRU, with Redis as an optional second
+    tier shared by all processes. Results are keyed by the normalized query
+    and the retrieval parameters (class, limit, properties) and scoped to
+    the index generation, so an index change invalidates them: the local
+    tier is cleared when a new generation is seen and the Redis keys of old
+    generations are never read again and expire. Query vectors depend only
+    on the model, so they survive index changes.
+
+    Redis layout:
+      retrieval:vector:<hash>         base64 float32 query vector
+      retrieval:G:results:<hash>      JSON list of result objects
+    """
+
+    def __init__(self, max_entries=1024, redis_client=None, ttl=3600):
+        """Initialize the cache; without a Redis client only the local tier is used."""
+        self.vectors = LRUDict(max_entries)
+        self.results = LRUDict(max_entries)
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def query_hash(self, *parts):
+        """Hash a normalized query together with any retrieval parameters."""
+        key = json.dumps([normalize_question(parts[0])] + list(parts[1:]), sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_vector(self, query):
+        """Return the memoized vector of a query, or None."""
+        query_hash = self.query_hash(query)
+        vector = self.vectors.get(query_hash)
+        if vector is None and self.redis_client is not None:
+            try:
+                data = self.redis_client.get(f"retrieval:vector:{query_hash}")
+            except redis.RedisError as e:
+                logger.error(f"Error reading query vector cache: {e}")
+                data = None
+            if data is not None:
+                vector = decode_vector(data)
+                self.vectors.put(query_hash, vector)
+        return vector
+
+    def put_vector(self, query, vector):
+        """Memoize the vector of a query."""
+        query_hash = self.query_hash(query)
+        self.vectors.put(query_hash, vector)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(f"retrieval:vector:{query_hash}", encode_vector(vector), ex=self.ttl)
+            except redis.RedisError as e:
+                logger.error(f"Error writing query vector cache: {e}")
+
+    def get_results(self, query, generation, params):
+        """Return the cached results of a query, or None."""
+        generation = str(generation)
+        if generation != self.generation:
+            self.results.clear()
+            self.generation = generation
+
+        results_hash = self.query_hash(query, params)
+        results = self.results.get(results_hash)
+        if results is None and self.redis_client is not None:
+            try:
+                data = self.redis_client.get(f"retrieval:{generation}:results:{results_hash}")
+            except redis.RedisError as e:
+                logger.error(f"Error reading retrieval cache: {e}")
+                data = None
+            if data is not None:
+                results = json.loads(data)
+                self.results.put(results_hash, results)
+
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return results
+
+    def put_results(self, query, generation, params, results):
+        """Cache the results of a query."""
+        generation = str(generation)
+        if generation != self.generation:
+            return  # The index changed while the query ran
+        results_hash = self.query_hash(query, params)
+        self.results.put(results_hash, results)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(f"retrieval:{generation}:results:{results_hash}",
+                                      json.dumps(results), ex=self.ttl)
+            except redis.RedisError as e:
+                logger.error(f"Error writing retrieval cache: {e}")
+
+class Retriever:
+    """Top-k passage retrieval, fusing Weaviate vector search with BM25.
+
+    The query is vectorized through the (memoizing) vectorizer and searched
+    with nearVector, so Weaviate does not re-vectorize it; if the vectorizer
+    is unavailable, Weaviate's nearText is used instead. With a lexical
+    index (a lexical.LocalIndex), the top `candidates` hits of both searches
+    are merged by reciprocal-rank fusion, which catches exact terms such as
+    "GARCH(1,1)" that embeddings blur; if Weaviate fails, the BM25 hits
+    alone are used. With a reranker (a reranker.Reranker), its `candidates`
+    best hits are fetched and re-ranked down to the requested limit.
+    Results are served from the RetrievalCache when possible; fallback
+    results are not cached.
+    """
+
+    def __init__(self, pool, vectorizer=None, cache=None, lexical=None, candidates=20, rrf_k=60,
+                 reranker=None, offload=None):
+        """Initialize the retriever with a client pool, vectorizer, cache, lexical index and reranker.
+
+        offload(function, *args) runs the CPU-bound re-ranking, for example
+        on a thread pool; by default it runs inline.
+        """
+        self.pool = pool
+        self.offload = offload or (lambda function, *args: function(*args))
+        self.vectorizer = vectorizer
+        self.cache = cache
+        self.lexical = lexical
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.reranker = reranker
+
+    def search(self, query, class_name, generation, properties, limit=5):
+        """Return the properties of the top `limit` chunks for query.
+
+        properties must include chunkHash, which identifies a chunk in
+        both indexes.
+        """
+        params = {"class": class_name, "limit": limit, "properties": list(properties),
+                  "hybrid": self.lexical is not None, "rerank": self.reranker is not None}
+        if self.cache is not None:
+            results = self.cache.get_results(query, generation, params)
+            if results is not None:
+                return results
+
+        fetch = max(limit, self.reranker.candidates) if self.reranker is not None else limit
+        index = self.lexical.get() if self.lexical is not None else None
+        try:
+            vector_results = self.vector_search(query, class_name, properties,
+                                                max(fetch, self.candidates) if index else fetch)
+        except Exception as e:
+            if index is None:
+                raise
+            logger.warning(f"Vector search failed ({e}), answering from the BM25 index")
+            return self.rerank(query, self.lexical_results(index, query, properties, fetch), limit)
+
+        results = vector_results[:fetch]
+        if index is not None:
+            results = self.fuse(index, query, vector_results, properties, fetch)
+        results = self.rerank(query, results, limit)
+
+        if self.cache is not None:
+            self.cache.put_results(query, generation, params, results)
+        return results
+
+    def rerank(self, query, results, limit):
+        """Re-rank results down to limit, if there is a reranker."""
+        if self.reranker is None:
+            return results[:limit]
+        results, skipped = self.offload(self.reranker.rerank, query, results, limit)
+        if skipped:
+            # Logged here: the offloaded re-ranking must not take logging's green lock
+            logger.info(f"Re-ranking budget spent before {', '.join(skipped)}")
+        return results
+
+    def vector_search(self, query, class_name, properties, limit):
+        """Return the top `limit` objects of a vector search in Weaviate."""
+        vector = None
+        if self.vectorizer is not None:
+            try:
+                vector = self.vectorizer.vectorize(query)
+            except requests.RequestException as e:
+                logger.warning(f"Query vectorization failed ({e}), falling back to nearText")
+
+        def run_query(client):
+            query_builder = client.query.get(class_name, list(properties)).with_additional(["id"])
+            if vector is not None:
+                query_builder = query_builder.with_near_vector({"vector": vector})
+            else:
+                query_builder = query_builder.with_near_text({"concepts": [query]})
+            return query_builder.with_limit(limit).do()
+
+        query_result = self.pool.run(run_query)
+        if "errors" in query_result:
+            raise RuntimeError(f"Weaviate query failed: {query_result['errors']}")
+        return query_result["data"]["Get"][class_name]
+
+    def fuse(self, index, query, vector_results, properties, limit):
+        """Merge vector and BM25 hits by reciprocal-rank fusion."""
+        by_hash = {result["chunkHash"]: result for result in vector_results}
+        lexical_hits = {index.chunk_hashes[doc]: doc for doc, _ in index.search(query, max(limit, self.candidates))}
+        fused = reciprocal_rank_fusion([list(by_hash), list(lexical_hits)], k=self.rrf_k)
+
+        results = []
+        for chunk_hash, _ in fused[:limit]:
+            if chunk_hash in by_hash:
+                results.append(by_hash[chunk_hash])
+            else:
+                results.append(self.stored_properties(index, lexical_hits[chunk_hash], properties))
+        return results
+
+    def lexical_results(self, index, query, properties, limit):
+        """Return the top `limit` BM25 hits with their stored properties."""
+        return [self.stored_properties(index, doc, properties) for doc, _ in index.search(query, limit)]
+
+    def stored_properties(self, index, doc, properties):
+        """Return the requested properties of a document stored with the BM25 index."""
+        document = index.document(doc)
+        return {name: document.get(name) for name in properties}
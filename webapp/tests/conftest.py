@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The webapp's modules are imported by their top-level names, as in app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+from admission import AdmissionQueue, QueueTimeout
+
+def hold_slot(queue):
+    """Hold a slot on another thread until the returned event is set."""
+    entered, leave = threading.Event(), threading.Event()
+
+    def run():
+        with queue.slot():
+            entered.set()
+            leave.wait()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    entered.wait()
+    return leave, thread
+
+def test_failing_position_callback_gives_up_its_place():
+    queue = AdmissionQueue("test", limit=1, poll_interval=0.01)
+    leave, thread = hold_slot(queue)
+
+    def on_position(position):
+        raise RuntimeError("client went away")
+
+    with pytest.raises(RuntimeError):
+        with queue.slot(on_position=on_position):
+            pass
+    assert queue.stats() == {"active": 1, "waiting": 0, "limit": 1}
+    leave.set()
+    thread.join()
+    assert queue.stats()["active"] == 0
+
+def test_slot_handed_over_to_an_interrupted_waiter_is_passed_on():
+    queue = AdmissionQueue("test", limit=1, poll_interval=0.01)
+    leave, thread = hold_slot(queue)
+    calls = []
+
+    def on_position(position):
+        calls.append(position)
+        if len(calls) == 1:
+            # The slot is handed to this waiter while it is being interrupted
+            leave.set()
+            thread.join()
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        with queue.slot(on_position=on_position):
+            pass
+    assert queue.stats() == {"active": 0, "waiting": 0, "limit": 1}
+
+def test_timed_out_waiter_does_not_release_a_slot():
+    queue = AdmissionQueue("test", limit=1, max_wait=0.05, poll_interval=0.01)
+    leave, thread = hold_slot(queue)
+    with pytest.raises(QueueTimeout):
+        with queue.slot():
+            pass
+    assert queue.stats() == {"active": 1, "waiting": 0, "limit": 1}
+    leave.set()
+    thread.join()
+    assert queue.stats()["active"] == 0
@@ -0,0 +1,18 @@
+from prompt_builder import PromptBuilder, SYSTEM_TEXT
+
+CHUNKS = [{"chapterNumber": 18, "chapterTitle": "GARCH Models", "content": "A GARCH(1,1) model has two parameters."}]
+
+def test_first_question_has_no_history_section():
+    prompt, turns_kept = PromptBuilder().build("What is a GARCH model?", CHUNKS, [])
+    assert turns_kept == 0
+    assert "Previous conversation" not in prompt
+    assert "Summary of the earlier conversation" not in prompt
+    assert prompt.startswith(SYSTEM_TEXT)
+    assert prompt.endswith("User: What is a GARCH model?\n\nAssistant:")
+
+def test_history_keeps_recent_turns_after_the_summary():
+    history = [{"role": "user", "content": "What is volatility?"},
+               {"role": "assistant", "content": "The standard deviation of returns."}]
+    prompt, turns_kept = PromptBuilder().build("And GARCH?", CHUNKS, history, summary="Volatility was defined.")
+    assert turns_kept == 2
+    assert prompt.index("Summary of the earlier conversation") < prompt.index("Previous conversation:\nUser: What is volatility?")
@@ -0,0 +1,23 @@
+import time
+
+from reranker import Reranker, LexicalScorer
+
+class SlowScorer(LexicalScorer):
+    def score(self, query, candidates):
+        time.sleep(0.05)
+        return super().score(query, candidates)
+
+def candidates(count):
+    return [{"content": f"garch model {i}", "chapterNumber": i, "sectionNumber": f"{i}.1"} for i in range(count)]
+
+def test_rerank_returns_scorers_the_budget_did_not_reach():
+    reranker = Reranker([(SlowScorer(), 1.0), (LexicalScorer(), 0.5)], budget_ms=10, batch_size=2)
+    results, skipped = reranker.rerank("garch", candidates(6), 3)
+    assert len(results) == 3
+    assert skipped == ["LexicalScorer"]
+
+def test_rerank_within_budget_skips_nothing():
+    reranker = Reranker([(LexicalScorer(), 1.0)], budget_ms=1000)
+    results, skipped = reranker.rerank("garch model 2", candidates(4), 2)
+    assert len(results) == 2
+    assert skipped == []
@@ -0,0 +1,73 @@
+import time
+
+import requests
+
+from retrieval import WeaviateClientPool, Retriever
+
+QUERY_TIMEOUT = 0.2
+
+class StalledQuery:
+    """A Weaviate query builder whose query never answers within the read timeout."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def do(self):
+        time.sleep(QUERY_TIMEOUT)
+        raise requests.ReadTimeout("Read timed out")
+
+class StalledClient:
+    def __init__(self):
+        self.query = StalledQuery()
+
+class StalledPool(WeaviateClientPool):
+    """A pool whose clients stall, counting how many it creates."""
+
+    def __init__(self):
+        super().__init__("http://weaviate:8080")
+        self.connects = 0
+
+    def _connect(self):
+        self.connects += 1
+        return StalledClient()
+
+class FakeIndex:
+    """A BM25 index over three documents, returned in order."""
+
+    chunk_hashes = ["a", "b", "c"]
+
+    def search(self, query, limit=20):
+        return [(doc, 1.0 / (doc + 1)) for doc in range(len(self.chunk_hashes))][:limit]
+
+    def document(self, doc):
+        return {"chunkHash": self.chunk_hashes[doc], "content": f"chunk {doc}"}
+
+class FakeLocalIndex:
+    def get(self):
+        return FakeIndex()
+
+def test_stalled_weaviate_falls_back_to_bm25_after_one_timeout():
+    pool = StalledPool()
+    retriever = Retriever(pool, lexical=FakeLocalIndex())
+
+    started = time.monotonic()
+    results = retriever.search("GARCH(1,1)", "BookChunk", 1, ["chunkHash", "content"], limit=2)
+    elapsed = time.monotonic() - started
+
+    assert [result["chunkHash"] for result in results] == ["a", "b"]
+    assert elapsed < 2 * QUERY_TIMEOUT
+    assert pool.connects == 1
+
+def test_connection_error_is_retried_on_a_fresh_client():
+    pool = StalledPool()
+    calls = []
+
+    def operation(client):
+        calls.append(client)
+        if len(calls) == 1:
+            raise requests.ConnectionError("Connection refused")
+        return "ok"
+
+    assert pool.run(operation) == "ok"
+    assert pool.connects == 2
+    assert calls[0] is not calls[1]
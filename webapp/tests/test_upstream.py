@@ -0,0 +1,88 @@
+import pytest
+import requests
+
+from upstream import CircuitBreaker, CircuitOpen, UpstreamClient
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+class FakeSession:
+    """Answers requests from a script of status codes and exceptions."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        step = self.script.pop(0)
+        if isinstance(step, BaseException):
+            raise step
+        return FakeResponse(step)
+
+def make_client(*script, retries=0):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    client = UpstreamClient("test", retries=retries, backoff=0, breaker=breaker)
+    client.session = FakeSession(*script)
+    return client
+
+def open_breaker(client):
+    client.get("http://upstream/")
+    assert client.breaker.state == "open"
+
+def test_server_error_opens_the_breaker():
+    client = make_client(503, 200)
+    open_breaker(client)
+    client.breaker.reset_timeout = 60
+    with pytest.raises(CircuitOpen):
+        client.get("http://upstream/")
+
+def test_successful_trial_closes_the_breaker():
+    client = make_client(503, 200)
+    open_breaker(client)
+    assert client.get("http://upstream/").status_code == 200
+    assert client.breaker.state == "closed"
+
+def test_trial_answered_429_lets_the_next_call_try():
+    client = make_client(503, 429, 200)
+    open_breaker(client)
+    assert client.get("http://upstream/").status_code == 429
+    assert client.breaker.state == "open"
+    assert client.get("http://upstream/").status_code == 200
+    assert client.breaker.state == "closed"
+
+@pytest.mark.parametrize("error", [
+    requests.exceptions.ChunkedEncodingError("broken"),
+    requests.ReadTimeout("slow"),
+    requests.ConnectionError("refused"),
+    KeyboardInterrupt()
+])
+def test_trial_ending_in_an_exception_reopens_the_breaker(error):
+    client = make_client(503, error, 200)
+    open_breaker(client)
+    with pytest.raises(type(error)):
+        client.get("http://upstream/")
+    assert client.breaker.state == "open"
+    # The breaker is not stuck half-open: after reset_timeout there is a new trial
+    assert client.get("http://upstream/").status_code == 200
+    assert client.breaker.state == "closed"
+
+def test_retries_of_a_trial_do_not_trip_the_breaker():
+    client = make_client(503, 503, requests.ConnectionError("refused"), 200)
+    open_breaker(client)
+    client.retries = 2
+    assert client.get("http://upstream/").status_code == 200
+    assert client.session.calls == 4
+    assert client.breaker.state == "closed"
+
+def test_request_counts_once_towards_the_threshold():
+    client = make_client(503, 503, 503, retries=2)
+    client.breaker.failure_threshold = 2
+    assert client.get("http://upstream/").status_code == 503
+    assert client.breaker.failures == 1
+    assert client.breaker.state == "closed"
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Upstream HTTP Clients for Cerebras RAG
+--------------------------------------
+Pooled, keep-alive HTTP clients for the services the webapp calls (the
+Cerebras API and the code executor), with timeouts, retries and a circuit
+breaker.
+"""
+
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 502, 503, 504}
+
+class CircuitOpen(requests.RequestException):
+    """Raised instead of calling an upstream that is failing."""
+
+class CircuitBreaker:
+    """Stop calling an upstream after failure_threshold consecutive failures.
+
+    While open, calls fail immediately with CircuitOpen. After
+    reset_timeout seconds one trial call is let through: if it succeeds
+    the breaker closes, if it fails it stays open for another
+    reset_timeout, and if it is released without a verdict the next call
+    becomes the trial.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        """Initialize a closed breaker for a named upstream."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        """Raise CircuitOpen unless a call may go through."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.trial = True
+                return
+            raise CircuitOpen(f"{self.name} is unavailable, not calling it for now")
+
+    def record_success(self):
+        """Close the breaker."""
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"{self.name} is available again")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def release(self):
+        """End a call without a verdict, letting the next call be the trial if this one was."""
+        with self.lock:
+            self.trial = False
+
+    def record_failure(self):
+        """Count a failure, opening the breaker at the threshold or after a failed trial."""
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if not self.trial:
+                    logger.warning(f"{self.name} failed {self.failures} times in a row, opening the circuit")
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    @property
+    def state(self):
+        """Return "closed", "open" or "half-open"."""
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.trial else "open"
+
+class UpstreamClient:
+    """A shared HTTP session for one upstream service.
+
+    The session keeps up to pool_maxsize connections alive, so requests do
+    not pay for a TCP and TLS handshake each time. Every request gets a
+    (connect, read) timeout. Requests that fail with a connection error or
+    one of retry_statuses (by default 429/502/503/504) are retried up to
+    `retries` times, after a random delay of up to backoff * 2^attempt
+    seconds (at most max_backoff, or the server's Retry-After). Read
+    timeouts are not retried, since the upstream may already be working
+    on the request. Each request, retries included, counts once towards a
+    CircuitBreaker: as a failure if it ends in an exception or a 5xx
+    response, as neither if it ends in a 429, and as a success otherwise.
+    While the upstream is down callers fail fast instead of waiting for
+    timeouts.
+    """
+
+    def __init__(self, name, pool_maxsize=20, timeout=(3, 60), retries=2, backoff=0.5,
+                 max_backoff=4.0, breaker=None, retry_statuses=RETRY_STATUSES):
+        """Initialize the client for a named upstream."""
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_statuses = retry_statuses
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker(name)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, url, **kwargs):
+        """POST to url and return the response; see request()."""
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """GET url and return the response; see request()."""
+        return self.request("GET", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Send a request and return the response; see requests.Session.request.
+
+        With stream=True, retries only cover getting the response headers.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        self.breaker.allow()
+        try:
+            response = self._send(method, url, kwargs)
+        except BaseException:
+            # Whatever went wrong, a trial call must not stay unsettled
+            self.breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        elif response.status_code == 429:
+            # A 429 says nothing about whether the upstream is healthy
+            self.breaker.release()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _send(self, method, url, kwargs):
+        """Send a request, retrying connection errors and retry_statuses."""
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError as e:
+                if attempt >= self.retries:
+                    raise
+                logger.warning(f"{self.name} connection error ({e}), retrying")
+                self.sleep(attempt)
+                attempt += 1
+                continue
+
+            if response.status_code not in self.retry_statuses or attempt >= self.retries:
+                return response
+
+            logger.warning(f"{self.name} answered {response.status_code}, retrying")
+            retry_after = response.headers.get("Retry-After")
+            response.close()
+            self.sleep(attempt, retry_after)
+            attempt += 1
+
+    def sleep(self, attempt, retry_after=None):
+        """Wait before retry number attempt + 1."""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = min(self.max_backoff, max(delay, int(retry_after)))
+        time.sleep(delay)
+
+    def stats(self):
+        """Return the state of the circuit breaker."""
+        return {"circuit": self.breaker.state, "consecutive_failures": self.breaker.failures}